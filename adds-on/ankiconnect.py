@@ -321,6 +321,58 @@ class AnkiBridge:
         if note is None:
             return
 
+        self.injectAudio(note, params)
+
+        self.startEditing()
+        collection.addNote(note)
+        collection.autosave()
+        self.stopEditing()
+
+        return note.id
+
+
+    def addNotes(self, paramsList):
+        collection = self.collection()
+        if collection is None:
+            return [None] * len(paramsList)
+
+        # notes are added in groups by deck, as the deck is set on the model
+        results = [None] * len(paramsList)
+        groups = {}
+        firsts = set()
+        for i, params in enumerate(paramsList):
+            if not params.validate():
+                continue
+
+            note = self.createNote(params)
+            if note is None:
+                continue
+
+            # duplicates of notes earlier in the batch
+            first = (note.mid, anki.utils.stripHTMLMedia(note.fields[0]))
+            if first in firsts:
+                continue
+            firsts.add(first)
+
+            self.injectAudio(note, params)
+            groups.setdefault(params.deckName, []).append((i, note))
+
+        self.startEditing()
+        for deckName, group in groups.items():
+            deck = collection.decks.byName(deckName)
+            for i, note in group:
+                note.model()['did'] = deck['id']
+            notes = [note for i, note in group]
+            for (i, note), (ncards, error) in zip(group, collection.addNotes(notes)):
+                if ncards:
+                    results[i] = note.id
+        collection.autosave()
+        self.stopEditing()
+
+        return results
+
+
+    def injectAudio(self, note, params):
         if params.audio is not None and len(params.audio.fields) > 0:
             data = download(params.audio.url)
             if data is not None:
@@ -335,13 +387,6 @@ class AnkiBridge:
                     audioInject(note, params.audio.fields, params.audio.filename)
                     self.media().writeData(params.audio.filename, data)
 
-        self.startEditing()
-        collection.addNote(note)
-        collection.autosave()
-        self.stopEditing()
-
-        return note.id
-
 
     def canAddNote(self, note):
         return bool(self.createNote(note))
@@ -472,15 +517,7 @@ class AnkiConnect:
 
 
     def api_addNotes(self, notes):
-        results = []
-        for note in notes:
-            params = AnkiNoteParams(note)
-            if note.validate():
-                results.append(self.anki.addNote(params))
-            else:
-                results.append(None)
-
-        return results
+        return self.anki.addNotes([AnkiNoteParams(note) for note in notes])
 
 
     def api_canAddNotes(self, notes):
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""
+Automatic backups of a collection.
+
+The collection is copied with sqlite's online backup API, a few pages
+at a time, so that it can be saved between two steps; the copy starts
+again if the collection is saved meanwhile. In the WAL journal mode,
+where reading the collection doesn't prevent saving it, it may thus be
+open and studied while the backup is taken.
+
+A backup is either a .colpkg file without media, which can be imported
+like any collection package, or, when the chunk store is used, a
+manifest backup-*.chunks listing the chunks of the copy. The chunks are
+the blocks of chunkSize bytes of the copy, compressed, and stored in
+the folder chunks of the backup folder under the sha1 of the block.
+As the pages of the collection which didn't change are at the same
+offset in each copy, consecutive backups share most of their chunks.
+"""
+
+import os, re, time, zlib, zipfile
+from hashlib import sha1
+
+from anki.db import DB
+from anki.utils import json
+
+# number of pages copied at each step of the backup
+backupPages = 256
+# seconds slept between two steps, so that the collection can be saved
+backupSleep = 0.005
+# seconds to wait for the collection being saved when reading it
+backupTimeout = 5
+
+_backupRe = re.compile(r"backup-\d{4}-\d{2}-.+\.(colpkg|chunks)$")
+
+def copyCollection(path, dst, progress=None):
+    """Copy the collection at path, which may be open, to the file dst.
+
+    progress -- if not None, called after each step with the status, the
+    number of pages remaining and the total number of pages."""
+    db = DB(path, timeout=backupTimeout, readOnly=True)
+    try:
+        db.backup(dst, pages=backupPages, sleep=backupSleep,
+                  progress=progress)
+    finally:
+        db.close()
+
+def writeColpkg(colfile, path):
+    "Write the collection file colfile in a new .colpkg at path, without media."
+    z = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+    z.write(colfile, "collection.anki2")
+    z.writestr("media", "{}")
+    z.close()
+
+def backup(path, folder, keep, chunks=False, progress=None):
+    """Back up the collection at path into the folder, and remove the
+    oldest backups so that keep remain. Return the path of the backup.
+
+    chunks -- whether to store the backup in the chunk store, instead of
+    as a .colpkg.
+    progress -- as in copyCollection."""
+    return storeSnapshot(snapshot(path, folder, progress), keep, chunks)
+
+def snapshot(path, folder, progress=None):
+    """Copy the collection at path to a temporary file of the folder, named
+    after the backup it is for, and return the path of the file.
+
+    progress -- as in copyCollection."""
+    name = time.strftime("backup-%Y-%m-%d-%H.%M.%S", time.localtime())
+    tmp = os.path.join(folder, name + ".tmp")
+    try:
+        copyCollection(path, tmp, progress)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return tmp
+
+def storeSnapshot(tmp, keep, chunks=False):
+    """Store the copy tmp returned by snapshot() as a backup, remove it, and
+    remove the oldest backups so that keep remain. Return the path of the
+    backup.
+
+    chunks -- as in backup()."""
+    folder, name = os.path.split(tmp[:-len(".tmp")])
+    try:
+        if chunks:
+            dst = os.path.join(folder, name + ".chunks")
+            ChunkStore(folder).add(tmp, dst)
+        else:
+            dst = os.path.join(folder, name + ".colpkg")
+            writeColpkg(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+    prune(folder, keep)
+    return dst
+
+def prune(folder, keep):
+    """Remove the oldest backups of the folder so that keep remain, and the
+    chunks no remaining backup uses."""
+    backups = sorted(f for f in os.listdir(folder) if _backupRe.match(f))
+    while len(backups) > keep:
+        os.unlink(os.path.join(folder, backups.pop(0)))
+    store = ChunkStore(folder)
+    if os.path.exists(store.dir):
+        store.collect()
+
+def restoreColpkg(manifest, path):
+    """Write the backup of the chunk store whose manifest is at the path
+    manifest as a .colpkg at path."""
+    tmp = path + ".anki2"
+    try:
+        ChunkStore(os.path.dirname(manifest)).restore(manifest, tmp)
+        writeColpkg(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+class ChunkStore:
+
+    """
+    folder -- the backup folder, containing the manifests
+    dir -- the folder of the chunks
+    """
+
+    # size of the chunks, a multiple of sqlite's page size
+    chunkSize = 64*1024
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.dir = os.path.join(folder, "chunks")
+
+    def add(self, file, manifest):
+        """Store the chunks of file which are not already stored, and write
+        the manifest listing them at the path manifest."""
+        hashes = []
+        size = 0
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(self.chunkSize), b""):
+                h = sha1(block).hexdigest()
+                path = self._path(h)
+                if not os.path.exists(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    self._write(path, zlib.compress(block))
+                hashes.append(h)
+                size += len(block)
+        # written last, so that it only lists chunks which exist
+        self._write(manifest, json.dumps(
+            dict(size=size, chunks=hashes)).encode("utf8"))
+
+    def restore(self, manifest, file):
+        "Write at the path file the file whose manifest is at manifest."
+        m = self._manifest(manifest)
+        with open(file, "wb") as f:
+            for h in m['chunks']:
+                with open(self._path(h), "rb") as c:
+                    f.write(zlib.decompress(c.read()))
+            if f.tell() != m['size']:
+                raise Exception("backup %s is incomplete" % manifest)
+
+    def collect(self):
+        "Remove the chunks which no manifest of the folder lists."
+        used = set()
+        for name in os.listdir(self.folder):
+            if name.endswith(".chunks"):
+                used.update(self._manifest(
+                    os.path.join(self.folder, name))['chunks'])
+        for sub in os.listdir(self.dir):
+            for name in os.listdir(os.path.join(self.dir, sub)):
+                if name not in used:
+                    os.unlink(os.path.join(self.dir, sub, name))
+
+    def _path(self, h):
+        return os.path.join(self.dir, h[:2], h)
+
+    def _manifest(self, path):
+        with open(path, "rb") as f:
+            return json.loads(f.read().decode("utf8"))
+
+    def _write(self, path, data):
+        "Write data at path, so that no partial file is ever at path."
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
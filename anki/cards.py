@@ -62,7 +62,7 @@ class Card:
     wasNew --
     """
 
-    def __init__(self, col, id=None):
+    def __init__(self, col, id=None, row=None):
         """
         This function returns a card object from the collection given in argument.
 
@@ -72,12 +72,16 @@ class Card:
         Keyword arguments:
         col -- a collection
         id -- an identifier of a card
+        row -- the row of the card in the table cards, if it was
+        already read, instead of the id
         """
         self.col = col
         self.timerStarted = None
         self._qa = None
         self._note = None
-        if id:
+        if row:
+            self.load(row)
+        elif id:
             self.id = id
             self.load()
         else:
@@ -97,11 +101,14 @@ class Card:
             self.flags = 0
             self.data = ""
 
-    def load(self):
+    def load(self, row=None):
         """
         Given a card, complete it with the information extracted from the database.
 
-        It is assumed that the card's id and col are already known."""
+        It is assumed that the card's id and col are already known.
+
+        row -- the row of the card in the table cards, if it was already
+        read."""
         (self.id,
          self.nid,
          self.did,
@@ -119,7 +126,7 @@ class Card:
          self.odue,
          self.odid,
          self.flags,
-         self.data) = self.col.db.first(
+         self.data) = row or self.col.db.first(
              "select * from cards where id = ?", self.id)
         self._qa = None
         self._note = None
@@ -157,10 +164,12 @@ insert or replace into cards values
             self.odid,
             self.flags,
             self.data)
+        self.col.sched._dropPrefetched([self.id])
         self.col.log(self)
 
     def flushSched(self):
-        """Update the card into the database.
+        """Update the card into the database. The update is deferred, see
+        DB.defer().
 
         This card is supposed to already
         exists in the db."""
@@ -170,7 +179,7 @@ insert or replace into cards values
         if self.queue == QUEUE_REV and self.odue and not self.col.decks.isDyn(self.did):
             runHook("odueInvalid")
         assert self.due < 4294967296
-        self.col.db.execute(
+        self.col.db.defer(
             """update cards set
 mod=?, usn=?, type=?, queue=?, due=?, ivl=?, factor=?, reps=?,
 lapses=?, left=?, odue=?, odid=?, did=? where id = ?""",
@@ -188,6 +197,7 @@ lapses=?, left=?, odue=?, odid=?, did=? where id = ?""",
             self.odid,
             self.did,
             self.id)
+        self.col.sched._dropPrefetched([self.id])
         self.col.log(self)
 
     def q(self, reload=False, browser=False):
@@ -11,6 +11,7 @@ import stat
 import datetime
 import copy
 import traceback
+import functools
 
 from anki.lang import _, ngettext
 from anki.utils import ids2str, fieldChecksum, stripHTML, \
@@ -20,6 +21,10 @@ from anki.models import ModelManager
 from anki.media import MediaManager
 from anki.decks import DeckManager
 from anki.tags import TagManager
+from anki.fts import FullTextIndex
+from anki.notemedia import NoteMediaIndex
+from anki.notetags import NoteTagIndex
+from anki.revlogstats import RevlogStats
 from anki.consts import *
 from anki.errors import AnkiError
 from anki.sound import stripSounds
@@ -48,6 +53,24 @@ defaultConf = {
     'dayLearnFirst': False,
 }
 
+@functools.lru_cache(maxsize=1000)
+def clozeFormat(format, type, ord):
+    """The format of the template's side type ("q" or "a"), where the
+    cloze: modifiers refer to the cloze ord+1."""
+    if type == "q":
+        format = re.sub("{{(?!type:)(.*?)cloze:", r"{{\1cq-%d:" % (ord+1), format)
+        #Replace {{'foo'cloze: by {{'foo'cq-(ord+1), where 'foo' does not begins with "type:"
+        format = format.replace("<%cloze:", "<%%cq:%d:" % (
+            ord+1))
+        #Replace <%cloze: by <%%cq:(ord+1)
+    else:
+        format = re.sub("{{(.*?)cloze:", r"{{\1ca-%d:" % (ord+1), format)
+        #Replace {{'foo'cloze: by {{'foo'ca-(ord+1)
+        format = format.replace("<%cloze:", "<%%ca:%d:" % (
+            ord+1))
+        #Replace <%cloze: by <%%ca:(ord+1)
+    return format
+
 # this is initialized by storage.Collection
 class _Collection:
     """A collection is, basically, everything that composed an account in
@@ -108,6 +131,11 @@ class _Collection:
     undoName is the name of the action to undo. Used in the edit menu,
     and in tooltip stating that undo was done.
     """
+
+    # seconds a statement waits for another connection reading the
+    # collection, such as a backup, to release its lock
+    busyTimeout = 5
+
     def __init__(self, db, server=False, log=False):
         self._debugLog = log
         self.db = db
@@ -121,6 +149,12 @@ class _Collection:
         self.models = ModelManager(self)
         self.decks = DeckManager(self)
         self.tags = TagManager(self)
+        self.fts = FullTextIndex(self)
+        self.noteMedia = NoteMediaIndex(self)
+        self.noteTags = NoteTagIndex(self)
+        # the indexes kept up to date when notes change
+        self.noteIndexes = (self.fts, self.noteMedia, self.noteTags)
+        self.revlogStats = RevlogStats(self)
         self.load()
         if not self.crt:
             d = datetime.datetime.today()
@@ -201,6 +235,9 @@ conf, models, decks, dconf, tags from col""")
         self.models.load(models)
         self.decks.load(decks, dconf)
         self.tags.load(tags)
+        for index in self.noteIndexes:
+            index.load()
+        self.revlogStats.load()
 
     def setMod(self):
         """Mark DB modified.
@@ -217,6 +254,9 @@ is only necessary if you modify properties of this object or the conf dict."""
 crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
             self.crt, self.mod, self.scm, self.dty,
             self._usn, self.ls, json.dumps(self.conf))
+        for index in self.noteIndexes:
+            index.flush()
+        self.revlogStats.flush()
 
     def save(self, name=None, mod=None):
         "Flush, commit DB, and take out another write lock."
@@ -265,7 +305,7 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
         "Reconnect to DB (after changing threads, etc)."
         import anki.db
         if not self.db:
-            self.db = anki.db.DB(self.path)
+            self.db = anki.db.DB(self.path, timeout=self.busyTimeout)
             self.media.connect()
             self._openLog()
 
@@ -310,12 +350,14 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
         self.models.beforeUpload()
         self.tags.beforeUpload()
         self.decks.beforeUpload()
+        # other clients don't know about the indexes
+        for index in self.noteIndexes:
+            index.disable()
+        self.revlogStats.disable()
         self.modSchema(check=False)
         self.ls = self.scm
         # ensure db is compacted before upload
-        self.db.setAutocommit(True)
-        self.db.execute("vacuum")
-        self.db.execute("analyze")
+        self.db.optimize()
         self.close()
 
     # Object creation helpers
@@ -376,6 +418,71 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
             ncards += 1
         return ncards
 
+    def addNotes(self, notes):
+        """Add the notes to the collection, with their cards, in bulk. Return
+        a list containing, for each note, a pair (number of new cards,
+        error). The error is None if the note was added, otherwise a
+        message explaining why it was not, in which case the number of
+        cards is 0.
+
+        Contrary to addNote, the notes' ids, which may have been shared
+        by notes created before any of them was saved, are reallocated.
+        Tags are registered, and nextPos updated, once for the batch.
+
+        notes -- a list of new notes, not yet in the collection.
+        """
+        results = []
+        noteRows = []
+        cardRows = []
+        tags = set()
+        canonified = {}
+        nid = cid = maxID(self.db)
+        pos = self.nextID("pos", inc=False)
+        now = intTime()
+        usn = self.usn()
+        dids = {}
+        for note in notes:
+            if note.scm != self.scm:
+                results.append((0, _("The note type was modified.")))
+                continue
+            model = note.model()
+            cms = self.findTemplates(note)
+            if not cms:
+                results.append((0, _("The note would have no cards.")))
+                continue
+            note.id = nid
+            nid += 1
+            note.mod = now
+            note.usn = usn
+            key = tuple(note.tags)
+            if key not in canonified:
+                canonified[key] = self.tags.canonify(note.tags)
+            tags.update(canonified[key])
+            noteRows.append((
+                note.id, note.guid, note.mid, now, usn,
+                self.tags.join(canonified[key]), note.joinedFields(),
+                stripHTMLMedia(note.fields[self.models.sortIdx(model)]),
+                fieldChecksum(note.fields[0]), note.flags, note.data))
+            for template in cms:
+                dkey = (model['id'], template['did'])
+                if dkey not in dids:
+                    dids[dkey] = self._didForTemplate(model, template)
+                did = dids[dkey]
+                cardRows.append((cid, note.id, did, template['ord'], now, usn,
+                                 self._dueForDid(did, pos)))
+                cid += 1
+            pos += 1
+            results.append((len(cms), None))
+        self.db.executemany("""
+insert into notes values (?,?,?,?,?,?,?,?,?,?,?)""", noteRows)
+        self.db.executemany("""
+insert into cards values (?,?,?,?,?,?,0,0,?,0,0,0,0,0,0,0,0,"")""", cardRows)
+        self.conf['nextPos'] = pos
+        self.tags.register(tags)
+        for index in self.noteIndexes:
+            index.update([row[0] for row in noteRows])
+        return results
+
     def remNotes(self, ids):
         """Removes all cards associated to the notes whose id is in ids"""
         self.remCards(self.db.list("select id from cards where nid in "+
@@ -391,6 +498,8 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
         runHook("remNotes", self, ids)
         self._logRem(ids, REM_NOTE)
         self.db.execute("delete from notes where id in %s" % strids)
+        for index in self.noteIndexes:
+            index.remove(ids)
 
     # Card creation
     ##########################################################################
@@ -526,22 +635,27 @@ insert into cards values (?,?,?,?,?,?,0,0,?,0,0,0,0,0,0,0,0,"")""",
         card = anki.cards.Card(self)
         card.nid = note.id
         card.ord = template['ord']
+        card.did = self._didForTemplate(note.model(), template)
+        card.due = self._dueForDid(card.did, due)
+        if flush:
+            card.flush()
+        return card
+
+    def _didForTemplate(self, model, template):
+        """The deck id of new cards of this template: the template's deck
+        override if valid, otherwise the model's deck. The default deck
+        if this deck does not exist or is filtered."""
         # Use template did (deck override) if valid, otherwise model did
         if template['did'] and str(template['did']) in self.decks.decks:
-            card.did = template['did']
+            did = template['did']
         else:
-            card.did = note.model()['did']
+            did = model['did']
         # if invalid did, use default instead
-        deck = self.decks.get(card.did)
+        deck = self.decks.get(did)
         if deck['dyn']:
             # must not be a filtered deck
-            card.did = 1
-        else:
-            card.did = deck['id']
-        card.due = self._dueForDid(card.did, due)
-        if flush:
-            card.flush()
-        return card
+            return 1
+        return deck['id']
 
     def _dueForDid(self, did, due):
         """The due date of a card. Itself if not random mode. A random number
@@ -630,6 +744,8 @@ where c.nid = n.id and c.id in %s group by nid""" % ids2str(cids)):
                       nid))
         # apply, relying on calling code to bump usn+mod
         self.db.executemany("update notes set sfld=?, csum=? where id=?", r)
+        for index in self.noteIndexes:
+            index.update(nids)
 
     # Q/A generation
     ##########################################################################
@@ -698,18 +814,8 @@ where c.nid = n.id and c.id in %s group by nid""" % ids2str(cids)):
         qfmt = qfmt or template['qfmt']
         afmt = afmt or template['afmt']
         for (type, format) in (("q", qfmt), ("a", afmt)):
-            if type == "q":
-                format = re.sub("{{(?!type:)(.*?)cloze:", r"{{\1cq-%d:" % (ord+1), format)
-                #Replace {{'foo'cloze: by {{'foo'cq-(ord+1), where 'foo' does not begins with "type:"
-                format = format.replace("<%cloze:", "<%%cq:%d:" % (
-                    ord+1))
-                #Replace <%cloze: by <%%cq:(ord+1)
-            else:
-                format = re.sub("{{(.*?)cloze:", r"{{\1ca-%d:" % (ord+1), format)
-                #Replace {{'foo'cloze: by {{'foo'ca-(ord+1)
-                format = format.replace("<%cloze:", "<%%ca:%d:" % (
-                    ord+1))
-                #Replace <%cloze: by <%%ca:(ord+1)
+            format = clozeFormat(format, type, ord)
+            if type == "a":
                 fields['FrontSide'] = stripSounds(d['q'])
                 #d['q'] is defined during loop's first iteration
             fields = runFilter("mungeFields", fields, model, data, self) # TODO check
@@ -849,6 +955,7 @@ where c.nid == f.id
         type = ("new", "lrn", "rev")[n]
         self.sched._updateStats(c, type, -1)
         self.sched.reps -= 1
+        self.sched._dropPrefetched()
         return c.id
 
     def _markOp(self, name):
@@ -982,11 +1089,16 @@ select id from cards where odid > 0 and did in %s""" % ids2str(dids))
                          "Fixed %d cards with invalid properties.", cnt) % cnt)
             self.db.execute("update cards set odid=0, odue=0 where id in "+
                 ids2str(ids))
+        # the indexes may have missed changes of the notes
+        for index in self.noteIndexes:
+            index.check(force=True)
         # tags
         self.tags.registerNotes()
         # field cache
         for m in self.models.all():
             self.updateFieldCache(self.models.nids(m))
+        # the revlog aggregates are computed again when next needed
+        self.revlogStats.disable()
         # new cards can't have a due position > 32 bits
         self.db.execute("""
 update cards set due = 1000000, mod = ?, usn = ? where due > 1000000
@@ -1012,8 +1124,8 @@ and type = 0""", intTime(), self.usn())
         curs.execute("update revlog set ivl=round(ivl),lastIvl=round(lastIvl) where ivl!=round(ivl) or lastIvl!=round(lastIvl)")
         if curs.rowcount:
             problems.append("Fixed %d review history entries with v2 scheduler bug." % curs.rowcount)
-        # and finally, optimize
-        self.optimize()
+        # and finally, rebuild the database
+        self.vacuum()
         newSize = os.stat(self.path)[stat.ST_SIZE]
         txt = _("Database rebuilt and optimized.")
         ok = not problems
@@ -1025,11 +1137,26 @@ and type = 0""", intTime(), self.usn())
         return ("\n".join(problems), ok)
 
     def optimize(self):
-        self.db.setAutocommit(True)
-        self.db.execute("vacuum")
-        self.db.execute("analyze")
-        self.db.setAutocommit(False)
+        """Release the free pages of the database, and analyze the tables
+        which changed a lot. The first time, the database is rebuilt in the
+        incremental auto vacuum mode instead."""
+        self.db.optimize()
+        self.lock()
+
+    def vacuum(self):
+        "Rebuild the database, and analyze all its tables."
+        self.db.vacuum()
+        self.lock()
+
+    def vacuumSlice(self, budget=0.05):
+        """Release free pages of the database for up to budget seconds, if
+        it has no unsaved changes. Whether free pages remain."""
+        if self.db.mod:
+            return True
+        more = self.db.incrementalVacuum(budget)
+        self.db.commit()
         self.lock()
+        return more
 
     # Logging
     ##########################################################################
@@ -50,6 +50,8 @@ STARTING_FACTOR = 2500
 SCHEMA_VERSION = 11
 SYNC_ZIP_SIZE = int(2.5*1024*1024)
 SYNC_ZIP_COUNT = 25
+# number of media zips downloaded at the same time
+SYNC_ZIP_PARALLEL = 4
 SYNC_BASE = "https://sync%s.ankiweb.net/"
 SYNC_VER = 9
 
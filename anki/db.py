@@ -3,19 +3,52 @@
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
 import os
+import re
 import time
+import random
+import itertools
+from urllib.request import pathname2url
 
 from sqlite3 import dbapi2 as sqlite, Cursor
 
 DBError = sqlite.Error
 
+# statements setting mod
+_writeRe = re.compile(r"\s*(insert|update|delete)", re.I)
+
 class DB:
-    def __init__(self, path, timeout=0):
-        self._db = sqlite.connect(path, timeout=timeout)
+
+    """
+    deferLimit -- number of statements passed to defer() kept in memory
+    before they are executed. 0 to execute them at once.
+    profiler -- the Profiler recording the statements executed, or None.
+    _deferred -- dictionnary associating to the sql of the deferred
+    statements the list of their arguments, in the order they were
+    deferred.
+    """
+
+    deferLimit = 0
+    profiler = None
+
+    def __init__(self, path, timeout=0, readOnly=False):
+        """Open the database at path.
+
+        readOnly -- open it read-only, on a connection which may be used by
+        any thread."""
+        if readOnly:
+            self._db = sqlite.connect(
+                "file:%s?mode=ro" % pathname2url(os.path.abspath(path)),
+                timeout=timeout, uri=True, check_same_thread=False)
+        else:
+            self._db = sqlite.connect(path, timeout=timeout)
         self._db.text_factory = self._textFactory
         self._path = path
         self.echo = os.environ.get("DBECHO")
         self.mod = False
+        self._deferred = {}
+        self._deferredCount = 0
+        if os.environ.get("DBPROFILE"):
+            self.startProfiling()
 
     def execute(self, sql, *a, **ka):
         """The result of execute on the database with sql query and either ka if it exists, or a. 
@@ -23,23 +56,18 @@ class DB:
         If insert, update or delete, mod is set to True
         If self.echo, prints the execution time
         """
-        s = sql.strip().lower()
+        self.flushDeferred()
         # mark modified?
-        for stmt in "insert", "update", "delete":
-            if s.startswith(stmt):
-                self.mod = True
-        t = time.time()
-        if ka:
-            # execute("...where id = :id", id=5)
-            res = self._db.execute(sql, ka)
-        else:
-            # execute("...where id = ?", 5)
-            res = self._db.execute(sql, a)
-        if self.echo:
-            #print a, ka
-            print(sql, "%0.3fms" % ((time.time() - t)*1000))
-            if self.echo == "2":
-                print(a, ka)
+        if _writeRe.match(sql):
+            self.mod = True
+        # either execute("...where id = :id", id=5) or
+        # execute("...where id = ?", 5)
+        args = ka or a
+        if not self.echo and self.profiler is None:
+            return self._db.execute(sql, args)
+        t = time.perf_counter()
+        res = self._db.execute(sql, args)
+        self._log(sql, args, time.perf_counter() - t, res.rowcount)
         return res
 
     def executemany(self, sql, l):
@@ -48,62 +76,262 @@ class DB:
         Mod is set to True
         If self.echo, prints the execution time
         """
+        self.flushDeferred()
         self.mod = True
-        t = time.time()
-        self._db.executemany(sql, l)
-        if self.echo:
-            print(sql, "%0.3fms" % ((time.time() - t)*1000))
-            if self.echo == "2":
-                print(l)
+        if not self.echo and self.profiler is None:
+            self._db.executemany(sql, l)
+            return
+        # the first arguments, kept by the profiler instead of l, which
+        # may be long
+        l = iter(l)
+        first = next(l, None)
+        if first is not None:
+            l = itertools.chain((first,), l)
+        if self.echo == "2":
+            l = list(l)
+        t = time.perf_counter()
+        res = self._db.executemany(sql, l)
+        self._log(sql, l, time.perf_counter() - t, res.rowcount,
+                  first=() if first is None else first)
 
     def commit(self):
         """Commit database.
          If self.echo, prints the execution time."""
-        t = time.time()
+        self.flushDeferred()
+        t = time.perf_counter()
         self._db.commit()
-        if self.echo:
-            print("commit %0.3fms" % ((time.time() - t)*1000))
+        self._log("commit", (), time.perf_counter() - t, 0)
 
     def executescript(self, sql):
         """executescript with sql on the database.
          If self.echo, prints sql
         set mod to True."""
+        self.flushDeferred()
         self.mod = True
-        if self.echo:
-            print(sql)
+        t = time.perf_counter()
         self._db.executescript(sql)
+        self._log(sql, (), time.perf_counter() - t, 0)
 
     def rollback(self):
-        """rollback on the db"""
+        """rollback on the db, forgetting the deferred statements"""
+        self._deferred = {}
+        self._deferredCount = 0
         self._db.rollback()
 
+    # Deferred statements
+    ##########################################################################
+
+    # Statements modifying the database which are executed often, such as
+    # the updates of the cards answered, can be deferred. They are then
+    # kept in memory, and executed together, statements with the same sql
+    # being executed by a single executemany(), before any other access
+    # to the database, e.g. a query, a commit, or closing the database.
+    # The queries thus see their effects, and they are in the transaction
+    # they were deferred in.
+
+    def defer(self, sql, *a):
+        """Execute sql with arguments a, either now if deferLimit is 0, or
+        later, with the other deferred statements. mod is set to True.
+
+        The deferred statements must not depend on the effects of each
+        other, as they may be reordered, except those with the same sql,
+        which are executed in order."""
+        if not self.deferLimit:
+            self.execute(sql, *a)
+            return
+        self.mod = True
+        self._deferred.setdefault(sql, []).append(a)
+        self._deferredCount += 1
+        if self._deferredCount >= self.deferLimit:
+            self.flushDeferred()
+
+    def flushDeferred(self):
+        "Execute the deferred statements."
+        if not self._deferred:
+            return
+        deferred = self._deferred
+        self._deferred = {}
+        self._deferredCount = 0
+        for sql, l in deferred.items():
+            self.executemany(sql, l)
+
     def scalar(self, *a, **kw):
         """The first value of the first tuple of the result, if it exists. None otherwise."""
         res = self.execute(*a, **kw).fetchone()
+        if self.profiler is not None:
+            self.profiler.fetched(a[0], 1 if res else 0)
         if res:
             return res[0]
         return None
 
     def all(self, *a, **kw):
         """The list of rows of the answer."""
-        return self.execute(*a, **kw).fetchall()
+        c = self.execute(*a, **kw)
+        if self.profiler is None:
+            return c.fetchall()
+        t = time.perf_counter()
+        res = c.fetchall()
+        self.profiler.fetched(a[0], len(res), time.perf_counter() - t)
+        return res
 
     def first(self, *a, **kw):
         """The first row of the answer."""
         c = self.execute(*a, **kw)
         res = c.fetchone()
         c.close()
+        if self.profiler is not None:
+            self.profiler.fetched(a[0], 1 if res else 0)
         return res
 
     def list(self, *a, **kw):
         """The list of first elements of tuples of the answer."""
-        return [x[0] for x in self.execute(*a, **kw)]
+        c = self.execute(*a, **kw)
+        if self.profiler is None:
+            return [x[0] for x in c]
+        t = time.perf_counter()
+        res = [x[0] for x in c]
+        self.profiler.fetched(a[0], len(res), time.perf_counter() - t)
+        return res
+
+    # Profiling
+    ##########################################################################
+
+    def startProfiling(self):
+        """Record the statements executed from now on, and return the
+        Profiler recording them. Also done when the environment variable
+        DBPROFILE is set, the slowest statements being then printed when
+        the database is closed."""
+        self.profiler = Profiler()
+        return self.profiler
+
+    def stopProfiling(self):
+        "Stop recording the statements, and return the Profiler."
+        profiler = self.profiler
+        self.profiler = None
+        return profiler
+
+    def _log(self, sql, args, elapsed, rows, first=None):
+        """Record that sql, executed with args, took elapsed seconds and
+        modified or returned rows rows, and print it if echo is set.
+
+        first -- for executemany(), whose args are a list of arguments,
+        the first of them, recorded instead of the list."""
+        if self.profiler is not None:
+            self.profiler.record(sql, args if first is None else first,
+                                 elapsed, max(rows, 0))
+        if self.echo:
+            print(sql, "%0.3fms" % (elapsed*1000))
+            if self.echo == "2":
+                print(args)
+
+    def readOnly(self):
+        """A new read-only connection to the same database. In WAL mode, it
+        can read while this connection writes, and sees what was last
+        committed."""
+        return DB(self._path, readOnly=True)
 
     def close(self):
-        """Close the underlying database."""
+        """Close the underlying database, after executing the deferred
+        statements."""
+        self.flushDeferred()
+        if self.profiler is not None and os.environ.get("DBPROFILE"):
+            print(self.profiler.dump(self))
         self._db.text_factory = None
         self._db.close()
 
+    def backup(self, path, pages=-1, sleep=0, progress=None):
+        """Copy the database to the file path with sqlite's online backup
+        API, pages pages at a time, or all at once if pages is -1, sleeping
+        sleep seconds between steps. The copy is restarted when another
+        connection commits changes meanwhile, and is in the rollback
+        journal mode. The deferred statements are executed first.
+
+        progress -- if not None, called after each step with the status,
+        the number of pages remaining and the total number of pages."""
+        self.flushDeferred()
+        dst = sqlite.connect(path)
+        try:
+            self._db.backup(dst, pages=pages, sleep=sleep, progress=progress)
+            dst.execute("pragma journal_mode = delete")
+        finally:
+            dst.close()
+
+    # Maintenance
+    ##########################################################################
+
+    # number of rows of each index read by analyze()
+    analysisLimit = 1000
+    # relative change of the number of rows of a table after which
+    # analyze() analyzes it again
+    analyzeChange = 0.5
+    # number of free pages released at a time by incrementalVacuum(),
+    # about 10ms of work
+    vacuumPages = 1024
+
+    def vacuum(self):
+        """Rebuild the database in the incremental auto vacuum mode, and
+        analyze all its tables. The current transaction is committed."""
+        self.setAutocommit(True)
+        self.execute("pragma auto_vacuum = incremental")
+        self.execute("vacuum")
+        self.analyze(full=True)
+        self.setAutocommit(False)
+
+    def optimize(self):
+        """Release the free pages of the database, analyze the tables whose
+        number of rows changed a lot, and commit. If the database is not in
+        the incremental auto vacuum mode, vacuum() it instead."""
+        if self.scalar("pragma auto_vacuum") != 2:
+            self.vacuum()
+            return
+        self.incrementalVacuum()
+        self.analyze()
+        self.commit()
+
+    def incrementalVacuum(self, budget=None):
+        """Release the free pages of the database for up to budget seconds,
+        or all of them if budget is None, and return whether free pages
+        remain. The current transaction is committed first, and the pages
+        are released vacuumPages at a time, each in a transaction of its
+        own. Nothing is released unless the database is in the incremental
+        auto vacuum mode."""
+        if self.scalar("pragma auto_vacuum") != 2:
+            return False
+        if budget is not None:
+            end = time.perf_counter() + budget
+        self.flushDeferred()
+        sql = "pragma incremental_vacuum(%d)" % self.vacuumPages
+        while self.scalar("pragma freelist_count"):
+            if budget is not None and time.perf_counter() > end:
+                return True
+            # execute() would only step the pragma once, releasing a single
+            # page; executescript() runs it to completion
+            t = time.perf_counter()
+            self._db.executescript(sql)
+            self._log(sql, (), time.perf_counter() - t, 0)
+        return False
+
+    def analyze(self, full=False):
+        """Analyze the tables whose number of rows changed by more than
+        analyzeChange since they were last analyzed, or all tables if full,
+        reading about analysisLimit rows of each index."""
+        self.execute("pragma analysis_limit = %d" % self.analysisLimit)
+        if full or not self.scalar(
+                "select 1 from sqlite_master where name = 'sqlite_stat1'"):
+            self.execute("analyze")
+            return
+        # the first number of a stat is the number of rows of the index
+        counts = {}
+        for tbl, stat in self.execute("select tbl, stat from sqlite_stat1"):
+            counts[tbl] = max(counts.get(tbl, 0), int(stat.split()[0]))
+        for name in self.list("""
+select name from sqlite_master where type = 'table'
+and name not like 'sqlite_%' and sql not like 'create virtual%'"""):
+            old = counts.get(name, 0)
+            new = self.scalar('select count() from "%s"' % name)
+            if abs(new - old) > old * self.analyzeChange:
+                self.execute('analyze "%s"' % name)
+
     def set_progress_handler(self, *args):
         self._db.set_progress_handler(*args)
 
@@ -115,12 +343,14 @@ class DB:
         self._db.close()
 
     def totalChanges(self):
+        self.flushDeferred()
         return self._db.total_changes
 
     def interrupt(self):
         self._db.interrupt()
 
     def setAutocommit(self, autocommit):
+        self.flushDeferred()
         if autocommit:
             self._db.isolation_level = None
         else:
@@ -131,4 +361,126 @@ class DB:
         return str(data, errors="ignore")
 
     def cursor(self, factory=Cursor):
+        self.flushDeferred()
         return self._db.cursor(factory)
+
+class Profiler:
+
+    """The number of calls, time taken and rows modified or returned by
+    the statements executed on a DB, grouped by shape: the sql, whose
+    literals are replaced by ?, lists of ? by "?, ...", and
+    whitespace by a single space, or removed around parentheses.
+
+    entries -- dictionnary associating to each shape a dictionnary with
+    keys calls, time, rows, samples (the time taken by some of the
+    calls), last (the index in samples of the last call, if kept), sql
+    and args (the last statement of this shape and its arguments, or the
+    first arguments of an executemany()).
+    _shapes -- dictionnary associating to sql strings their shape.
+    """
+
+    # number of times kept per shape to compute the percentiles
+    maxSamples = 1000
+
+    _stringRe = re.compile(r"'(?:[^']|'')*'")
+    _numberRe = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+    _listRe = re.compile(r"\?(?:\s*,\s*\?)+")
+    _spaceRe = re.compile(r"\s+")
+    _parenRe = re.compile(r"\(\s+|\s+\)")
+
+    def __init__(self):
+        self.entries = {}
+        self._shapes = {}
+        self._random = random.Random(0)
+
+    def shape(self, sql):
+        "The shape of sql."
+        shape = self._shapes.get(sql)
+        if shape is None:
+            shape = self._stringRe.sub("?", sql)
+            shape = self._numberRe.sub("?", shape)
+            shape = self._listRe.sub("?, ...", shape)
+            shape = self._spaceRe.sub(" ", shape).strip()
+            shape = self._parenRe.sub(lambda m: m.group().strip(), shape)
+            if len(self._shapes) > 10000:
+                # sql built with ever changing literals
+                self._shapes.clear()
+            self._shapes[sql] = shape
+        return shape
+
+    def record(self, sql, args, elapsed, rows):
+        """Record that sql, executed with args, took elapsed seconds and
+        modified or returned rows rows."""
+        shape = self.shape(sql)
+        entry = self.entries.get(shape)
+        if entry is None:
+            entry = self.entries[shape] = dict(
+                calls=0, time=0, rows=0, samples=[])
+        entry['calls'] += 1
+        entry['time'] += elapsed
+        entry['rows'] += rows
+        entry['sql'] = sql
+        entry['args'] = args
+        samples = entry['samples']
+        if len(samples) < self.maxSamples:
+            i = len(samples)
+            samples.append(elapsed)
+        else:
+            # keep each call's time with the same probability
+            i = self._random.randrange(entry['calls'])
+            if i < self.maxSamples:
+                samples[i] = elapsed
+        # where the time of this call is, to add its fetching time
+        entry['last'] = i
+
+    def fetched(self, sql, rows, elapsed=0):
+        """Record that the last execution of sql returned rows rows, whose
+        fetching took elapsed seconds."""
+        entry = self.entries.get(self.shape(sql))
+        if entry is None:
+            return
+        entry['rows'] += rows
+        entry['time'] += elapsed
+        last = entry['last']
+        if last < len(entry['samples']):
+            entry['samples'][last] += elapsed
+
+    def report(self, key="time", limit=None):
+        """The list of the statistics of each shape, sorted by decreasing
+        key, which is either calls, time, rows, p50 or p99. Each is a
+        dictionnary with keys sql (the shape), calls, time, rows, and p50
+        and p99, the median and 99th percentile of the time taken by a
+        call, in seconds.
+
+        limit -- the number of shapes returned, all if None."""
+        stats = []
+        for shape, entry in self.entries.items():
+            samples = sorted(entry['samples'])
+            def percentile(q):
+                return samples[min(len(samples) - 1, int(q * len(samples)))]
+            stats.append(dict(sql=shape, calls=entry['calls'],
+                              time=entry['time'], rows=entry['rows'],
+                              p50=percentile(0.5), p99=percentile(0.99)))
+        stats.sort(key=lambda s: s[key], reverse=True)
+        return stats[:limit]
+
+    def dump(self, db, limit=10):
+        """A text describing the limit statements which took the most time,
+        with the query plan of their last execution on db."""
+        lines = ["%8s %10s %9s %9s %8s" % (
+            "calls", "total ms", "p50 ms", "p99 ms", "rows")]
+        for stat in self.report(limit=limit):
+            entry = self.entries[stat['sql']]
+            lines.append("%8d %10.1f %9.3f %9.3f %8d  %s" % (
+                stat['calls'], stat['time']*1000, stat['p50']*1000,
+                stat['p99']*1000, stat['rows'], stat['sql']))
+            try:
+                # not recorded, as it doesn't use db.execute()
+                plan = db._db.execute("explain query plan " + entry['sql'],
+                                      entry['args']).fetchall()
+            except (DBError, ValueError):
+                # several statements, or not a query
+                continue
+            for row in plan:
+                lines.append(" " * 10 + str(row[-1]))
+        return "\n".join(lines)
@@ -72,10 +72,10 @@ ivlFct -- multiplication factor applied to the intervals Anki generates
 maxIvl -- the maximal interval for review
 bury -- If True, when a review card is answered, the related cards of its notes are buried
 """
-import copy, operator
+import bisect, copy, operator
 import unicodedata
 
-from anki.utils import intTime, ids2str, json
+from anki.utils import intTime, ids2str, json, JsonCache
 from anki.hooks import runHook
 from anki.consts import *
 from anki.lang import _
@@ -163,6 +163,18 @@ class DeckManager:
     col -- the collection associated to this Deck manager
     decks -- associating to each id (as string) its deck
     dconf -- associating to each id (as string) its configuration(option)
+    _decksJson, _dconfJson -- the JsonCache of decks and dconf; only
+    the objects given to save() are serialized again on flush.
+    _flushed -- the pair of JSON strings of decks and dconf as they are
+    in the database.
+    _ids -- dictionnary associating to each normalised deck name the id
+    of a deck having this name, or None if the index of the names is not
+    yet built.
+    _norms -- dictionnary associating to each deck id the normalised
+    name under which the deck is indexed.
+    _sorted -- the sorted list of pairs (normalised name, id) of the
+    decks, in which the descendants of a deck are a range.
+    _nextId -- the smallest id a new deck may have.
     """
     # Registry save/load
     #############################################################
@@ -174,37 +186,89 @@ class DeckManager:
     def load(self, decks, dconf):
         """Assign decks and dconf of this object using the two parameters.
 
-        It also ensures that the number of cards per day is at most
-        999999 or correct this error.
+        The JSON is only decoded when decks or dconf are first accessed,
+        so that opening the collection for an operation which doesn't
+        need them is fast.
 
         Keyword arguments:
         decks -- json dic associating to each id (as string) its deck
         dconf -- json dic associating to each id (as string) its configuration(option)
         """
-        self.decks = json.loads(decks)
-        self.dconf = json.loads(dconf)
-        # set limits to within bounds
-        found = False
-        for c in list(self.dconf.values()):
-            for t in ('rev', 'new'):
-                pd = 'perDay'
-                if c[t][pd] > 999999:
-                    c[t][pd] = 999999
-                    self.save(c)
-                    found = True
-        if not found:
-            self.changed = False
+        self._decks = None
+        self._dconf = None
+        self._decksJson = JsonCache()
+        self._dconfJson = JsonCache()
+        self._flushed = (decks, dconf)
+        self._onLoad = []
+        self._ids = None
+        self._nextId = 0
+        self.changed = False
+
+    @property
+    def decks(self):
+        if self._decks is None:
+            self._decks = json.loads(self._flushed[0])
+            for fn in self._onLoad:
+                for deck in self._decks.values():
+                    fn(deck)
+            self._onLoad = []
+        return self._decks
+
+    @decks.setter
+    def decks(self, decks):
+        self._decks = decks
+        self._ids = None
+
+    @property
+    def dconf(self):
+        """Decoded on first access. It also ensures that the number of
+        cards per day is at most 999999 or correct this error."""
+        if self._dconf is None:
+            self._dconf = json.loads(self._flushed[1])
+            # set limits to within bounds
+            for c in list(self._dconf.values()):
+                for t in ('rev', 'new'):
+                    pd = 'perDay'
+                    if c[t][pd] > 999999:
+                        c[t][pd] = 999999
+                        self.save(c)
+        return self._dconf
+
+    @dconf.setter
+    def dconf(self, dconf):
+        self._dconf = dconf
+
+    def updateAll(self, fn):
+        """Call fn on each deck, now if the decks are already decoded,
+        otherwise once they are. The decks are not marked as modified."""
+        if self._decks is None:
+            self._onLoad.append(fn)
+        else:
+            for deck in self._decks.values():
+                fn(deck)
 
     def save(self, g=None):
         """State that the DeckManager has been changed. Changes the
         mod and usn of the potential argument.
 
         The potential argument can be either a deck or a deck
-        configuration.
+        configuration. Without argument, any deck or configuration may
+        have been changed.
         """
         if g:
             g['mod'] = intTime()
             g['usn'] = self.col.usn()
+            id = str(g['id'])
+            # a deck and a configuration may have the same id
+            if self._decks is not None and self._decks.get(id) is g:
+                self._decksJson.mark(id)
+                # its name may have changed
+                self._reindex(g)
+            else:
+                self._dconfJson.mark(id)
+        else:
+            self._decksJson.mark()
+            self._dconfJson.mark()
         self.changed = True
 
     def flush(self):
@@ -212,9 +276,15 @@ class DeckManager:
         changes happenned.
         """
         if self.changed:
-            self.col.db.execute("update col set decks=?, dconf=?",
-                                 json.dumps(self.decks),
-                                 json.dumps(self.dconf))
+            decks, dconf = self._flushed
+            if self._decks is not None:
+                decks = self._decksJson.dumps(self._decks)
+            if self._dconf is not None:
+                dconf = self._dconfJson.dumps(self._dconf)
+            if (decks, dconf) != self._flushed:
+                self.col.db.execute("update col set decks=?, dconf=?",
+                                    decks, dconf)
+                self._flushed = (decks, dconf)
             self.changed = False
 
     # Deck save/load
@@ -231,9 +301,10 @@ class DeckManager:
         """
         name = name.replace('"', '')
         name = unicodedata.normalize("NFC", name)
-        for id, g in list(self.decks.items()):
-            if unicodedata.normalize("NFC", g['name'].lower()) == name.lower():
-                return int(id)
+        self._index()
+        did = self._ids.get(self._normName(name))
+        if did is not None:
+            return did
         if not create:
             return None
         g = copy.deepcopy(type)
@@ -241,10 +312,12 @@ class DeckManager:
             # not top level; ensure all parents exist
             name = self._ensureParents(name)
         g['name'] = name
-        while 1:
-            id = intTime(1000)
-            if str(id) not in self.decks:
-                break
+        # rather than waiting for the next millisecond when creating many
+        # decks, use the following ids
+        id = max(intTime(1000), self._nextId)
+        while str(id) in self.decks:
+            id += 1
+        self._nextId = id + 1
         g['id'] = id
         self.decks[str(id)] = g
         self.save(g)
@@ -307,6 +380,7 @@ class DeckManager:
                 self.col.remCards(cids)
         # delete the deck and add a grave (it seems no grave is added)
         del self.decks[str(did)]
+        self._unindex(did)
         # ensure we have an active deck.
         if did in self.active():
             self.select(int(list(self.decks.keys())[0]))
@@ -364,13 +438,16 @@ class DeckManager:
 
     def byName(self, name):
         "Get deck object with NAME."
-        for m in list(self.decks.values()):
+        self._index()
+        for did in self._same(self._normName(name)):
+            m = self.decks[str(did)]
             if m['name'] == name:
                 return m
 
     def update(self, g):
         "Add or update an existing deck. Used for syncing and merging."
         self.decks[str(g['id'])] = g
+        self._reindex(g)
         self.maybeAddToActive()
         # mark registry changed, but don't bump mod time
         self.save()
@@ -393,7 +470,8 @@ class DeckManager:
         # ensure we have parents
         newName = self._ensureParents(newName)
         # rename children
-        for grp in self.all():
+        for name, did in self.children(g['id']):
+            grp = self.get(did)
             if grp['name'].startswith(g['name'] + "::"):
                 grp['name'] = grp['name'].replace(g['name']+ "::",
                                                   newName + "::", 1)
@@ -696,7 +774,8 @@ same id."""
         """Change activeDecks to the list containing did and the did
         of its children.
 
-        Also mark the manager as changed."""
+        Also mark the collection as modified, so that its conf is
+        saved."""
         # make sure arg is an int
         did = int(did)
         # current deck
@@ -705,15 +784,18 @@ same id."""
         actv = self.children(did)
         actv.sort()
         self.col.conf['activeDecks'] = [did] + [a[1] for a in actv]
-        self.changed = True
+        self.col.setMod()
 
     def children(self, did):
-        "All descendant of did, as (name, id)."
-        name = self.get(did)['name']
+        "All descendant of did, as (name, id), sorted by name."
+        self._index()
+        prefix = self._normName(self.get(did)['name']) + "::"
         actv = []
-        for g in self.all():
-            if g['name'].startswith(name + "::"):
-                actv.append((g['name'], g['id']))
+        i = bisect.bisect_left(self._sorted, (prefix,))
+        while i < len(self._sorted) and self._sorted[i][0].startswith(prefix):
+            id = self._sorted[i][1]
+            actv.append((self.decks[str(id)]['name'], id))
+            i += 1
         return actv
 
     def childDids(self, did, childMap):
@@ -797,6 +879,65 @@ same id."""
     def nameMap(self):
         return dict((d['name'], d) for d in self.decks.values())
 
+    # Index of the names
+    #############################################################
+
+    def _normName(self, name):
+        """The name under which a deck named name is indexed: in NFC and
+        lower case, as decks' names are unique regardless of the case."""
+        return unicodedata.normalize("NFC", name).lower()
+
+    def _index(self):
+        "Build the index of the names from the decks, if not yet done."
+        if self._ids is not None:
+            return
+        self._ids = {}
+        self._norms = {}
+        self._sorted = []
+        for g in self.decks.values():
+            did = int(g['id'])
+            norm = self._normName(g['name'])
+            self._ids.setdefault(norm, did)
+            self._norms[did] = norm
+            self._sorted.append((norm, did))
+        self._sorted.sort()
+
+    def _reindex(self, g):
+        "Update the index, as the deck g may be new or renamed."
+        if self._ids is None:
+            return
+        did = int(g['id'])
+        norm = self._normName(g['name'])
+        if self._norms.get(did) == norm:
+            return
+        self._unindex(did)
+        self._ids.setdefault(norm, did)
+        self._norms[did] = norm
+        bisect.insort(self._sorted, (norm, did))
+
+    def _unindex(self, did):
+        "Update the index, as the deck whose id is did was removed."
+        if self._ids is None:
+            return
+        did = int(did)
+        norm = self._norms.pop(did, None)
+        if norm is None:
+            return
+        del self._sorted[bisect.bisect_left(self._sorted, (norm, did))]
+        if self._ids[norm] == did:
+            del self._ids[norm]
+            # other decks may have the same name, up to the case
+            for other in self._same(norm):
+                self._ids[norm] = other
+                break
+
+    def _same(self, norm):
+        "The ids of the decks whose normalised name is norm."
+        i = bisect.bisect_left(self._sorted, (norm,))
+        while i < len(self._sorted) and self._sorted[i][0] == norm:
+            yield self._sorted[i][1]
+            i += 1
+
     # Sync handling
     ##########################################################################
 
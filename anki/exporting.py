@@ -3,6 +3,8 @@
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
 import re, os, zipfile, shutil, unicodedata
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from anki.lang import _
 from anki.utils import ids2str, splitFields, json, namedtmp
@@ -132,58 +134,27 @@ class AnkiExporter(Exporter):
             pass
         self.dst = Collection(path)
         self.src = self.col
-        # find cards
-        cids = self.cardIds()
-        # copy cards, noting used nids
-        nids = {}
-        data = []
-        for row in self.src.db.execute(
-            "select * from cards where id in "+ids2str(cids)):
-            nids[row[1]] = True
-            data.append(row)
-            # clear flags
-            row = list(row)
-            row[-2] = 0
-        self.dst.db.executemany(
-            "insert into cards values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
-            data)
-        # notes
-        strnids = ids2str(list(nids.keys()))
-        notedata = []
-        for row in self.src.db.all(
-            "select * from notes where id in "+strnids):
-            # remove system tags if not exporting scheduling info
-            if not self.includeSched:
-                row = list(row)
-                row[5] = self.removeSystemTags(row[5])
-            notedata.append(row)
-        self.dst.db.executemany(
-            "insert into notes values (?,?,?,?,?,?,?,?,?,?,?)",
-            notedata)
-        # models used by the notes
-        mids = self.dst.db.list("select distinct mid from notes where id in "+
-                                strnids)
-        # card history and revlog
-        if self.includeSched:
-            data = self.src.db.all(
-                "select * from revlog where cid in "+ids2str(cids))
-            self.dst.db.executemany(
-                "insert into revlog values (?,?,?,?,?,?,?,?,?)",
-                data)
+        # decks exported, all if empty
+        if not self.did:
+            dids = []
         else:
+            dids = [self.did] + [
+                x[1] for x in self.src.decks.children(self.did)]
+        self._attach()
+        try:
+            self._copyRows(dids)
+        finally:
+            self._detach()
+        mids = self.dst.db.list("select distinct mid from notes")
+        if not self.includeSched:
             # need to reset card state
-            self.dst.sched.resetCards(cids)
+            self.dst.sched.resetCards(self.dst.db.list("select id from cards"))
         # models - start with zero
         self.dst.models.models = {}
         for m in self.src.models.all():
             if int(m['id']) in mids:
                 self.dst.models.update(m)
         # decks
-        if not self.did:
-            dids = []
-        else:
-            dids = [self.did] + [
-                x[1] for x in self.src.decks.children(self.did)]
         dconfs = {}
         for d in self.src.decks.all():
             if str(d['id']) == "1":
@@ -206,26 +177,28 @@ class AnkiExporter(Exporter):
         media = {}
         self.mediaDir = self.src.media.dir()
         if self.includeMedia:
-            for row in notedata:
-                flds = row[6]
-                mid = row[2]
-                for file in self.src.media.filesInStr(mid, flds):
-                    # skip files in subdirs
-                    if file != os.path.basename(file):
-                        continue
-                    media[file] = True
+            nids = None
+            if dids:
+                nids = self.dst.db.list("select id from notes")
+            for file in self.src.noteMedia.files(nids):
+                # skip files in subdirs
+                if file != os.path.basename(file):
+                    continue
+                media[file] = True
             if self.mediaDir:
-                for fname in os.listdir(self.mediaDir):
-                    path = os.path.join(self.mediaDir, fname)
-                    if os.path.isdir(path):
-                        continue
-                    if fname.startswith("_"):
-                        # Scan all models in mids for reference to fname
-                        for m in self.src.models.all():
-                            if int(m['id']) in mids:
-                                if self._modelHasMedia(m, fname):
-                                    media[fname] = True
-                                    break
+                # the LaTeX images not shown yet must be generated
+                self.src.media.buildLatex(
+                    media, set(self.dst.db.list("select id from notes")))
+                # files starting with _ referenced by the models in mids;
+                # as names contain no newline, searching the joined
+                # stylings and templates is searching each of them
+                text = "\n".join(self._modelTexts(
+                    m for m in self.src.models.all() if int(m['id']) in mids))
+                with os.scandir(self.mediaDir) as it:
+                    for entry in it:
+                        if (entry.name.startswith("_") and
+                                entry.name in text and entry.is_file()):
+                            media[entry.name] = True
         self.mediaFiles = list(media.keys())
         self.dst.crt = self.src.crt
         # todo: tags?
@@ -234,6 +207,50 @@ class AnkiExporter(Exporter):
         self.postExport()
         self.dst.close()
 
+    # Copying the rows
+    ######################################################################
+    # Cards, notes and revlog are copied by statements of the destination
+    # collection reading the collection attached as the database src,
+    # instead of going through python.
+
+    def _attach(self):
+        # the attached database only sees committed changes
+        self.src.save()
+        # attaching is not possible inside a transaction
+        self.dst.db.setAutocommit(True)
+        self.dst.db.execute("attach ? as src", self.src.path)
+        self.dst.db.setAutocommit(False)
+
+    def _detach(self):
+        self.dst.db.setAutocommit(True)
+        self.dst.db.execute("detach src")
+        self.dst.db.setAutocommit(False)
+
+    def _copyRows(self, dids):
+        """Copy the cards of the decks whose id is in dids, or all cards,
+        their notes and, if includeSched, their revlog."""
+        lim = ""
+        if dids:
+            lim = " where did in " + ids2str(dids)
+        self.dst.db.execute("insert into cards select * from src.cards" + lim)
+        self.dst.db.execute("""
+insert into notes select * from src.notes
+where id in (select nid from main.cards)""")
+        if self.includeSched:
+            self.dst.db.execute("""
+insert into revlog select * from src.revlog
+where cid in (select id from main.cards)""")
+        else:
+            # remove system tags if not exporting scheduling info
+            rows = []
+            for (id, tags) in self.dst.db.execute("""
+select id, tags from notes
+where ' ' || tags || ' ' like '% marked %'
+or ' ' || tags || ' ' like '% leech %'"""):
+                rows.append((self.removeSystemTags(tags), id))
+            self.dst.db.executemany(
+                "update notes set tags = ? where id = ?", rows)
+
     def postExport(self):
         # overwrite to apply customizations to the deck before it's closed,
         # such as update the deck description
@@ -242,15 +259,13 @@ class AnkiExporter(Exporter):
     def removeSystemTags(self, tags):
         return self.src.tags.remFromStr("marked leech", tags)
 
-    def _modelHasMedia(self, model, fname):
-        # First check the styling
-        if fname in model["css"]:
-            return True
-        # If no reference to fname then check the templates as well
-        for t in model["tmpls"]:
-            if fname in t["qfmt"] or fname in t["afmt"]:
-                return True
-        return False
+    def _modelTexts(self, models):
+        "The stylings and templates of models."
+        for model in models:
+            yield model["css"]
+            for t in model["tmpls"]:
+                yield t["qfmt"]
+                yield t["afmt"]
 
 # Packaged Anki decks
 ######################################################################
@@ -259,6 +274,10 @@ class AnkiPackageExporter(AnkiExporter):
 
     key = _("Anki Deck Package")
     ext = ".apkg"
+    # number of threads reading the media files
+    mediaThreads = min(8, os.cpu_count() or 1)
+    # media files larger than this are not kept in memory
+    mediaBlock = 1024*1024
 
     def __init__(self, col):
         AnkiExporter.__init__(self, col)
@@ -298,20 +317,53 @@ class AnkiPackageExporter(AnkiExporter):
         return media
 
     def _exportMedia(self, z, files, fdir):
+        """Write the files of the folder fdir into z, each named by its
+        index in files, and return the dictionnary associating these names
+        to the files. Folders and missing files are skipped.
+
+        The files are read by mediaThreads threads while this thread
+        writes them to the zip in order, so that at most 2*mediaThreads
+        files are kept in memory. Files larger than mediaBlock are not read
+        by the threads but copied into the zip by blocks."""
+        def read(c, file):
+            try:
+                zinfo = zipfile.ZipInfo.from_file(
+                    os.path.join(fdir, file), str(c))
+            except OSError:
+                return None, None
+            if zinfo.is_dir():
+                return None, None
+            if re.search(r'\.svg$', file, re.IGNORECASE):
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+            else:
+                zinfo.compress_type = zipfile.ZIP_STORED
+            if zinfo.file_size > self.mediaBlock:
+                return zinfo, None
+            try:
+                with open(os.path.join(fdir, file), "rb") as f:
+                    return zinfo, f.read()
+            except OSError:
+                return None, None
         media = {}
-        for c, file in enumerate(files):
-            cStr = str(c)
-            mpath = os.path.join(fdir, file)
-            if os.path.isdir(mpath):
-                continue
-            if os.path.exists(mpath):
-                if re.search('\.svg$', file, re.IGNORECASE):
-                    z.write(mpath, cStr, zipfile.ZIP_DEFLATED)
-                else:
-                    z.write(mpath, cStr, zipfile.ZIP_STORED)
-                media[cStr] = unicodedata.normalize("NFC", file)
-                runHook("exportedMediaFiles", c)
-
+        def write(c, file, future):
+            zinfo, data = future.result()
+            if not zinfo:
+                return
+            if data is None:
+                z.write(os.path.join(fdir, file), zinfo.filename,
+                        zinfo.compress_type)
+            else:
+                z.writestr(zinfo, data)
+            media[zinfo.filename] = unicodedata.normalize("NFC", file)
+            runHook("exportedMediaFiles", c)
+        with ThreadPoolExecutor(self.mediaThreads) as pool:
+            pending = deque()
+            for c, file in enumerate(files):
+                pending.append((c, file, pool.submit(read, c, file)))
+                if len(pending) > 2*self.mediaThreads:
+                    write(*pending.popleft())
+            while pending:
+                write(*pending.popleft())
         return media
 
     def prepareMedia(self):
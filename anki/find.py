@@ -178,7 +178,7 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
                 if cmd in self.search:
                     add(self.search[cmd]((val, args)))
                 else:
-                    add(self._findField(cmd, val))
+                    add(self._findField(cmd, val, args))
             # normal text search
             else:
                 add(self._findText(token, args))
@@ -246,13 +246,9 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
         (val, args) = args
         if val == "none":
             return 'n.tags = ""'
+        # matched against each tag in the index of the notes' tags
         val = val.replace("*", "%")
-        if not val.startswith("%"):
-            val = "% " + val
-        if not val.endswith("%") or val.endswith('\\%'):
-            val += " %"
-        args.append(val)
-        return "n.tags like ? escape '\\'"
+        return "n.id in (%s)" % self.col.noteTags.query(val, args)
 
     def _findCardState(self, args):
         (val, args) = args
@@ -343,6 +339,10 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
 
     def _findText(self, val, args):
         val = val.replace("*", "%")
+        # use the full text index if possible
+        query = self.col.fts.textQuery(val, args)
+        if query:
+            return query
         args.append("%"+val+"%")
         args.append("%"+val+"%")
         return "(n.sfld like ? escape '\\' or n.flds like ? escape '\\')"
@@ -429,7 +429,7 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
                             m['id'], t['ord']))
         return " or ".join(lims)
 
-    def _findField(self, field, val):
+    def _findField(self, field, val, args=None):
         field = field.lower()
         val = val.replace("*", "%")
         # find models that have that field
@@ -441,6 +441,13 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
         if not mods:
             # nothing has that field
             return
+        # use the full text index if possible
+        if args is not None:
+            query = self.col.fts.fieldQuery(
+                dict((mid, ord) for (mid, (m, ord)) in mods.items()),
+                val, args)
+            if query:
+                return query
         # gather nids
         regex = re.escape(val).replace("_", ".").replace(re.escape("%"), ".*")
         nids = []
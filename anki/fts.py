@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""
+An optional full text index of the notes, used by the Finder.
+
+The index is a FTS5 table, notes_fts, whose rowid is the note id. Its
+column f<ord> contains the field of ordinal ord, as returned by
+stripHTMLMedia. The trigram tokenizer is used, so that the index can
+answer the substring and LIKE queries the Finder generates. The index
+only exists once enable() has been called; see anki.noteindex for how
+it is kept up to date.
+
+Searches answered by the index ignore the HTML of the fields, as it is
+not indexed; the filenames of images are kept.
+"""
+
+from anki.utils import ids2str, splitFields, stripHTMLMedia
+from anki.db import DBError
+from anki.noteindex import NoteIndex
+
+class FullTextIndex(NoteIndex):
+
+    """
+    _cols -- number of field columns of notes_fts, None if not yet read
+    from the database.
+    """
+
+    name = "notes_fts"
+    columns = "flds"
+    automatic = False
+    # number of field columns created when the models have fewer fields
+    minCols = 8
+
+    def load(self):
+        NoteIndex.load(self)
+        self._cols = None
+
+    def supported(self):
+        "Whether sqlite has been compiled with FTS5 and the trigram tokenizer."
+        try:
+            self.col.db.execute("""
+create virtual table temp.fts_check using fts5(f, tokenize='trigram')""")
+        except DBError:
+            return False
+        self.col.db.execute("drop table temp.fts_check")
+        return True
+
+    def enable(self):
+        "Create the index, and fill it. False if sqlite can't do it."
+        if not self.supported():
+            return False
+        self.rebuild()
+        return True
+
+    def disable(self):
+        NoteIndex.disable(self)
+        self.col.setMod()
+
+    def update(self, nids):
+        """As NoteIndex.update(), rebuilding the index if a model gained
+        more fields than there are columns."""
+        if nids and self.enabled() and self._fields() > self._columns():
+            self.rebuild()
+            return
+        NoteIndex.update(self, nids)
+
+    def _fields(self):
+        "The greatest number of fields of a model."
+        return max([len(m['flds']) for m in self.col.models.all()] + [0])
+
+    def _columns(self):
+        "The number of field columns of notes_fts."
+        if self._cols is None:
+            self._cols = len([r[1] for r in self.col.db.execute(
+                "pragma table_info(notes_fts)") if r[1].startswith("f")])
+        return self._cols
+
+    def _create(self):
+        self._cols = max(self._fields(), self.minCols)
+        self.col.db.execute("""
+create virtual table notes_fts using fts5(%s, tokenize = 'trigram')""" %
+                            ", ".join("f%d" % i for i in range(self._cols)))
+
+    def _drop(self):
+        self.col.db.execute("drop table if exists notes_fts")
+        self._cols = None
+
+    def _delete(self, snids):
+        self.col.db.execute("delete from notes_fts where rowid in " + snids)
+
+    def _index(self, rows):
+        cols = self._columns()
+        def gen():
+            for (id, flds) in rows:
+                fields = [stripHTMLMedia(f) for f in splitFields(flds)]
+                fields += [None] * (cols - len(fields))
+                yield [id] + fields
+        self.col.db.executemany(
+            "insert into notes_fts (rowid, %s) values (%s)" % (
+                ", ".join("f%d" % i for i in range(cols)),
+                ", ".join("?" * (cols + 1))), gen())
+
+    # Searching
+    #############################################################
+
+    def textQuery(self, val, args):
+        """A condition on n.id equivalent to searching val in any
+        field, or None if the index can't answer it.
+
+        val -- the searched text, using % and _ as the LIKE wildcards.
+        args -- the list of arguments of the query; the phrase searched
+        is added to it."""
+        # trigrams can't represent wildcards nor shorter strings
+        if "%" in val or "_" in val or "\\" in val or len(val) < 3:
+            return None
+        if not self.check():
+            return None
+        args.append('"%s"' % val.replace('"', '""'))
+        return "n.id in (select rowid from notes_fts where notes_fts match ?)"
+
+    def fieldQuery(self, ords, val, args):
+        """A condition on n.id equivalent to the whole content of a field
+        matching val, or None if the index can't answer it.
+
+        ords -- dictionnary associating to the ids of the models having
+        this field the ordinal of the field.
+        val -- the searched value, using % and _ as the LIKE wildcards.
+        args -- the list of arguments of the query; val is added to it
+        once per distinct ordinal."""
+        if not self.check() or max(ords.values()) >= self._columns():
+            return None
+        mids = {}
+        for mid, ord in ords.items():
+            mids.setdefault(ord, []).append(mid)
+        lims = []
+        for ord, ids in sorted(mids.items()):
+            args.append(val)
+            lims.append("(n.mid in %s and n.id in "
+                        "(select rowid from notes_fts where f%d like ?))" % (
+                            ids2str(ids), ord))
+        return " or ".join(lims)
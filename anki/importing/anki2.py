@@ -10,9 +10,12 @@ from anki.importing.base import Importer
 from anki.lang import _
 from anki.lang import ngettext
 
-GUID = 1
-MID = 2
-MOD = 3
+# what is done with a note of the file
+NOTE_NONE = 0
+NOTE_ADD = 1
+NOTE_UPDATE = 2
+NOTE_IGNORE = 3
+NOTE_IDENTICAL = 4
 
 class Anki2Importer(Importer):
 
@@ -51,17 +54,53 @@ class Anki2Importer(Importer):
             self.dst.decks.select(id)
         self._prepareTS()
         self._prepareModels()
-        self._importNotes()
-        self._importCards()
+        self._attach()
+        try:
+            self._importNotes()
+            self._importCards()
+        except:
+            # don't leave a partial import in the collection
+            self.dst.rollback()
+            raise
+        finally:
+            self._detach()
         self._importStaticMedia()
         self._postImport()
+        self.dst.db.optimize()
+
+    # Attaching the file
+    ######################################################################
+    # Notes, cards and revlog are merged by statements reading the file
+    # attached to the collection's connection as the database src, instead
+    # of loading both collections in python. The intermediate results are
+    # kept in temporary tables, named import_*.
+
+    tempTables = ("import_mids", "import_notes", "import_guids",
+                  "import_dstnotes", "import_cards", "import_decks")
+
+    def _attach(self):
+        if self.src.db.mod:
+            # the file was upgraded when it was opened; the attached
+            # database must see the upgraded tables
+            self.src.db.commit()
+        # attaching is not possible inside a transaction
+        self.dst.db.setAutocommit(True)
+        self.dst.db.execute("attach ? as src", self.file)
+        self.dst.db.setAutocommit(False)
+
+    def _detach(self):
         self.dst.db.setAutocommit(True)
-        self.dst.db.execute("vacuum")
-        self.dst.db.execute("analyze")
+        for table in self.tempTables:
+            self.dst.db.execute("drop table if exists temp.%s" % table)
+        self.dst.db.execute("detach src")
         self.dst.db.setAutocommit(False)
 
     # Notes
     ######################################################################
+    # Each note of the file has a row in import_notes, whose action is one
+    # of the NOTE_* constants. Its nid is the id the note has in the
+    # collection once added or updated, and ignored is set when the
+    # cards of its guid should not be imported.
 
     def _logNoteRow(self, action, noteRow):
         self.log.append("[%s] %s" % (
@@ -70,130 +109,206 @@ class Anki2Importer(Importer):
         ))
 
     def _importNotes(self):
-        # build guid -> (id,mod,mid) hash & map of existing note ids
-        self._notes = {}
-        existing = {}
-        for id, guid, mod, mid in self.dst.db.execute(
-            "select id, guid, mod, mid from notes"):
-            self._notes[guid] = (id, mod, mid)
-            existing[id] = True
-        # we may need to rewrite the guid if the model schemas don't match,
-        # so we need to keep track of the changes for the card import stage
-        self._changedGuids = {}
-        # we ignore updates to changed schemas. we need to note the ignored
-        # guids, so we avoid importing invalid cards
-        self._ignoredGuids = {}
-        # iterate over source collection
-        add = []
-        update = []
-        dirty = []
+        db = self.dst.db
         usn = self.dst.usn()
-        dupesIdentical = []
-        dupesIgnored = []
-        total = 0
-        for note in self.src.db.execute(
-            "select * from notes"):
-            total += 1
-            # turn the db result into a mutable list
-            note = list(note)
-            shouldAdd = self._uniquifyNote(note)
-            if shouldAdd:
-                # ensure id is unique
-                while note[0] in existing:
-                    note[0] += 999
-                existing[note[0]] = True
-                # bump usn
-                note[4] = usn
-                # update media references in case of dupes
-                note[6] = self._mungeMedia(note[MID], note[6])
-                add.append(note)
-                dirty.append(note[0])
-                # note we have the added the guid
-                self._notes[note[GUID]] = (note[0], note[3], note[MID])
-            else:
-                # a duplicate or changed schema - safe to update?
-                if self.allowUpdate:
-                    oldNid, oldMod, oldMid = self._notes[note[GUID]]
-                    # will update if incoming note more recent
-                    if oldMod < note[MOD]:
-                        # safe if note types identical
-                        if oldMid == note[MID]:
-                            # incoming note should use existing id
-                            note[0] = oldNid
-                            note[4] = usn
-                            note[6] = self._mungeMedia(note[MID], note[6])
-                            update.append(note)
-                            dirty.append(note[0])
-                        else:
-                            dupesIgnored.append(note)
-                            self._ignoredGuids[note[GUID]] = True
-                    else:
-                        dupesIdentical.append(note)
+        # map the models of the file, in the order their notes appear
+        db.execute("""
+create temp table import_mids (src integer primary key, dst integer)""")
+        for (mid,) in db.all(
+            "select mid from src.notes group by mid order by min(id)"):
+            db.execute("insert into import_mids values (?, ?)",
+                       mid, self._mid(mid))
+        # the notes of the file, with the last note of the collection
+        # having the same guid
+        db.execute("""
+create temp table import_notes (
+    sid integer primary key, guid text not null, mid integer not null,
+    mod integer not null, moved integer not null,
+    dnid integer, dmod integer, dmid integer,
+    action integer, nid integer, ignored integer, ref integer, flds text)""")
+        db.execute("""
+insert into import_notes (sid, guid, mid, mod, moved)
+select n.id, n.guid, m.dst, n.mod, n.mid != m.dst
+from src.notes n join import_mids m on m.src = n.mid""")
+        db.execute(
+            "create index temp.import_notes_guid on import_notes (guid)")
+        db.execute("""
+create temp table import_guids (
+    guid text primary key, id integer, mod integer, mid integer)""")
+        db.execute("""
+insert or replace into import_guids select guid, id, mod, mid
+from main.notes where guid in (select guid from import_notes)
+order by id""")
+        db.execute("""
+update import_notes set (dnid, dmod, dmid) = (
+select id, mod, mid from import_guids d
+where d.guid = import_notes.guid)""")
+        # new guids are added. a known guid is updated if the note of
+        # the file is more recent and the note type is the same, and
+        # ignored if the note type changed.
+        db.execute("""
+update import_notes set
+action = case
+  when dnid is null then :add
+  when not :allowUpdate then :none
+  when dmod >= mod then :identical
+  when dmid = mid then :update
+  else :ignore end,
+nid = case
+  when dnid is null then sid
+  when :allowUpdate and dmod < mod and dmid = mid then dnid end,
+ignored = dnid is not null and (
+  moved or (:allowUpdate and dmod < mod and dmid != mid))""",
+                   add=NOTE_ADD, none=NOTE_NONE, identical=NOTE_IDENTICAL,
+                   update=NOTE_UPDATE, ignore=NOTE_IGNORE,
+                   allowUpdate=self.allowUpdate)
+        self._importDuplicateGuids()
+        self._uniquifyNoteIds()
+        self._mungeNotesMedia()
+        # log
+        counts = dict(db.all(
+            "select action, count() from import_notes group by action"))
+        total = sum(counts.values())
+        dupesIgnored = counts.get(NOTE_IGNORE, 0)
+        update = counts.get(NOTE_UPDATE, 0)
+        add = counts.get(NOTE_ADD, 0)
+        dupesIdentical = counts.get(NOTE_IDENTICAL, 0)
 
         self.log.append(_("Notes found in file: %d") % total)
 
         if dupesIgnored:
             self.log.append(
                 _("Notes that could not be imported as note type has changed: %d") %
-                len(dupesIgnored))
+                dupesIgnored)
         if update:
             self.log.append(
                 _("Notes updated, as file had newer version: %d") %
-                len(update))
+                update)
         if add:
             self.log.append(
                 _("Notes added from file: %d") %
-                len(add))
+                add)
         if dupesIdentical:
             self.log.append(
                 _("Notes skipped, as they're already in your collection: %d") %
-                len(dupesIdentical))
+                dupesIdentical)
 
         self.log.append("")
 
-        if dupesIgnored:
-            for row in dupesIgnored:
-                self._logNoteRow(_("Skipped"), row)
-        if update:
-            for row in update:
-                self._logNoteRow(_("Updated"), row)
-        if add:
-            for row in add:
-                self._logNoteRow(_("Added"), row)
-        if dupesIdentical:
-            for row in dupesIdentical:
-                self._logNoteRow(_("Identical"), row)
+        for action, label in ((NOTE_IGNORE, _("Skipped")),
+                              (NOTE_UPDATE, _("Updated")),
+                              (NOTE_ADD, _("Added")),
+                              (NOTE_IDENTICAL, _("Identical"))):
+            for row in db.execute(self._notesSql("i.action = ?"), action):
+                self._logNoteRow(label, row)
 
         # export info for calling code
-        self.dupes = len(dupesIdentical)
-        self.added = len(add)
-        self.updated = len(update)
+        self.dupes = dupesIdentical
+        self.added = add
+        self.updated = update
         # add to col
-        self.dst.db.executemany(
-            "insert or replace into notes values (?,?,?,?,?,?,?,?,?,?,?)",
-            add)
-        self.dst.db.executemany(
-            "insert or replace into notes values (?,?,?,?,?,?,?,?,?,?,?)",
-            update)
+        for action in (NOTE_ADD, NOTE_UPDATE):
+            db.execute("insert or replace into main.notes " +
+                       self._notesSql("i.action = ?", usn=True),
+                       usn, action)
+        dirty = db.list("""
+select nid from import_notes where action in (?, ?) order by sid""",
+                        NOTE_ADD, NOTE_UPDATE)
         self.dst.updateFieldCache(dirty)
         self.dst.tags.registerNotes(dirty)
 
-    # determine if note is a duplicate, and adjust mid and/or guid as required
-    # returns true if note should be added
-    def _uniquifyNote(self, note):
-        origGuid = note[GUID]
-        srcMid = note[MID]
-        dstMid = self._mid(srcMid)
-        # duplicate schemas?
-        if srcMid == dstMid:
-            return origGuid not in self._notes
-        # differing schemas and note doesn't exist?
-        note[MID] = dstMid
-        if origGuid not in self._notes:
-            return True
-        # schema changed; don't import
-        self._ignoredGuids[origGuid] = True
-        return False
+    def _notesSql(self, where, usn=False):
+        """The query returning, in the file's order, the rows of the notes
+        of import_notes satisfying where, as they are imported.
+
+        usn -- whether the usn is a parameter of the query, preceding those
+        of where."""
+        return """
+select coalesce(i.nid, n.id), n.guid, i.mid, n.mod, %s, n.tags,
+coalesce(i.flds, n.flds), n.sfld, n.csum, n.flags, n.data
+from import_notes i join src.notes n on n.id = i.sid
+where %s order by i.sid""" % ("?" if usn else "n.usn", where)
+
+    def _importDuplicateGuids(self):
+        """Decide again the action of the notes of the file sharing their
+        guid with another note of the file. Each of them sees the notes
+        added by the previous ones, as if the notes were imported one at a
+        time. An update of a note added by the file refers to its row in
+        ref, as its id is not known yet."""
+        rows = self.dst.db.all("""
+select sid, guid, mid, mod, moved, dnid, dmod, dmid from import_notes
+where guid in (
+  select guid from import_notes group by guid having count() > 1)
+order by sid""")
+        # guid -> (sid of the note added, nid, mod, mid)
+        notes = {}
+        changes = []
+        for sid, guid, mid, mod, moved, dnid, dmod, dmid in rows:
+            if guid not in notes and dnid is not None:
+                notes[guid] = (None, dnid, dmod, dmid)
+            action = NOTE_NONE
+            nid = ref = None
+            ignored = False
+            if guid not in notes:
+                action = NOTE_ADD
+                nid = sid
+                notes[guid] = (sid, None, mod, mid)
+            else:
+                ignored = bool(moved)
+                if self.allowUpdate:
+                    oldSid, oldNid, oldMod, oldMid = notes[guid]
+                    if oldMod >= mod:
+                        action = NOTE_IDENTICAL
+                    elif oldMid == mid:
+                        action = NOTE_UPDATE
+                        nid = oldNid
+                        ref = oldSid
+                    else:
+                        action = NOTE_IGNORE
+                        ignored = True
+            changes.append((action, nid, ignored, ref, sid))
+        self.dst.db.executemany("""
+update import_notes set action = ?, nid = ?, ignored = ?, ref = ?
+where sid = ?""", changes)
+
+    def _uniquifyNoteIds(self):
+        """Give new ids to the notes added whose id is already used in the
+        collection."""
+        db = self.dst.db
+        if db.scalar("""
+select 1 from import_notes where action = ? and nid in (
+  select id from main.notes) limit 1""", NOTE_ADD):
+            existing = set(db.list("select id from main.notes"))
+            changes = []
+            for (sid,) in db.execute("""
+select sid from import_notes where action = ? order by sid""", NOTE_ADD):
+                nid = sid
+                while nid in existing:
+                    nid += 999
+                existing.add(nid)
+                if nid != sid:
+                    changes.append((nid, sid))
+            db.executemany(
+                "update import_notes set nid = ? where sid = ?", changes)
+        db.execute("""
+update import_notes set nid = (
+  select a.nid from import_notes a where a.sid = import_notes.ref)
+where ref is not null""")
+
+    def _mungeNotesMedia(self):
+        """Save in flds the fields of the notes added or updated whose media
+        references changed in _mungeMedia."""
+        changes = []
+        for sid, mid, flds in self.dst.db.execute("""
+select i.sid, i.mid, n.flds from import_notes i
+join src.notes n on n.id = i.sid
+where i.action in (?, ?) and (n.flds like '%[sound:%' or n.flds like '%<img%')
+order by i.sid""", NOTE_ADD, NOTE_UPDATE):
+            munged = self._mungeMedia(mid, flds)
+            if munged != flds:
+                changes.append((munged, sid))
+        self.dst.db.executemany(
+            "update import_notes set flds = ? where sid = ?", changes)
 
     # Models
     ######################################################################
@@ -291,84 +406,85 @@ class Anki2Importer(Importer):
     ######################################################################
 
     def _importCards(self):
-        # build map of (guid, ord) -> cid and used id cache
-        self._cards = {}
-        existing = {}
-        for guid, ord, cid in self.dst.db.execute(
-            "select f.guid, c.ord, c.id from cards c, notes f "
-            "where c.nid = f.id"):
-            existing[cid] = True
-            self._cards[(guid, ord)] = cid
-        # loop through src
-        cards = []
-        revlog = []
-        cnt = 0
+        db = self.dst.db
         usn = self.dst.usn()
         aheadBy = self.src.sched.today - self.dst.sched.today
-        for card in self.src.db.execute(
-            "select f.guid, f.mid, c.* from cards c, notes f "
-            "where c.nid = f.id"):
-            guid = card[0]
-            if guid in self._changedGuids:
-                guid = self._changedGuids[guid]
-            if guid in self._ignoredGuids:
-                continue
-            # does the card's note exist in dst col?
-            if guid not in self._notes:
-                continue
-            dnid = self._notes[guid]
-            # does the card already exist in the dst col?
-            ord = card[5]
-            if (guid, ord) in self._cards:
-                # fixme: in future, could update if newer mod time
-                continue
-            # doesn't exist. strip off note info, and save src id for later
-            card = list(card[2:])
-            scid = card[0]
-            # ensure the card id is unique
-            while card[0] in existing:
-                card[0] += 999
-            existing[card[0]] = True
-            # update cid, nid, etc
-            card[1] = self._notes[guid][0]
-            card[2] = self._did(card[2])
-            card[4] = intTime()
-            card[5] = usn
-            # review cards have a due date relative to collection
-            if card[7] in (2, 3) or card[6] == 2:
-                card[8] -= aheadBy
-            # odue needs updating too
-            if card[14]:
-                card[14] -= aheadBy
-            # if odid true, convert card from filtered to normal
-            if card[15]:
-                # odid
-                card[15] = 0
-                # odue
-                card[8] = card[14]
-                card[14] = 0
-                # queue
-                if card[6] == 1: # type
-                    card[7] = 0
-                else:
-                    card[7] = card[6]
-                # type
-                if card[6] == 1:
-                    card[6] = 0
-            cards.append(card)
-            # we need to import revlog, rewriting card ids and bumping usn
-            for rev in self.src.db.execute(
-                "select * from revlog where cid = ?", scid):
-                rev = list(rev)
-                rev[1] = card[0]
-                rev[2] = self.dst.usn()
-                revlog.append(rev)
-            cnt += 1
-        # apply
-        self.dst.db.executemany("""
-insert or ignore into cards values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""", cards)
-        self.dst.db.executemany("""
-insert or ignore into revlog values (?,?,?,?,?,?,?,?,?)""", revlog)
+        # the notes of the collection whose guid is in the file
+        db.execute("""
+create temp table import_dstnotes (id integer primary key, guid text)""")
+        db.execute("""
+insert into import_dstnotes select id, guid from main.notes
+where guid in (select guid from import_notes)""")
+        db.execute("""
+create index temp.import_dstnotes_guid on import_dstnotes (guid)""")
+        # the cards of the file whose note was imported, and which are not
+        # already in the collection
+        db.execute("""
+create temp table import_cards (sid integer primary key, id integer,
+nid integer)""")
+        db.execute("""
+insert into import_cards
+select c.id, c.id, coalesce(a.nid, i.dnid)
+from src.cards c join import_notes i on i.sid = c.nid
+left join import_notes a on a.guid = i.guid and a.action = :add
+where coalesce(a.nid, i.dnid) is not null
+and not exists (select 1 from import_notes g
+                where g.guid = i.guid and g.ignored)
+and not exists (select 1 from import_dstnotes d
+                join main.cards dc on dc.nid = d.id
+                where d.guid = i.guid and dc.ord = c.ord)
+order by c.id""", add=NOTE_ADD)
+        self._uniquifyCardIds()
+        # map the decks, in the order their cards appear
+        db.execute("""
+create temp table import_decks (src integer primary key, dst integer)""")
+        for (did,) in db.all("""
+select c.did from import_cards i join src.cards c on c.id = i.sid
+group by c.did order by min(i.sid)"""):
+            db.execute("insert into import_decks values (?, ?)",
+                       did, self._did(did))
+        # review cards have a due date relative to the collection, and
+        # cards in filtered decks are returned to their home deck
+        db.execute("""
+insert or ignore into main.cards
+select i.id, i.nid, d.dst, c.ord, :mod, :usn,
+case when c.odid and c.type = 1 then 0 else c.type end,
+case when c.odid then (case when c.type = 1 then 0 else c.type end)
+  else c.queue end,
+case when c.odid then (case when c.odue then c.odue - :ahead else 0 end)
+  when c.queue in (2, 3) or c.type = 2 then c.due - :ahead
+  else c.due end,
+c.ivl, c.factor, c.reps, c.lapses, c.left,
+case when c.odid then 0 when c.odue then c.odue - :ahead else 0 end,
+0, c.flags, c.data
+from import_cards i join src.cards c on c.id = i.sid
+join import_decks d on d.src = c.did
+order by i.sid""", mod=intTime(), usn=usn, ahead=aheadBy)
+        # the revlog follows the cards, with their new id
+        db.execute("""
+insert or ignore into main.revlog
+select r.id, i.id, :usn, r.ease, r.ivl, r.lastIvl, r.factor, r.time, r.type
+from import_cards i join src.revlog r on r.cid = i.sid
+order by i.sid, r.id""", usn=usn)
+
+    def _uniquifyCardIds(self):
+        """Give new ids to the cards imported whose id is already used in
+        the collection."""
+        db = self.dst.db
+        if not db.scalar("""
+select 1 from import_cards where id in (select id from main.cards)
+limit 1"""):
+            return
+        existing = set(db.list("select id from main.cards"))
+        changes = []
+        for (sid,) in db.execute("select sid from import_cards order by sid"):
+            cid = sid
+            while cid in existing:
+                cid += 999
+            existing.add(cid)
+            if cid != sid:
+                changes.append((cid, sid))
+        db.executemany("update import_cards set id = ? where sid = ?", changes)
 
     # Media
     ######################################################################
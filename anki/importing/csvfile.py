@@ -4,7 +4,7 @@
 
 import codecs
 import csv
-import re
+import itertools
 
 from anki.importing.noteimp import NoteImporter, ForeignNote
 from anki.lang import _
@@ -14,6 +14,8 @@ class TextImporter(NoteImporter):
 
     needDelimiter = True
     patterns = ("\t", "|", ",", ";", ":")
+    # number of lines read to find the format of the file
+    sniffLines = 10
 
     def __init__(self, *args):
         NoteImporter.__init__(self, *args)
@@ -23,37 +25,34 @@ class TextImporter(NoteImporter):
         self.tagsToAdd = []
 
     def foreignNotes(self):
+        """An iterator over the notes of the file, which is read as the
+        notes are needed."""
         self.open()
-        # process all lines
-        log = []
-        notes = []
-        lineNum = 0
-        ignored = 0
-        if self.delimiter:
-            reader = csv.reader(self.data, delimiter=self.delimiter, doublequote=True)
-        else:
-            reader = csv.reader(self.data, self.dialect, doublequote=True)
+        return self._foreignNotes()
+
+    def _foreignNotes(self):
+        self.log = []
+        self.ignored = 0
+        lines = self._lines()
+        reader = self._reader(lines)
         try:
             for row in reader:
                 if len(row) != self.numFields:
                     if row:
-                        log.append(_(
+                        self.log.append(_(
                             "'%(row)s' had %(num1)d fields, "
                             "expected %(num2)d") % {
                             "row": " ".join(row),
                             "num1": len(row),
                             "num2": self.numFields,
                             })
-                        ignored += 1
+                        self.ignored += 1
                     continue
-                note = self.noteFromFields(row)
-                notes.append(note)
+                yield self.noteFromFields(row)
         except (csv.Error) as e:
-            log.append(_("Aborted: %s") % str(e))
-        self.log = log
-        self.ignored = ignored
-        self.fileobj.close()
-        return notes
+            self.log.append(_("Aborted: %s") % str(e))
+        finally:
+            lines.close()
 
     def open(self):
         "Parse the top line and determine the pattern and number of fields."
@@ -61,26 +60,49 @@ class TextImporter(NoteImporter):
         self.cacheFile()
 
     def cacheFile(self):
-        "Read file into self.lines if not already there."
+        "Read the first lines into self.data if not already there."
         if not self.fileobj:
             self.openFile()
 
     def openFile(self):
         self.dialect = None
         self.fileobj = open(self.file, "r", encoding='utf-8-sig')
-        self.data = self.fileobj.read()
-        def sub(s):
-            return re.sub("^\#.*$", "__comment", s)
-        self.data = [sub(x)+"\n" for x in self.data.split("\n") if sub(x) != "__comment"]
+        with self.fileobj:
+            for line in self.fileobj:
+                if not line.startswith("#"):
+                    if line.startswith("tags:"):
+                        tags = str(line[5:]).strip()
+                        self.tagsToAdd = tags.split(" ")
+                    break
+        lines = self._lines()
+        self.data = list(itertools.islice(lines, self.sniffLines))
+        lines.close()
         if self.data:
-            if self.data[0].startswith("tags:"):
-                tags = str(self.data[0][5:]).strip()
-                self.tagsToAdd = tags.split(" ")
-                del self.data[0]
             self.updateDelimiter()
         if not self.dialect and not self.delimiter:
             raise Exception("unknownFormat")
 
+    def _lines(self):
+        """Generator of the lines of the file, ending with a newline, except
+        the comments and the tags line."""
+        with open(self.file, "r", encoding='utf-8-sig') as f:
+            first = True
+            for line in f:
+                if line.startswith("#"):
+                    continue
+                if first:
+                    first = False
+                    if line.startswith("tags:"):
+                        continue
+                yield line.rstrip("\n") + "\n"
+
+    def _reader(self, lines):
+        "A csv reader of lines, using the delimiter or dialect found."
+        if self.delimiter:
+            return csv.reader(lines, delimiter=self.delimiter,
+                              doublequote=True)
+        return csv.reader(lines, self.dialect, doublequote=True)
+
     def updateDelimiter(self):
         def err():
             raise Exception("unknownFormat")
@@ -95,12 +117,7 @@ class TextImporter(NoteImporter):
                     self.dialect = sniffer.sniff(self.data[0], self.patterns)
                 except:
                     pass
-        if self.dialect:
-            try:
-                reader = csv.reader(self.data, self.dialect, doublequote=True)
-            except:
-                err()
-        else:
+        if not self.dialect:
             if not self.delimiter:
                 if "\t" in self.data[0]:
                     self.delimiter = "\t"
@@ -110,7 +127,13 @@ class TextImporter(NoteImporter):
                     self.delimiter = ","
                 else:
                     self.delimiter = " "
-            reader = csv.reader(self.data, delimiter=self.delimiter, doublequote=True)
+        # the first row may span more lines than were read
+        lines = self._lines()
+        try:
+            reader = self._reader(lines)
+        except:
+            lines.close()
+            err()
         try:
             while True:
                 row = next(reader)
@@ -119,6 +142,8 @@ class TextImporter(NoteImporter):
                     break
         except:
             err()
+        finally:
+            lines.close()
         self.initMapping()
 
     def fields(self):
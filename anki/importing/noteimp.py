@@ -3,13 +3,14 @@
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
 import  html
-
+import itertools
 import unicodedata
 
 from anki.consts import NEW_CARDS_RANDOM, STARTING_FACTOR
 from anki.lang import _
-from anki.utils import fieldChecksum, guid64, timestampID, \
-    joinFields, intTime, splitFields
+from anki.utils import fieldChecksum, joinFields, intTime, splitFields
+from anki.notes import Note
+from anki.hooks import runHook
 from anki.importing.base import Importer
 from anki.lang import ngettext
 
@@ -61,6 +62,8 @@ class NoteImporter(Importer):
     needDelimiter = False
     allowHTML = False
     importMode = 0
+    # number of notes saved at once by importNotes
+    chunkSize = 1000
 
     def __init__(self, col, file):
         Importer.__init__(self, col, file)
@@ -74,6 +77,11 @@ class NoteImporter(Importer):
         c = self.foreignNotes()
         self.importNotes(c)
 
+    def cancel(self):
+        """Stop importing after the current chunk of notes. The notes of
+        the previous chunks stay in the collection."""
+        self._cancelled = True
+
     def fields(self):
         """The number of fields."""
 
@@ -108,36 +116,110 @@ class NoteImporter(Importer):
         return
 
     def importNotes(self, notes):
-        "Convert each card into a note, apply attributes and add to col."
+        """Convert each card into a note, apply attributes and add to col.
+
+        notes -- an iterable of ForeignNote. It is read chunkSize notes
+        at a time, and the hook importedNotes is run with the number of
+        notes read so far after each chunk. The collection is saved
+        before each chunk but the first, so an import of a single chunk
+        can still be undone, and undoable is False otherwise."""
         assert self.mappingOk()
+        self._cancelled = False
         # note whether tags are mapped
         self._tagsMapped = False
         for f in self.mapping:
             if f == "_tags":
                 self._tagsMapped = True
-        # gather checks for duplicate comparison
-        csums = {}
-        for csum, id in self.col.db.execute(
-            "select csum, id from notes where mid = ?", self.model['id']):
-            if csum in csums:
-                csums[csum].append(id)
-            else:
-                csums[csum] = [id]
-        firsts = {}#mapping sending first field of added note to true
-        fld0idx = self.mapping.index(self.model['flds'][0]['name'])
+        self._fld0idx = self.mapping.index(self.model['flds'][0]['name'])
         self._fmap = self.col.models.fieldMap(self.model)
-        self._nextID = timestampID(self.col.db, "notes")
-        # loop through the notes
-        updates = []
-        updateLog = []
+        self._updateLog = []
+        self._dupes = set()#first fields seen in the db, and added anyway
+        self._emptyNotes = False
+        self._emptyCards = False
+        self._added = 0
+        self._dupeCount = 0
+        self.updateCount = 0
+        self.total = 0
+        self.undoable = True
+        db = self.col.db
+        # checksums of the notes of the model before the import, for
+        # duplicate comparison
+        db.execute("""
+create temp table import_csums (csum integer not null, id integer not null)""")
+        db.execute("""
+insert into import_csums select csum, id from notes where mid = ?""",
+                   self.model['id'])
+        db.execute(
+            "create index temp.import_csums_csum on import_csums (csum)")
+        # first fields of the previous chunks
+        db.execute("create temp table import_firsts (fld text primary key)")
+        # first fields of the current chunk
+        db.execute("""
+create temp table import_chunk (idx integer primary key, csum integer,
+fld text)""")
+        read = 0
+        try:
+            notes = iter(notes)
+            while not self._cancelled:
+                chunk = list(itertools.islice(notes, self.chunkSize))
+                if not chunk:
+                    break
+                if read:
+                    # this also clears the checkpoint taken before the
+                    # import
+                    self.col.save()
+                    self.undoable = False
+                self._importChunk(chunk)
+                read += len(chunk)
+                runHook("importedNotes", read)
+        finally:
+            for table in ("import_csums", "import_firsts", "import_chunk"):
+                db.execute("drop table if exists temp.%s" % table)
+        if self._emptyCards:
+            self.log.insert(0, _(
+                "Empty cards found. Please run Tools>Empty Cards."))
+        # we randomize or order here, to ensure that siblings
+        # have the same due#
+        did = self.col.decks.selected()
+        conf = self.col.decks.confForDid(did)
+        # in order due?
+        if conf['new']['order'] == NEW_CARDS_RANDOM:
+            self.col.sched.randomizeCards(did)
+
+        part1 = ngettext("%d note added", "%d notes added",
+                         self._added) % self._added
+        part2 = ngettext("%d note updated", "%d notes updated",
+                         self.updateCount) % self.updateCount
+        if self.importMode == 0:
+            unchanged = self._dupeCount - self.updateCount
+        elif self.importMode == 1:
+            unchanged = self._dupeCount
+        else:
+            unchanged = 0
+        part3 = ngettext("%d note unchanged", "%d notes unchanged",
+                         unchanged) % unchanged
+        self.log.append("%s, %s, %s." % (part1, part2, part3))
+        self.log.extend(self._updateLog)
+        if self._emptyNotes:
+            self.log.append(_("""\
+One or more notes were not imported, because they didn't generate any cards. \
+This can happen when you have empty fields or when you have not mapped the \
+content in the text file to the correct fields."""))
+        if self._cancelled:
+            self.log.append(_("Import cancelled."))
+        if not self.undoable:
+            self.log.append(_(
+                "This import was saved as it went and can't be undone."))
+
+    def _importChunk(self, notes):
+        """Add or update the notes of a chunk, and generate their cards."""
+        db = self.col.db
         updateLogTxt = _("First field matched: %s")
         dupeLogTxt = _("Added duplicate with first field: %s")
-        new = []
         self._ids = []
         self._cards = []
-        self._emptyNotes = False
-        dupeCount = 0
-        dupes = []#List of first field seen, present in the db, and added anyway
+        # (note, first field, checksum) of the notes with a first field
+        rows = []
         for n in notes:
             for c in range(len(n.fields)):
                 if not self.allowHTML:
@@ -147,112 +229,101 @@ class NoteImporter(Importer):
                     n.fields[c] = n.fields[c].replace("\n", "<br>")
                 n.fields[c] = unicodedata.normalize("NFC", n.fields[c])
             n.tags = [unicodedata.normalize("NFC", t) for t in n.tags]
-            fld0 = n.fields[fld0idx]
-            csum = fieldChecksum(fld0)
+            fld0 = n.fields[self._fld0idx]
             # first field must exist
             if not fld0:
                 self.log.append(_("Empty first field: %s") %
                                 " ".join(n.fields))
                 continue
+            rows.append((n, fld0, fieldChecksum(fld0)))
+        db.execute("delete from import_chunk")
+        db.executemany("insert into import_chunk values (?, ?, ?)",
+                       ((idx, csum, fld0)
+                        for idx, (n, fld0, csum) in enumerate(rows)))
+        firsts = set(db.list("""
+select fld from import_chunk where fld in (select fld from import_firsts)"""))
+        db.execute("insert or ignore into import_firsts select fld "
+                   "from import_chunk order by idx")
+        # notes of the db whose first field has the same checksum;
+        # csum is not a guarantee, the field has to be checked
+        candidates = {}
+        for idx, id, flds in db.execute("""
+select c.idx, n.id, n.flds from import_chunk c
+join import_csums s on s.csum = c.csum join notes n on n.id = s.id
+order by c.idx, s.rowid"""):
+            candidates.setdefault(idx, []).append((id, flds))
+        # loop through the notes
+        updates = []
+        new = []
+        for idx, (n, fld0, csum) in enumerate(rows):
             # earlier in import?
             if fld0 in firsts and self.importMode != 2:
                 # duplicates in source file; log and ignore
                 self.log.append(_("Appeared twice in file: %s") %
                                 fld0)
                 continue
-            firsts[fld0] = True
+            firsts.add(fld0)
             # already exists?
             found = False#Whether a note with a similar first field was found
-            if csum in csums:
-                # csum is not a guarantee; have to check
-                for id in csums[csum]:
-                    flds = self.col.db.scalar(
-                        "select flds from notes where id = ?", id)
-                    sflds = splitFields(flds)
-                    if fld0 == sflds[0]:
-                        # duplicate
-                        found = True
-                        if self.importMode == 0:
-                            data = self.updateData(n, id, sflds)
-                            if data:
-                                updates.append(data)
-                                updateLog.append(updateLogTxt % fld0)
-                                dupeCount += 1
-                                found = True
-                        elif self.importMode == 1:
-                            dupeCount += 1
-                        elif self.importMode == 2:
-                            # allow duplicates in this case
-                            if fld0 not in dupes:
-                                # only show message once, no matter how many
-                                # duplicates are in the collection already
-                                updateLog.append(dupeLogTxt % fld0)
-                                dupes.append(fld0)
-                            found = False
+            for id, flds in candidates.get(idx, ()):
+                sflds = splitFields(flds)
+                if fld0 == sflds[0]:
+                    # duplicate
+                    found = True
+                    if self.importMode == 0:
+                        data = self.updateData(n, id, sflds)
+                        if data:
+                            updates.append(data)
+                            self._updateLog.append(updateLogTxt % fld0)
+                            self._dupeCount += 1
+                            found = True
+                    elif self.importMode == 1:
+                        self._dupeCount += 1
+                    elif self.importMode == 2:
+                        # allow duplicates in this case
+                        if fld0 not in self._dupes:
+                            # only show message once, no matter how many
+                            # duplicates are in the collection already
+                            self._updateLog.append(dupeLogTxt % fld0)
+                            self._dupes.add(fld0)
+                        found = False
             # newly add
             if not found:
                 data = self.newData(n)
                 if data:
                     new.append(data)
-                    # note that we've seen this note once already
-                    firsts[fld0] = True
         self.addNew(new)
         self.addUpdates(updates)
+        self._added += len(new)
         # make sure to update sflds, etc
         self.col.updateFieldCache(self._ids)
         # generate cards
         if self.col.genCards(self._ids):
-            self.log.insert(0, _(
-                "Empty cards found. Please run Tools>Empty Cards."))
+            self._emptyCards = True
         # apply scheduling updates
         self.updateCards()
-        # we randomize or order here, to ensure that siblings
-        # have the same due#
-        did = self.col.decks.selected()
-        conf = self.col.decks.confForDid(did)
-        # in order due?
-        if conf['new']['order'] == NEW_CARDS_RANDOM:
-            self.col.sched.randomizeCards(did)
-
-        part1 = ngettext("%d note added", "%d notes added", len(new)) % len(new)
-        part2 = ngettext("%d note updated", "%d notes updated",
-                         self.updateCount) % self.updateCount
-        if self.importMode == 0:
-            unchanged = dupeCount - self.updateCount
-        elif self.importMode == 1:
-            unchanged = dupeCount
-        else:
-            unchanged = 0
-        part3 = ngettext("%d note unchanged", "%d notes unchanged",
-                         unchanged) % unchanged
-        self.log.append("%s, %s, %s." % (part1, part2, part3))
-        self.log.extend(updateLog)
-        if self._emptyNotes:
-            self.log.append(_("""\
-One or more notes were not imported, because they didn't generate any cards. \
-This can happen when you have empty fields or when you have not mapped the \
-content in the text file to the correct fields."""))
-        self.total = len(self._ids)
+        self.total += len(self._ids)
 
     def newData(self, n):
-        id = self._nextID
-        self._nextID += 1
-        self._ids.append(id)
+        """A pair (note, n's cards) to add to the collection, or None if
+        the note would have no card."""
         if not self.processFields(n):
             return
-        # note id for card updates later
-        for ord, c in list(n.cards.items()):
-            self._cards.append((id, ord, c))
-        self.col.tags.register(n.tags)
-        return [id, guid64(), self.model['id'],
-                intTime(), self.col.usn(), self.col.tags.join(n.tags),
-                n.fieldsStr, "", "", 0, ""]
+        note = Note(self.col, self.model)
+        note.fields = splitFields(n.fieldsStr)
+        note.tags = n.tags
+        return note, n.cards
 
     def addNew(self, rows):
-        """Adds every notes of rows into the db"""
-        self.col.db.executemany(
-            "insert or replace into notes values (?,?,?,?,?,?,?,?,?,?,?)",
-            rows)
+        """Adds every notes of rows into the db, with their cards"""
+        results = self.col.addNotes([note for note, cards in rows])
+        for (note, cards), (ncards, error) in zip(rows, results):
+            if not ncards:
+                continue
+            self._ids.append(note.id)
+            # note id for card updates later
+            for ord, c in list(cards.items()):
+                self._cards.append((note.id, ord, c))
 
     def updateData(self, n, id, sflds):
         self._ids.append(id)
@@ -277,7 +348,7 @@ where id = ? and (flds != ? or tags != ?)""", rows)
             self.col.db.executemany("""
 update notes set mod = ?, usn = ?, flds = ?
 where id = ? and flds != ?""", rows)
-        self.updateCount = self.col.db.totalChanges() - old
+        self.updateCount += self.col.db.totalChanges() - old
 
     def processFields(self, note, fields=None):
         if not fields:
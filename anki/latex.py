@@ -54,17 +54,44 @@ def mungeQA(html, type, fields, model, data, col):
     data -- not used. [cid, nid, mid, did, ord, tags, flds]
     col -- the current collection. It deals with media folder
     """
+    return _replaceLatex(html, lambda latex: _imgLink(col, latex, model))
+
+def latexLinks(html, model):
+    """html, where LaTeX parts are replaced by the HTML mungeQA would
+    show once their images exist, without building nor looking for the
+    images.
+
+    keyword arguments:
+    html -- the text in which to find the LaTeX to be replaced.
+    model -- the model in which is compiled the note. It deals with the
+    image file format."""
+    return _replaceLatex(html, lambda latex: _link(_imgName(latex, model)))
+
+def _replaceLatex(html, repl):
+    """html, where each LaTeX part is replaced by repl applied to its
+    LaTeX code."""
     for match in regexps['standard'].finditer(html):
-        html = html.replace(match.group(), _imgLink(col, match.group(1), model))
+        html = html.replace(match.group(), repl(match.group(1)))
     for match in regexps['expression'].finditer(html):
-        html = html.replace(match.group(), _imgLink(
-            col, "$" + match.group(1) + "$", model))
+        html = html.replace(match.group(), repl("$" + match.group(1) + "$"))
     for match in regexps['math'].finditer(html):
-        html = html.replace(match.group(), _imgLink(
-            col,
-            "\\begin{displaymath}" + match.group(1) + "\\end{displaymath}", model))
+        html = html.replace(match.group(), repl(
+            "\\begin{displaymath}" + match.group(1) + "\\end{displaymath}"))
     return html
 
+def _imgName(latex, model):
+    "The name of the image of the latex code, in the model."
+    txt = _latexFromHtml(None, latex)
+    if model.get("latexsvg", False):
+        ext = "svg"
+    else:
+        ext = "png"
+    return "latex-%s.%s" % (checksum(txt.encode("utf8")), ext)
+
+def _link(fname):
+    "The HTML showing the image fname."
+    return '<img class=latex src="%s">' % fname
+
 def _imgLink(col, latex, model):
     """Some HTML to display instead of the LaTeX code.
 
@@ -91,14 +118,9 @@ def _imgLink(col, latex, model):
     """
     txt = _latexFromHtml(col, latex)
 
-    if model.get("latexsvg", False):
-        ext = "svg"
-    else:
-        ext = "png"
-
     # is there an existing file?
-    fname = "latex-%s.%s" % (checksum(txt.encode("utf8")), ext)
-    link = '<img class=latex src="%s">' % fname
+    fname = _imgName(latex, model)
+    link = _link(fname)
     if os.path.exists(fname):
         return link
 
@@ -24,12 +24,16 @@ import unicodedata
 import sys
 import zipfile
 import pathlib
+import tempfile
 from io import StringIO
+from hashlib import sha1
+from concurrent.futures import ThreadPoolExecutor
 
 from anki.utils import checksum, isWin, isMac, json
+from anki.hooks import runHook
 from anki.db import DB, DBError
 from anki.consts import *
-from anki.latex import mungeQA
+from anki.latex import mungeQA, latexLinks
 
 class MediaManager:
 
@@ -44,6 +48,13 @@ class MediaManager:
     ]
     regexps = soundRegexps + imgRegexps
 
+    # number of threads hashing files when scanning the media folder
+    hashThreads = min(8, os.cpu_count() or 1)
+    # size of the blocks files are hashed by
+    hashBlock = 1024*1024
+    # number of files hashed between two commits of the media DB
+    hashBatch = 500
+
     def __init__(self, col, server):
         self.col = col
         if server:
@@ -79,6 +90,7 @@ class MediaManager:
 
     def _initDB(self):
         self.db.executescript("""
+pragma auto_vacuum = incremental;
 create table media (
  fname text not null primary key,
  csum text,           -- null indicates deleted file
@@ -212,9 +224,8 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
                     f.write(data)
                 return fname
             # if it's identical, reuse
-            with open(path, "rb") as f:
-                if checksum(f.read()) == csum:
-                    return fname
+            if self._checksum(path) == csum:
+                return fname
             # otherwise, increment the index in the filename
             reg = " \((\d+)\)$"
             if not re.search(reg, root):
@@ -225,7 +236,7 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
     # String manipulation
     ##########################################################################
 
-    def filesInStr(self, mid, string, includeRemote=False):
+    def filesInStr(self, mid, string, includeRemote=False, build=True):
         """The list of media's path in the string.
         
         Each clozes are expanded in every possible ways. It allows
@@ -238,6 +249,8 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
         mid -- the id of the model of the note whose string is considered
         string -- A string, which corresponds to a field of a note
         includeRemote -- whether the list should include contents which is with http, https or ftp
+        build -- whether LaTeX media are generated. Otherwise, the
+        names they would have are listed, whether they exist or not.
         """
         l = []
         model = self.col.models.get(mid)
@@ -250,7 +263,10 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
             strings = [string]
         for string in strings:
             # handle latex
-            string = mungeQA(string, None, None, model, None, self.col)
+            if build:
+                string = mungeQA(string, None, None, model, None, self.col)
+            else:
+                string = latexLinks(string, model)
             # extract filenames
             for reg in self.regexps:
                 for match in re.finditer(reg, string):
@@ -327,17 +343,16 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
         "Return (missingFiles, unusedFiles)."
         mdir = self.dir()
         # gather all media references in NFC form
-        allRefs = set()
-        for nid, mid, flds in self.col.db.execute("select id, mid, flds from notes"):
-            noteRefs = self.filesInStr(mid, flds)
-            # check the refs are in NFC
-            for f in noteRefs:
-                # if they're not, we'll need to fix them first
-                if f != unicodedata.normalize("NFC", f):
-                    self._normalizeNoteRefs(nid)
-                    noteRefs = self.filesInStr(mid, flds)
-                    break
-            allRefs.update(noteRefs)
+        allRefs = self.col.noteMedia.files()
+        # check the refs are in NFC
+        notNFC = [f for f in allRefs if f != unicodedata.normalize("NFC", f)]
+        if notNFC:
+            # if they're not, we'll need to fix them first
+            for nid in self.col.noteMedia.notes(notNFC):
+                self._normalizeNoteRefs(nid)
+            allRefs = self.col.noteMedia.files()
+        # generate the LaTeX images not shown yet
+        self.buildLatex(allRefs)
         # loop through media folder
         unused = []
         if local is None:
@@ -397,6 +412,21 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
                 _("Anki does not support files in subfolders of the collection.media folder."))
         return (nohave, unused, warnings)
 
+    def buildLatex(self, fnames, nids=None):
+        """Generate the LaTeX images of fnames which are not in the media
+        folder, from the notes referencing them whose id is in nids, or
+        from any note if nids is None."""
+        mdir = self.dir()
+        missing = [f for f in fnames if f.startswith("latex-") and
+                   not os.path.exists(os.path.join(mdir, f))]
+        if not missing:
+            return
+        for nid in self.col.noteMedia.notes(missing):
+            if nids is None or nid in nids:
+                mid, flds = self.col.db.first(
+                    "select mid, flds from notes where id = ?", nid)
+                self.filesInStr(mid, flds)
+
     def _normalizeNoteRefs(self, nid):
         note = self.col.getNote(nid)
         for c, fld in enumerate(note.fields):
@@ -499,9 +529,29 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
         return int(os.stat(path).st_mtime)
 
     def _checksum(self, path):
-        """Checksum of file at path"""
+        """Checksum of file at path, read by blocks of hashBlock bytes."""
+        h = sha1()
         with open(path, "rb") as f:
-            return checksum(f.read())
+            for block in iter(lambda: f.read(self.hashBlock), b""):
+                h.update(block)
+        return h.hexdigest()
+
+    def _checksums(self, paths):
+        """Iterator of the (path, checksum) of the files at paths, in this
+        order. The files are hashed by hashThreads threads, as sha1 and
+        reading files release the GIL. The checksum is None if the file
+        can't be read anymore."""
+        def csum(path):
+            try:
+                return self._checksum(path)
+            except OSError:
+                return None
+        if self.hashThreads <= 1 or len(paths) <= 1:
+            for path in paths:
+                yield path, csum(path)
+            return
+        with ThreadPoolExecutor(self.hashThreads) as pool:
+            yield from zip(paths, pool.map(csum, paths))
 
     def _changed(self):
         "Return dir mtime if it has changed since the last findChanges()"
@@ -513,16 +563,39 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
         return mtime
 
     def _logChanges(self):
+        """Hash the files added or modified since the last scan, and record
+        them and the removed files in the media DB.
+
+        The DB is committed every hashBatch files, so that an interrupted
+        scan doesn't have to hash them again. The hook hashedMedia is
+        called with the number of files hashed and to hash."""
         (added, removed) = self._changes()
+        mtimes = dict(added)
+        total = len(added)
         media = []
-        for f, mtime in added:
-            media.append((f, self._checksum(f), mtime, 1))
+        done = 0
+        for f, csum in self._checksums([f for f, mtime in added]):
+            done += 1
+            # modified files whose content is the same aren't changed
+            if csum is not None and csum != self.cache.get(f, [None])[0]:
+                media.append((f, csum, mtimes[f], 1))
+            if done % self.hashBatch == 0:
+                self._logMedia(media)
+                media = []
+                runHook("hashedMedia", done, total)
         for f in removed:
             media.append((f, None, 0, 1))
-        # update media db
+        self._logMedia(media)
+        if total:
+            runHook("hashedMedia", done, total)
+        self.db.execute("update meta set dirMod = ?", self._mtime(self.dir()))
+        self.db.commit()
+
+    def _logMedia(self, media):
+        """Record in the media DB the rows (fname, csum, mtime, dirty) and
+        commit."""
         self.db.executemany("insert or replace into media values (?,?,?,?)",
                             media)
-        self.db.execute("update meta set dirMod = ?", self._mtime(self.dir()))
         self.db.commit()
 
     def _changes(self):
@@ -571,11 +644,10 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
                 if normname not in self.cache:
                     added.append((normname, mtime))
                 else:
-                    # modified since last time?
+                    # modified since last time? _logChanges() compares
+                    # the checksums
                     if mtime != self.cache[normname][1]:
-                        # and has different checksum?
-                        if self._checksum(normname) != self.cache[normname][0]:
-                            added.append((normname, mtime))
+                        added.append((normname, mtime))
                     # mark as used
                     self.cache[normname][2] = True
         # look for any entries in the cache that no longer exist on disk
@@ -601,9 +673,9 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
         return ret or (None, 0)
 
     def markClean(self, fnames):
-        for fname in fnames:
-            self.db.execute(
-                "update media set dirty=0 where fname=?", fname)
+        self.db.executemany(
+            "update media set dirty=0 where fname=?",
+            ((fname,) for fname in fnames))
 
     def syncDelete(self, fname):
         """Delete the file fname if it is not in media directory."""
@@ -627,16 +699,18 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
         self.db.execute("delete from media")
         self.db.execute("update meta set lastUsn=0,dirMod=0")
         self.db.commit()
-        self.db.setAutocommit(True)
-        self.db.execute("vacuum")
-        self.db.execute("analyze")
-        self.db.setAutocommit(False)
+        self.db.optimize()
 
     # Media syncing: zips
     ##########################################################################
 
     def mediaChangesZip(self):
-        f = io.BytesIO()
+        """A zip of dirty files to upload, and the list of their names.
+
+        The zip is written to a temporary file, which stays in memory
+        while it is smaller than SYNC_ZIP_SIZE, positioned at its
+        start."""
+        f = tempfile.SpooledTemporaryFile(max_size=SYNC_ZIP_SIZE)
         z = zipfile.ZipFile(f, "w", compression=zipfile.ZIP_DEFLATED)
 
         fnames = []
@@ -666,34 +740,47 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
 
         z.writestr("_meta", json.dumps(meta))
         z.close()
-        return f.getvalue(), fnames
+        f.seek(0)
+        return f, fnames
 
     def addFilesFromZip(self, zipData):
-        "Extract zip data; true if finished."
-        f = io.BytesIO(zipData)
-        z = zipfile.ZipFile(f, "r")
+        """Extract the files of a zip sent by the server, given as bytes or
+        as a file, and record them. Return the number of files."""
+        if isinstance(zipData, bytes):
+            zipData = io.BytesIO(zipData)
+        media = self.extractZip(zipData)
+        self.addMedia(media)
+        return len(media)
+
+    def extractZip(self, fileobj):
+        """Extract the files of the zip fileobj sent by the server,
+        hashing them while they are written, by blocks of hashBlock bytes.
+        Return the rows (fname, csum, mtime, dirty) to record.
+
+        This doesn't use the media DB, so it may run in another thread."""
+        z = zipfile.ZipFile(fileobj, "r")
         media = []
         # get meta info first
         meta = json.loads(z.read("_meta").decode("utf8"))
         # then loop through all files
-        cnt = 0
         for i in z.infolist():
             if i.filename == "_meta":
                 # ignore previously-retrieved meta
                 continue
-            else:
-                data = z.read(i)
-                csum = checksum(data)
-                name = meta[i.filename]
-                # normalize name
-                name = unicodedata.normalize("NFC", name)
-                # save file
-                with open(name, "wb") as f:
-                    f.write(data)
-                # update db
-                media.append((name, csum, self._mtime(name), 0))
-                cnt += 1
+            name = meta[i.filename]
+            # normalize name
+            name = unicodedata.normalize("NFC", name)
+            # save file
+            h = sha1()
+            with z.open(i) as src, open(name, "wb") as dst:
+                for block in iter(lambda: src.read(self.hashBlock), b""):
+                    h.update(block)
+                    dst.write(block)
+            media.append((name, h.hexdigest(), self._mtime(name), 0))
+        return media
+
+    def addMedia(self, media):
+        "Record the rows (fname, csum, mtime, dirty), without committing."
         if media:
             self.db.executemany(
                 "insert or replace into media values (?,?,?,?)", media)
-        return cnt
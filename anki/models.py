@@ -60,7 +60,7 @@ qfmt -- "question format string"
 
 import copy, re
 from anki.utils import intTime, joinFields, splitFields, ids2str,\
-    checksum, json
+    checksum, json, JsonCache
 from anki.lang import _
 from anki.consts import *
 from anki.hooks import runHook
@@ -127,7 +127,12 @@ defaultTemplate = {
 
 class ModelManager:
     """This object is usually denoted mm as a variable. Or .models in
-    collection."""
+    collection.
+
+    _json -- the JsonCache of models; only the models given to save()
+    are serialized again on flush.
+    _flushed -- the JSON of models as it is in the database.
+    """
     # Saving/loading registry
     #############################################################
 
@@ -136,9 +141,22 @@ class ModelManager:
         self.col = col
 
     def load(self, json_):
-        "Load registry from JSON."
+        """Load registry from JSON. It is only decoded when models are
+        first accessed."""
         self.changed = False
-        self.models = json.loads(json_)
+        self._models = None
+        self._json = JsonCache()
+        self._flushed = json_
+
+    @property
+    def models(self):
+        if self._models is None:
+            self._models = json.loads(self._flushed)
+        return self._models
+
+    @models.setter
+    def models(self, models):
+        self._models = models
 
     def save(self, m=None, templates=False):
         """
@@ -156,14 +174,19 @@ class ModelManager:
             self._updateRequired(m)
             if templates:
                 self._syncTemplates(m)
+            self._json.mark(str(m['id']))
+        else:
+            self._json.mark()
         self.changed = True
         runHook("newModel") # By default, only refresh side bar of browser
 
     def flush(self):
         "Flush the registry if any models were changed."
-        if self.changed:
-            self.col.db.execute("update col set models = ?",
-                                 json.dumps(self.models))
+        if self.changed and self._models is not None:
+            models = self._json.dumps(self._models)
+            if models != self._flushed:
+                self.col.db.execute("update col set models = ?", models)
+                self._flushed = models
             self.changed = False
 
     # Retrieving and creating models
@@ -489,6 +512,8 @@ and notes.mid = ? and cards.ord = ?""", m['id'], ord)
                       intTime(), self.col.usn(), id))
         self.col.db.executemany(
             "update notes set flds=?,mod=?,usn=? where id = ?", r)
+        for index in self.col.noteIndexes:
+            index.update([row[3] for row in r])
 
     # Templates
     ##################################################
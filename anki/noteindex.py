@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""
+Indexes derived from the notes, stored in tables of the collection.
+
+Beside its own tables, an index named name has a table name_notes,
+containing the mod of each note when it was indexed, and a table
+name_state, containing the collection's mod when the index was last
+known to be up to date.
+
+Code modifying notes keeps the indexes of col.noteIndexes up to date
+through Note.flush(), addNotes(), updateFieldCache() and _remNotes();
+this covers the importers, find and replace, and notes merged by sync.
+Clients which don't know about the indexes may still modify the
+collection; this is detected because name_state then no longer contains
+the collection's mod, and the notes whose mod changed are indexed again
+before the index is used. The indexes are dropped before a full upload.
+"""
+
+from anki.utils import ids2str
+
+class NoteIndex:
+
+    """
+    col -- the collection
+    _enabled -- whether the index exists in the database, None if not
+    yet read from the database.
+    _checked -- whether the index was compared to the notes since the
+    collection was loaded.
+
+    Subclasses define name, columns, and the methods _create(), _drop(),
+    _delete() and _index().
+    """
+
+    # prefix of the names of the tables
+    name = None
+    # the columns of notes given to _index() after the id
+    columns = None
+    # whether the index is created when first needed, rather than by
+    # rebuild()
+    automatic = True
+
+    def __init__(self, col):
+        self.col = col
+        self.load()
+
+    def load(self):
+        self._enabled = None
+        self._checked = False
+
+    def flush(self):
+        "Record that the index is up to date with the collection's mod."
+        if self.enabled():
+            self.col.db.execute("update %s_state set mod = ?" % self.name,
+                                self.col.mod)
+
+    # Creating and dropping the index
+    #############################################################
+
+    def enabled(self):
+        "Whether the index exists in the collection."
+        if self._enabled is None:
+            self._enabled = bool(self.col.db.scalar(
+                "select 1 from sqlite_master where name = ?",
+                self.name + "_notes"))
+        return self._enabled
+
+    def disable(self):
+        "Drop the index."
+        self._drop()
+        self.col.db.execute("drop table if exists %s_notes" % self.name)
+        self.col.db.execute("drop table if exists %s_state" % self.name)
+        self._enabled = False
+
+    def rebuild(self):
+        "Recreate the index from scratch."
+        self.disable()
+        self._create()
+        self.col.db.execute("""
+create table %s_notes (nid integer primary key, mod integer not null)""" %
+                            self.name)
+        self.col.db.execute("create table %s_state (mod integer)" % self.name)
+        self.col.db.execute("insert into %s_state values (?)" % self.name,
+                            self.col.mod)
+        self._enabled = True
+        self._index(self.col.db.execute(
+            "select id, %s from notes" % self.columns))
+        self.col.db.execute(
+            "insert into %s_notes select id, mod from notes" % self.name)
+        self._checked = True
+
+    # Keeping the index up to date
+    #############################################################
+
+    def update(self, nids):
+        "Index the current content of the notes whose id is in nids."
+        if not nids or not self.enabled():
+            return
+        snids = ids2str(nids)
+        self._delete(snids)
+        self._index(self.col.db.all(
+            "select id, %s from notes where id in %s" % (self.columns, snids)))
+        self.col.db.execute("""
+insert or replace into %s_notes select id, mod from notes
+where id in %s""" % (self.name, snids))
+
+    def remove(self, nids):
+        "Remove the notes whose id is in nids from the index."
+        if not nids or not self.enabled():
+            return
+        snids = ids2str(nids)
+        self._delete(snids)
+        self.col.db.execute(
+            "delete from %s_notes where nid in %s" % (self.name, snids))
+
+    def check(self, force=False):
+        """Ensure the index exists, if it is automatic, and reflects the
+        notes, which may have been modified by a client not knowing about
+        it. Whether the index exists.
+
+        force -- compare the index with the notes even if it was already
+        done, or if the collection's mod indicates it is up to date."""
+        if not self.enabled():
+            if not self.automatic:
+                return False
+            self.rebuild()
+            return True
+        if self._checked and not force:
+            return True
+        self._checked = True
+        mod = self.col.db.scalar("select mod from %s_state" % self.name)
+        if mod == self.col.mod and not force:
+            return True
+        self._delete("""
+(select nid from %s_notes where nid not in (select id from notes))""" %
+                     self.name)
+        self.col.db.execute("""
+delete from %s_notes where nid not in (select id from notes)""" % self.name)
+        self.update(self.col.db.list("""
+select n.id from notes n left join %s_notes i on i.nid = n.id
+where i.nid is null or i.mod != n.mod""" % self.name))
+        self.flush()
+        return True
+
+    # Defined by subclasses
+    #############################################################
+
+    def _create(self):
+        "Create the tables of the index, empty."
+        pass
+
+    def _drop(self):
+        "Drop the tables of the index, if they exist."
+        pass
+
+    def _delete(self, snids):
+        """Remove the notes whose id is in snids, a list of ids or a query
+        as sql, from the tables of the index."""
+        pass
+
+    def _index(self, rows):
+        """Add to the tables of the index the rows (id, columns...) of notes
+        which are not in it."""
+        pass
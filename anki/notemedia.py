@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""
+An index of the media files referenced by each note, used by Check
+Media and by the exporters.
+
+The table note_media contains a row (nid, fname) for each local file
+fname referenced by the note nid, as listed by MediaManager.filesInStr
+without building LaTeX images. The table note_media_models contains the
+signature of each model, i.e. the options of the model filesInStr
+depends on, when its notes were indexed. The index is created the first
+time it is needed; see anki.noteindex for how it is kept up to date.
+"""
+
+from anki.utils import ids2str, json
+from anki.noteindex import NoteIndex
+
+class NoteMediaIndex(NoteIndex):
+
+    name = "note_media"
+    columns = "mid, flds"
+
+    def check(self, force=False):
+        """As NoteIndex.check(), also indexing again the notes of the
+        models whose options changed the names of LaTeX images."""
+        if self.enabled():
+            old = json.loads(self.col.db.scalar(
+                "select models from note_media_models"))
+            signatures = self._signatures()
+            mids = [mid for mid, sig in signatures.items()
+                    if old.get(mid) != sig]
+            if mids:
+                self.update(self.col.db.list(
+                    "select id from notes where mid in " + ids2str(mids)))
+                self.col.db.execute("update note_media_models set models = ?",
+                                    json.dumps(signatures))
+        return NoteIndex.check(self, force)
+
+    def _create(self):
+        self.col.db.execute("""
+create table note_media (nid integer not null, fname text not null,
+primary key (nid, fname)) without rowid""")
+        self.col.db.execute(
+            "create index ix_note_media_fname on note_media (fname)")
+        self.col.db.execute("create table note_media_models (models text)")
+        self.col.db.execute("insert into note_media_models values (?)",
+                            json.dumps(self._signatures()))
+
+    def _drop(self):
+        self.col.db.execute("drop table if exists note_media")
+        self.col.db.execute("drop table if exists note_media_models")
+
+    def _delete(self, snids):
+        self.col.db.execute("delete from note_media where nid in " + snids)
+
+    def _index(self, rows):
+        def gen():
+            for (id, mid, flds) in rows:
+                for fname in set(self.col.media.filesInStr(
+                        mid, flds, build=False)):
+                    yield id, fname
+        self.col.db.executemany(
+            "insert into note_media values (?, ?)", gen())
+
+    def _signatures(self):
+        """Dictionnary associating to each model id, as a string, what the
+        files its notes refer to depend on, beside their fields."""
+        return dict((str(m['id']), [m['type'], m.get("latexsvg", False)])
+                    for m in self.col.models.all())
+
+    # Querying the index
+    #############################################################
+
+    def files(self, nids=None):
+        """The set of files referenced by the notes whose id is in nids, or
+        by any note."""
+        self.check()
+        if nids is None:
+            return set(self.col.db.list(
+                "select distinct fname from note_media"))
+        return set(self.col.db.list(
+            "select distinct fname from note_media where nid in " +
+            ids2str(nids)))
+
+    def notes(self, fnames):
+        "The ids of the notes referencing a file of fnames."
+        self.check()
+        fnames = list(fnames)
+        nids = set()
+        # older sqlite allow at most 999 variables in a statement
+        for i in range(0, len(fnames), 999):
+            chunk = fnames[i:i+999]
+            nids.update(self.col.db.list(
+                "select nid from note_media where fname in (%s)" %
+                ", ".join("?" * len(chunk)), *chunk))
+        return list(nids)
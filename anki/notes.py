@@ -109,6 +109,10 @@ insert or replace into notes values (?,?,?,?,?,?,?,?,?,?,?)""",
                             self.mod, self.usn, tags,
                             fields, sfld, csum, self.flags,
                             self.data)
+        for index in self.col.noteIndexes:
+            index.update([self.id])
+        # prefetched cards may have rendered the old content
+        self.col.sched._dropPrefetched()
         self.col.tags.register(self.tags)
         self._postFlush()
 
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""
+An index of the tags of each note, used by tag searches, by the bulk
+tag operations and to list the tags in use.
+
+The table note_tags contains a row (tag, nid) for each tag of the note
+nid, as split by TagManager.split. Tags are compared case insensitively
+for ASCII letters, as by the LIKE of the searches, so that a tag is
+found by an index lookup and the tags starting with a prefix by a range
+scan; patterns starting with a wildcard are still matched against
+notes.tags, as they would scan the whole index. The index is created
+the first time it is needed; see anki.noteindex for how it is kept up
+to date. bulkAdd() also updates it, as it modifies notes' tags
+directly.
+"""
+
+from anki.utils import ids2str
+from anki.noteindex import NoteIndex
+
+# ASCII upper case letters, folded by the nocase collation
+_asciiLower = dict((c, c + 32) for c in range(ord("A"), ord("Z") + 1))
+
+class NoteTagIndex(NoteIndex):
+
+    name = "note_tags"
+    columns = "tags"
+
+    def _create(self):
+        self.col.db.execute("""
+create table note_tags (tag text not null collate nocase,
+nid integer not null, primary key (tag, nid)) without rowid""")
+        self.col.db.execute(
+            "create index ix_note_tags_nid on note_tags (nid)")
+
+    def _drop(self):
+        self.col.db.execute("drop table if exists note_tags")
+
+    def _delete(self, snids):
+        self.col.db.execute("delete from note_tags where nid in " + snids)
+
+    def _index(self, rows):
+        split = self.col.tags.split
+        def gen():
+            for (id, tags) in rows:
+                for tag in split(tags):
+                    yield tag, id
+        # tags differing only by case are one row
+        self.col.db.executemany(
+            "insert or ignore into note_tags values (?, ?)", gen())
+
+    # Querying the index
+    #############################################################
+
+    def query(self, val, args):
+        """A query returning the ids of the notes having a tag matching
+        val, or of all notes if val is %.
+
+        val -- a LIKE pattern escaped by \\, matched against each tag.
+        args -- the list of arguments of the query; those of the returned
+        query are appended to it."""
+        self.check()
+        # the characters before the first wildcard
+        prefix = ""
+        for c in val:
+            if c in "%_\\":
+                break
+            prefix += c
+        if prefix == val:
+            args.append(val)
+            return "select nid from note_tags where tag = ?"
+        if not prefix:
+            # no range of the index can be used, and scanning the tags of
+            # the notes is faster than scanning the index
+            if not val.startswith("%"):
+                val = "% " + val
+            if not val.endswith("%") or val.endswith("\\%"):
+                val += " %"
+            args.append(val)
+            return "select id from notes where tags like ? escape '\\'"
+        # the tags starting with prefix, in the order of the collation,
+        # are at least the lower case prefix and less than it with its
+        # last character incremented
+        low = prefix.translate(_asciiLower)
+        high = low[:-1] + chr(ord(low[-1]) + 1)
+        args.extend([low, high, val])
+        return """
+select nid from note_tags where tag >= ? and tag < ?
+and tag like ? escape '\\'"""
+
+    def tags(self, nids=None, dids=None):
+        """The set of tags, with their case, of the notes whose id is in
+        nids, or having a card in a deck whose id is in dids, or of any
+        note if both are None."""
+        self.check()
+        lim = ""
+        if nids is not None:
+            lim = " where nid in " + ids2str(nids)
+        elif dids is not None:
+            lim = " where nid in (select nid from cards where did in %s)" % (
+                ids2str(dids))
+        return set(self.col.db.list(
+            "select distinct tag collate binary from note_tags" + lim))
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""
+Aggregates of the revlog, so that the graphs of the statistics don't
+read every review.
+
+The table revlog_stats contains, for each deck, hour, type, ease and
+whether the interval before the review was at least 21 days, the
+number n of reviews, the sum of their time, and the number early of
+them done in the first second of the hour. A review belongs to the
+deck of its card, or to the deck -1 if its card doesn't exist. The
+hour of a review of id id is the ceiling of (id/1000 - shift) / 3600,
+where shift is the day cutoff modulo 3600, so that each hour ends at
+the same second as a day. A review done at the very end of an hour, or
+of a day, thus belongs to it, as in the queries of CollectionStats.
+
+The tables are created the first time the graphs are shown. Temporary
+triggers on revlog and cards then keep them up to date, whatever
+modifies the reviews or moves the cards to another deck. As the
+triggers only exist while the collection is open, revlog_stats_state
+contains the collection's mod when the tables were last known to be up
+to date. Changes done by clients which don't know about the tables are
+detected because this mod is then not the collection's one, and the
+tables are computed again.
+"""
+
+from anki.utils import ids2str
+
+class RevlogStats:
+
+    """
+    col -- the collection
+    _enabled -- whether the tables exist in the database, None if not
+    yet read from the database.
+    """
+
+    # names of the temporary triggers keeping the tables up to date
+    _triggers = ("revlog_stats_insert", "revlog_stats_delete",
+                 "revlog_stats_update_old", "revlog_stats_update_new",
+                 "revlog_stats_card_insert", "revlog_stats_card_delete",
+                 "revlog_stats_card_update")
+
+    def __init__(self, col):
+        self.col = col
+        self._enabled = None
+
+    def load(self):
+        """Keep the tables up to date from now on, if they are up to date
+        with the collection's mod."""
+        self._enabled = None
+        if not self.enabled():
+            return
+        mod, shift = self.col.db.first(
+            "select mod, shift from revlog_stats_state")
+        if mod == self.col.mod:
+            self._createTriggers(shift)
+        else:
+            self._dropTriggers()
+
+    def flush(self):
+        "Record that the tables are up to date with the collection's mod."
+        if self.enabled() and self._tracking():
+            self.col.db.execute("update revlog_stats_state set mod = ?",
+                                self.col.mod)
+
+    # Creating and dropping the tables
+    #############################################################
+
+    def enabled(self):
+        "Whether the tables exist in the collection."
+        if self._enabled is None:
+            self._enabled = bool(self.col.db.scalar(
+                "select 1 from sqlite_master where name = 'revlog_stats'"))
+        return self._enabled
+
+    def disable(self):
+        "Drop the tables."
+        self._dropTriggers()
+        self.col.db.execute("drop table if exists revlog_stats")
+        self.col.db.execute("drop table if exists revlog_stats_state")
+        self._enabled = False
+
+    def rebuild(self, shift):
+        """Compute the tables again from the revlog.
+
+        shift -- the day cutoff modulo 3600."""
+        self.disable()
+        self.col.db.execute("""
+create table revlog_stats (did integer not null, hour integer not null,
+type integer not null, ease integer not null, mature integer not null,
+n integer not null, time integer not null, early integer not null,
+primary key (hour, did, type, ease, mature)) without rowid""")
+        self.col.db.execute(
+            "create table revlog_stats_state (mod integer, shift integer)")
+        self.col.db.execute("insert into revlog_stats_state values (?, ?)",
+                            self.col.mod, shift)
+        hour, mature, early = self._bucketSql(shift)
+        self.col.db.execute("""
+insert into revlog_stats select ifnull(c.did, -1), %s, r.type, r.ease, %s,
+count(), sum(r.time), sum(%s)
+from revlog r left join cards c on c.id = r.cid
+group by 1, 2, 3, 4, 5""" % (hour, mature, early))
+        self._enabled = True
+        self._createTriggers(shift)
+
+    def check(self, cut):
+        """Ensure the tables exist and reflect the revlog.
+
+        cut -- the day cutoff."""
+        if (not self.enabled() or not self._tracking() or
+                self.col.db.scalar("select shift from revlog_stats_state")
+                != cut % 3600):
+            self.rebuild(cut % 3600)
+
+    # Keeping the tables up to date
+    #############################################################
+
+    def _tracking(self):
+        "Whether the triggers exist."
+        return self.col.db.scalar("""
+select count() from sqlite_temp_master
+where type = 'trigger' and name like 'revlog_stats_%'""") == len(
+            self._triggers)
+
+    def _dropTriggers(self):
+        for name in self._triggers:
+            self.col.db.execute("drop trigger if exists temp." + name)
+
+    def _createTriggers(self, shift):
+        self._dropTriggers()
+        # so that the delete triggers run on "insert or replace"
+        self.col.db.execute("pragma recursive_triggers = on")
+        cardDid = "ifnull((select did from cards where id = %s.cid), -1)"
+        reviewed = "id, cid, type, ease, lastIvl, time"
+        for (name, event, body) in (
+                ("revlog_stats_insert", "after insert on revlog",
+                 self._changeSql(shift, 1, cardDid % "new", "r.id = new.id")),
+                ("revlog_stats_delete", "before delete on revlog",
+                 self._changeSql(shift, -1, cardDid % "old", "r.id = old.id")),
+                ("revlog_stats_update_old",
+                 "before update of %s on revlog" % reviewed,
+                 self._changeSql(shift, -1, cardDid % "old", "r.id = old.id")),
+                ("revlog_stats_update_new",
+                 "after update of %s on revlog" % reviewed,
+                 self._changeSql(shift, 1, cardDid % "new", "r.id = new.id")),
+                ("revlog_stats_card_insert", "after insert on cards",
+                 self._changeSql(shift, -1, "-1", "r.cid = new.id") +
+                 self._changeSql(shift, 1, "new.did", "r.cid = new.id")),
+                ("revlog_stats_card_delete", "after delete on cards",
+                 self._changeSql(shift, -1, "old.did", "r.cid = old.id") +
+                 self._changeSql(shift, 1, "-1", "r.cid = old.id")),
+                ("revlog_stats_card_update",
+                 "after update of did on cards when old.did != new.did",
+                 self._changeSql(shift, -1, "old.did", "r.cid = new.id") +
+                 self._changeSql(shift, 1, "new.did", "r.cid = new.id"))):
+            self.col.db.execute("create temp trigger %s %s begin %s end" % (
+                name, event, body))
+
+    def _bucketSql(self, shift):
+        """The hour, mature and early columns of the revlog row r, as sql.
+
+        shift -- the day cutoff modulo 3600."""
+        return ("((r.id - %d + 3599999) / 3600000)" % (shift*1000),
+                "(r.lastIvl >= 21)",
+                "(((r.id - %d - 1) %% 3600000) < 999)" % (shift*1000))
+
+    def _changeSql(self, shift, sign, did, cond):
+        """Statements adding to the deck did, if sign is 1, or removing
+        from it, if sign is -1, the reviews r of the revlog satisfying
+        cond."""
+        hour, mature, early = self._bucketSql(shift)
+        cols = "%s, %s, r.type, r.ease, %s" % (did, hour, mature)
+        keys = "select %s from revlog r where %s" % (cols, cond)
+        match = """%s and %s = revlog_stats.hour and r.type = revlog_stats.type
+and r.ease = revlog_stats.ease and %s = revlog_stats.mature""" % (
+            cond, hour, mature)
+        sql = ""
+        # not "insert or ignore", as the conflict clause of the statement
+        # modifying the cards or the revlog would override it
+        if sign > 0:
+            sql += """
+insert into revlog_stats select distinct %s, 0, 0, 0 from revlog r
+where %s and not exists (select 1 from revlog_stats s where s.did = %s
+and s.hour = %s and s.type = r.type and s.ease = r.ease
+and s.mature = %s);""" % (cols, cond, did, hour, mature)
+        sql += """
+update revlog_stats set
+n = n + %(sign)d * (select count() from revlog r where %(match)s),
+time = time + %(sign)d * (select ifnull(sum(r.time), 0) from revlog r
+where %(match)s),
+early = early + %(sign)d * (select count() from revlog r where %(match)s
+and %(early)s)
+where (did, hour, type, ease, mature) in (%(keys)s);""" % dict(
+            sign=sign, match=match, early=early, keys=keys)
+        if sign < 0:
+            sql += """
+delete from revlog_stats where n = 0 and
+(did, hour, type, ease, mature) in (%s);""" % keys
+        return sql
+
+    # Querying the tables
+    #############################################################
+
+    def relation(self, dids, cut, since=None):
+        """A relation, as sql, with the columns id, type, ease, lastIvl and
+        time of the revlog, and n, the number of reviews each row stands
+        for. The reviews of the last day are the rows of the revlog. The
+        previous ones are grouped by hour: the id of a group is the end of
+        its hour, its lastIvl is 0 or 21, and its time is the sum of the
+        time of its reviews. The reviews done in the first second of the
+        hour are in a distinct row, whose id is the start of the hour plus
+        one.
+
+        Any query on the revlog whose result only depends on which hour
+        ids are in, and on whether lastIvl is at least 21, gives the same
+        result on this relation, with count() replaced by sum(n), as long
+        as the hours end at a day boundary.
+
+        dids -- the ids of the decks whose cards' reviews are kept, or
+        None for all reviews.
+        cut -- the day cutoff.
+        since -- if not None, a day boundary, in milliseconds. The rows of
+        reviews whose id is not greater may be omitted.
+
+        check() must have been called."""
+        upto = cut - 86400
+        end = "(hour * 3600 + %d)" % (cut % 3600)
+        lim = rlim = ""
+        if since is not None:
+            lim += " and hour > %d" % ((since // 1000 - cut % 3600) // 3600)
+            rlim += " and id > %d" % since
+        if dids is not None:
+            lim += " and did in %s" % ids2str(dids)
+            rlim += " and cid in (select id from cards where did in %s)" % (
+                ids2str(dids))
+        return """(
+select %(end)s * 1000 as id, type, ease, mature * 21 as lastIvl,
+n - early as n, time from revlog_stats where %(end)s <= %(upto)d %(lim)s
+union all
+select (%(end)s - 3600) * 1000 + 1, type, ease, mature * 21, early, 0
+from revlog_stats where early > 0 and %(end)s <= %(upto)d %(lim)s
+union all
+select id, type, ease, lastIvl, 1, time from revlog
+where id > %(upto)d000 %(rlim)s)""" % dict(
+            end=end, upto=upto, lim=lim, rlim=rlim)
@@ -13,6 +13,7 @@ from anki.utils import ids2str, intTime, fmtTimeSpan
 from anki.lang import _
 from anki.consts import *
 from anki.hooks import runHook
+from anki.cards import Card
 
 # queue types: 0=new/cram, 1=lrn, 2=rev, 3=day lrn, -1=suspended, -2=buried
 # revlog types: 0=lrn, 1=rev, 2=relrn, 3=cram
@@ -40,10 +41,16 @@ class Scheduler:
     def __init__(self, col):
         self.col = col
         self.queueLimit = 50
+        # number of cards of each queue loaded at once
+        self.prefetchLimit = 10
         self.reportLimit = 1000
         self.reps = 0
         self.today = None
         self._haveQueues = False
+        # dictionnary associating to ids the cards loaded in advance
+        self._prefetched = {}
+        # id of the last entry added to the revlog, None if not yet read
+        self._lastLogId = None
         self._updateCutoff()
 
     def getCard(self):
@@ -67,6 +74,9 @@ class Scheduler:
         empty queues. Set haveQueues to true
         """
         self._updateCutoff()
+        self._dropPrefetched()
+        # the revlog may have been synced
+        self._lastLogId = None
         self._resetLrn()
         self._resetRev()
         self._resetNew()
@@ -173,6 +183,7 @@ order by due""" % (self._deckLimit()),
 
     def unburyCards(self):
         "Unbury cards."
+        self._dropPrefetched()
         self.col.conf['lastUnburied'] = self.today
         self.col.log(
             self.col.db.list(f"select id from cards where queue = {QUEUE_USER_BURIED}"))
@@ -180,6 +191,7 @@ order by due""" % (self._deckLimit()),
             f"update cards set queue=type where queue = {QUEUE_USER_BURIED}")
 
     def unburyCardsForDeck(self):
+        self._dropPrefetched()
         sids = ids2str(self.col.decks.active())
         self.col.log(
             self.col.db.list(f"select id from cards where queue = {QUEUE_USER_BURIED} and did in %s"
@@ -273,33 +285,67 @@ order by due""" % (self._deckLimit()),
                 return None
             parts = parts[:-1]
             return "::".join(parts)
+        # raw per-deck counts, from a single scan of the cards
+        counts = self._deckDueCounts()
         for deck in decks:
             p = parent(deck['name'])
+            did = deck['id']
+            rawNew, lrn, lrnRows, rawRev = counts.get(did, (0, 0, 0, 0))
             # new
             #nlim -- maximal number of new card, taking parent into account
             nlim = self._deckNewLimitSingle(deck)
             if p:
                 nlim = min(nlim, lims[p][0])
-            new = self._newForDeck(deck['id'], nlim)
+            new = min(rawNew, nlim, self.reportLimit)
             # learning
-            lrn = self._lrnForDeck(deck['id'])
+            if lrnRows > self.reportLimit:
+                # the sum depends on which rows the limit keeps
+                lrn = self._lrnForDeck(did)
             # reviews
             #rlim -- maximal number of review, taking parent into account
             rlim = self._deckRevLimitSingle(deck)
             if p:
                 rlim = min(rlim, lims[p][1])
-            rev = self._revForDeck(deck['id'], rlim)
+            rev = min(rawRev, rlim, self.reportLimit)
             # save to list
-            data.append([deck['name'], deck['id'], rev, lrn, new])
+            data.append([deck['name'], did, rev, lrn, new])
             # add deck as a parent
             lims[deck['name']] = [nlim, rlim]
         return data
 
+    def _deckDueCounts(self):
+        """Dictionnary associating to each deck id containing cards the
+        tuple (new, lrn, lrnRows, rev), computed by a single grouped
+        scan of the cards.
+
+        new -- number of new cards, without limit
+        lrn -- number of learning steps due today, capped like
+        _lrnForDeck
+        lrnRows -- number of cards in the sub-day learning queue due
+        before the collapse time. Above self.reportLimit, lrn is not
+        the value _lrnForDeck would return.
+        rev -- number of reviews due today, without limit"""
+        lrnCutoff = intTime() + self.col.conf['collapseTime']
+        counts = {}
+        rows = self.col.db.execute(f"""
+select did,
+sum(queue = {QUEUE_NEW_CRAM}),
+sum(case when queue = {QUEUE_LRN} and due < :lrnCutoff then left/1000 end),
+sum(queue = {QUEUE_LRN} and due < :lrnCutoff),
+sum(queue = {QUEUE_DAY_LRN} and due <= :today),
+sum(queue = {QUEUE_REV} and due <= :today)
+from cards where queue between {QUEUE_NEW_CRAM} and {QUEUE_DAY_LRN}
+group by did""", lrnCutoff=lrnCutoff, today=self.today)
+        for (did, new, lrnSteps, lrnRows, dayLrn, rev) in rows:
+            lrn = (lrnSteps or 0) + min(dayLrn, self.reportLimit)
+            counts[did] = (new, lrn, lrnRows, rev)
+        return counts
+
     def deckDueTree(self):
         """Generate the node of the main deck. See deckbroser introduction to see what a node is
         """
         #something similar to nodes, but without the recursive part
-        nodes_=self.deckDueList()
+        nodes=self.deckDueList()
         #the actual nodes
         nodes=self._groupChildren(nodes)
         return nodes
@@ -394,6 +440,56 @@ order by due""" % (self._deckLimit()),
         # collapse or finish
         return self._getLrnCard(collapse=True)
 
+    # Prefetching cards
+    ##########################################################################
+
+    def _loadCard(self, id):
+        """The card id, popped from the prefetched cards. When it isn't
+        there, it is loaded with the next cards of the queues."""
+        if id not in self._prefetched:
+            self._prefetch(id)
+        return self._prefetched.pop(id, None) or self.col.getCard(id)
+
+    def _prefetch(self, id):
+        """Load with a single query the card id and the next prefetchLimit
+        cards of each queue, unless they are already prefetched."""
+        lim = self.prefetchLimit
+        ids = [id]
+        for queue in (self._newQueue, self._revQueue, self._lrnDayQueue):
+            ids += queue[max(0, len(queue) - lim):]
+        ids += [cid for (due, cid) in nsmallest(lim, self._lrnQueue)]
+        ids = [cid for cid in ids if cid not in self._prefetched]
+        for row in self.col.db.execute(
+                "select * from cards where id in " + ids2str(ids)):
+            self._prefetched[row[0]] = Card(self.col, row=row)
+
+    def _dropPrefetched(self, cids=None):
+        """Forget the prefetched cards whose id is in cids, or all of them,
+        as they are modified."""
+        if cids is None:
+            self._prefetched = {}
+        else:
+            for cid in cids:
+                self._prefetched.pop(cid, None)
+
+    def upcomingCards(self):
+        """The cards getCard() may return next, in order to render them in
+        advance. They are the cards at the head of each queue, and are
+        returned by getCard() with what they have already computed."""
+        if not self._haveQueues:
+            return []
+        ids = [queue[-1] for queue in (
+            self._newQueue, self._revQueue, self._lrnDayQueue) if queue]
+        if self._lrnQueue:
+            ids.append(self._lrnQueue[0][1])
+        cards = []
+        for id in ids:
+            if id not in self._prefetched:
+                self._prefetch(id)
+            if id in self._prefetched:
+                cards.append(self._prefetched[id])
+        return cards
+
     # New cards
     ##########################################################################
 
@@ -438,7 +534,7 @@ did = ? and queue = {QUEUE_NEW_CRAM} limit ?)""", did, lim)
     def _getNewCard(self):
         if self._fillNew():
             self.newCount -= 1
-            return self.col.getCard(self._newQueue.pop())
+            return self._loadCard(self._newQueue.pop())
 
     def _updateNewCardRatio(self):
         """set newCardModulus so that new cards are regularly mixed with review cards. At least 2.
@@ -487,7 +583,7 @@ did = ? and queue = {QUEUE_NEW_CRAM} limit ?)""", did, lim)
         if not lim:
             return 0
         lim = min(lim, self.reportLimit)
-        return self.col.db.scalar("""
+        return self.col.db.scalar(f"""
 select count() from
 (select 1 from cards where did = ? and queue = {QUEUE_NEW_CRAM} limit ?)""", did, lim)
 
@@ -550,7 +646,7 @@ limit %d""" % (self._deckLimit(), self.reportLimit), lim=self.dayCutoff)
                 cutoff += self.col.conf['collapseTime']
             if self._lrnQueue[0][0] < cutoff:
                 id = heappop(self._lrnQueue)[1]
-                card = self.col.getCard(id)
+                card = self._loadCard(id)
                 self.lrnCount -= card.left // 1000
                 return card
 
@@ -582,7 +678,7 @@ did = ? and queue = {QUEUE_DAY_LRN} and due <= ? limit ?""",
     def _getLrnDayCard(self):
         if self._fillLrnDay():
             self.lrnCount -= 1
-            return self.col.getCard(self._lrnDayQueue.pop())
+            return self._loadCard(self._lrnDayQueue.pop())
 
     def _answerLrnCard(self, card, ease):
         # ease 1=no, 2=yes, 3=remove
@@ -792,17 +888,7 @@ did = ? and queue = {QUEUE_DAY_LRN} and due <= ? limit ?""",
     def _logLrn(self, card, ease, conf, leaving, type, lastLeft):
         lastIvl = -(self._delayForGrade(conf, lastLeft))
         ivl = card.ivl if leaving else -(self._delayForGrade(conf, card.left))
-        def log():
-            self.col.db.execute(
-                "insert into revlog values (?,?,?,?,?,?,?,?,?)",
-                int(time.time()*1000), card.id, self.col.usn(), ease,
-                ivl, lastIvl, card.factor, card.timeTaken(), type)
-        try:
-            log()
-        except:
-            # duplicate pk; retry in 10ms
-            time.sleep(0.01)
-            log()
+        self._logReview(card, ease, ivl, lastIvl, type)
 
     def removeLrn(self, ids=None):
         "Remove cards from the learning queues."
@@ -921,7 +1007,7 @@ did = ? and queue = {QUEUE_REV} and due <= ? limit ?""",
     def _getRevCard(self):
         if self._fillRev():
             self.revCount -= 1
-            return self.col.getCard(self._revQueue.pop())
+            return self._loadCard(self._revQueue.pop())
 
     def totalRevForCurrentDeck(self):
         return self.col.db.scalar(
@@ -1040,19 +1126,20 @@ select id from cards where did in %s and queue = {QUEUE_REV} and due <= ? limit
             card.odue = 0
 
     def _logRev(self, card, ease, delay):
-        """Log this review. Retry once if failed"""
-        def log():
-            self.col.db.execute(
-                "insert into revlog values (?,?,?,?,?,?,?,?,?)",
-                int(time.time()*1000), card.id, self.col.usn(), ease,
-                -delay or card.ivl, card.lastIvl, card.factor, card.timeTaken(),
-                1)
-        try:
-            log()
-        except:
-            # duplicate pk; retry in 10ms
-            time.sleep(0.01)
-            log()
+        """Log this review."""
+        self._logReview(card, ease, -delay or card.ivl, card.lastIvl, 1)
+
+    def _logReview(self, card, ease, ivl, lastIvl, type):
+        """Add the review of card to the revlog, with an id greater than
+        the ones of the previous reviews. The insert is deferred."""
+        if self._lastLogId is None:
+            self._lastLogId = self.col.db.scalar(
+                "select max(id) from revlog") or 0
+        self._lastLogId = max(int(time.time()*1000), self._lastLogId + 1)
+        self.col.db.defer(
+            "insert into revlog values (?,?,?,?,?,?,?,?,?)",
+            self._lastLogId, card.id, self.col.usn(), ease, ivl, lastIvl,
+            card.factor, card.timeTaken(), type)
 
     # Interval management
     ##########################################################################
@@ -1187,6 +1274,7 @@ select id from cards where did in %s and queue = {QUEUE_REV} and due <= ? limit
         lim -- the query which decides which cards are used
         did -- assuming lim is not provided/false, the (filtered) deck concerned by this call
         """
+        self._dropPrefetched()
         if not lim:
             lim = "did = %s" % did
         self.col.log(self.col.db.list("select id from cards where %s" % lim))
@@ -1398,8 +1486,7 @@ did = ?, queue = %s, due = ?, usn = ? where id = ?""" % queue, data)
                 key = t+"Today"
                 if g[key][0] != self.today:
                     g[key] = [self.today, 0]
-        for deck in self.col.decks.all():
-            update(deck)
+        self.col.decks.updateAll(update)
         # unbury if the day has rolled over
         unburied = self.col.conf.get("lastUnburied", 0)
         if unburied < self.today:
@@ -1519,6 +1606,7 @@ To study outside of the normal schedule, click the Custom Study button below."""
 
     def suspendCards(self, ids):
         "Suspend cards."
+        self._dropPrefetched(ids)
         self.col.log(ids)
         self.remFromDyn(ids)
         self.removeLrn(ids)
@@ -1528,6 +1616,7 @@ To study outside of the normal schedule, click the Custom Study button below."""
 
     def unsuspendCards(self, ids):
         "Unsuspend cards."
+        self._dropPrefetched(ids)
         self.col.log(ids)
         self.col.db.execute(
             (f"update cards set queue=type,mod=?,usn=? "
@@ -1535,6 +1624,7 @@ To study outside of the normal schedule, click the Custom Study button below."""
             intTime(), self.col.usn())
 
     def buryCards(self, cids):
+        self._dropPrefetched(cids)
         self.col.log(cids)
         self.remFromDyn(cids)
         self.removeLrn(cids)
@@ -1584,12 +1674,14 @@ and (queue={QUEUE_NEW_CRAM} or (queue={QUEUE_REV} and due<=?))""",
                 (f"update cards set queue={QUEUE_USER_BURIED},mod=?,usn=? where id in ")+ids2str(toBury),
                 intTime(), self.col.usn())
             self.col.log(toBury)
+            self._dropPrefetched(toBury)
 
     # Resetting
     ##########################################################################
 
     def forgetCards(self, ids):
         "Put cards at the end of the new queue."
+        self._dropPrefetched(ids)
         self.remFromDyn(ids)
         self.col.db.execute(
             (f"update cards set type={CARD_NEW},queue={QUEUE_NEW_CRAM},ivl=0,due=0,odue=0,factor=?"
@@ -1602,6 +1694,7 @@ and (queue={QUEUE_NEW_CRAM} or (queue={QUEUE_REV} and due<=?))""",
 
     def reschedCards(self, ids, imin, imax):
         "Put cards in review queue with a new interval in days (min, max)."
+        self._dropPrefetched(ids)
         d = []
         t = self.today
         mod = intTime()
@@ -1636,6 +1729,7 @@ usn=:usn,mod=:mod,factor=:fact where id=:id""",
     ##########################################################################
 
     def sortCards(self, cids, start=1, step=1, shuffle=False, shift=False):
+        self._dropPrefetched()
         scids = ids2str(cids)
         now = intTime()
         nids = []
@@ -10,9 +10,11 @@ from heapq import *
 import datetime
 
 from anki.utils import ids2str, intTime, fmtTimeSpan
+from anki.db import DBError
 from anki.lang import _
 from anki.consts import *
 from anki.hooks import runHook
+from anki.cards import Card
 
 # card types: 0=new, 1=lrn, 2=rev, 3=relrn
 # queue types: 0=new, 1=(re)lrn, 2=rev, 3=day (re)lrn,
@@ -29,11 +31,17 @@ class Scheduler:
     def __init__(self, col):
         self.col = col
         self.queueLimit = 50
+        # number of cards of each queue loaded at once
+        self.prefetchLimit = 10
         self.reportLimit = 1000
         self.dynReportLimit = 99999
         self.reps = 0
         self.today = None
         self._haveQueues = False
+        # dictionnary associating to ids the cards loaded in advance
+        self._prefetched = {}
+        # id of the last entry added to the revlog, None if not yet read
+        self._lastLogId = None
         self._lrnCutoff = 0
         self._updateCutoff()
 
@@ -53,6 +61,9 @@ class Scheduler:
 
     def reset(self):
         self._updateCutoff()
+        self._dropPrefetched()
+        # the revlog may have been synced
+        self._lastLogId = None
         self._resetLrn()
         self._resetRev()
         self._resetNew()
@@ -200,6 +211,82 @@ order by due""" % (self._deckLimit(), QUEUE_REV),
             tot += cnt
         return tot
 
+    # Counts cache
+    ##########################################################################
+
+    # The number of new cards and of review cards due today of each deck
+    # are kept in the temporary table sched_counts, so that reset() doesn't
+    # need to count them again. Triggers on the table cards keep it up to
+    # date, whatever modifies the cards: answering, burying, suspending,
+    # moving them to another deck, editing, importing or syncing. As it is
+    # in the same database, it is also rolled back with the cards. It is
+    # counted again when the day changes, and when the temporary tables
+    # are lost, e.g. because the collection was reopened.
+
+    _countTriggers = ("sched_counts_insert", "sched_counts_delete",
+                      "sched_counts_update_old", "sched_counts_update_new")
+
+    def _dueCounts(self):
+        """Dictionnary associating to (did, queue) the number of cards of
+        the deck did in the queue QUEUE_NEW_CRAM, or in the queue
+        QUEUE_REV and due today."""
+        try:
+            today = self.col.db.scalar(
+                "select today from temp.sched_counts_today")
+        except DBError:
+            today = None
+        if today != self.today:
+            self._buildCounts()
+        return dict(((did, queue), n) for (did, queue, n) in
+                    self.col.db.execute(
+                        "select did, queue, n from temp.sched_counts"))
+
+    def _buildCounts(self):
+        "Count the cards of each deck, and create the triggers."
+        self._dropCounts()
+        db = self.col.db
+        # so that the delete trigger runs on "insert or replace"
+        db.execute("pragma recursive_triggers = on")
+        db.execute("create temp table sched_counts_today as select %d as today"
+                   % self.today)
+        db.execute("""
+create temp table sched_counts as select did, queue, count() as n
+from cards where %s group by did, queue""" % self._countedSql(""))
+        db.execute("create unique index temp.ix_sched_counts on "
+                   "sched_counts (did, queue)")
+        # not "insert or ignore", as the conflict clause of the statement
+        # modifying the cards would override it
+        add = """
+insert into sched_counts select new.did, new.queue, 0 where not exists
+(select 1 from sched_counts where did = new.did and queue = new.queue);
+update sched_counts set n = n + 1
+where did = new.did and queue = new.queue;"""
+        remove = """
+update sched_counts set n = n - 1
+where did = old.did and queue = old.queue;"""
+        for (name, event, row, body) in zip(
+                self._countTriggers,
+                ("insert", "delete", "update of did, queue, due",
+                 "update of did, queue, due"),
+                ("new", "old", "old", "new"),
+                (add, remove, remove, add)):
+            db.execute("""
+create temp trigger %s after %s on cards when %s
+begin %s end""" % (name, event, self._countedSql(row + "."), body))
+
+    def _dropCounts(self):
+        "Drop the counts and their triggers; they are counted again."
+        for name in self._countTriggers:
+            self.col.db.execute("drop trigger if exists temp." + name)
+        self.col.db.execute("drop table if exists temp.sched_counts")
+        self.col.db.execute("drop table if exists temp.sched_counts_today")
+
+    def _countedSql(self, prefix):
+        """The condition on the columns, prefixed by prefix, of the cards
+        counted in sched_counts."""
+        return "(%squeue = %d or (%squeue = %d and %sdue <= %d))" % (
+            prefix, QUEUE_NEW_CRAM, prefix, QUEUE_REV, prefix, self.today)
+
     # Deck list
     ##########################################################################
 
@@ -218,28 +305,61 @@ order by due""" % (self._deckLimit(), QUEUE_REV),
             parts = parts[:-1]
             return "::".join(parts)
         childMap = self.col.decks.childMap()
+        # raw per-deck counts, from a single scan of the cards
+        counts = self._deckDueCounts()
+        # reviews are counted over the whole subtree; children sort
+        # after their parents, so walk the decks backward
+        revTotals = {}
+        for deck in reversed(decks):
+            did = deck['id']
+            revTotals[did] = counts.get(did, (0, 0, 0))[2] + sum(
+                revTotals[child] for child in childMap[did])
         for deck in decks:
             p = parent(deck['name'])
+            did = deck['id']
+            rawNew, lrn = counts.get(did, (0, 0, 0))[:2]
             # new
             nlim = self._deckNewLimitSingle(deck)
             if p:
                 nlim = min(nlim, lims[p][0])
-            new = self._newForDeck(deck['id'], nlim)
-            # learning
-            lrn = self._lrnForDeck(deck['id'])
+            new = min(rawNew, nlim, self.reportLimit)
             # reviews
             if p:
                 plim = lims[p][1]
             else:
                 plim = None
             rlim = self._deckRevLimitSingle(deck, parentLimit=plim)
-            rev = self._revForDeck(deck['id'], rlim, childMap)
+            rev = min(revTotals[did], rlim, self.reportLimit)
             # save to list
-            data.append([deck['name'], deck['id'], rev, lrn, new])
+            data.append([deck['name'], did, rev, lrn, new])
             # add deck as a parent
             lims[deck['name']] = [nlim, rlim]
         return data
 
+    def _deckDueCounts(self):
+        """Dictionnary associating to each deck id containing cards the
+        tuple (new, lrn, rev), computed by a single grouped scan of the
+        cards.
+
+        new -- number of new cards, without limit
+        lrn -- learning count, capped like _lrnForDeck
+        rev -- number of reviews due today in this deck only, without
+        limit"""
+        lrnCutoff = intTime() + self.col.conf['collapseTime']
+        counts = {}
+        rows = self.col.db.execute(f"""
+select did,
+sum(queue = {QUEUE_NEW_CRAM}),
+sum(queue = {QUEUE_LRN} and due < :lrnCutoff),
+sum(queue = {QUEUE_DAY_LRN} and due <= :today),
+sum(queue = {QUEUE_REV} and due <= :today)
+from cards where queue between {QUEUE_NEW_CRAM} and {QUEUE_DAY_LRN}
+group by did""", lrnCutoff=lrnCutoff, today=self.today)
+        for (did, new, lrn, dayLrn, rev) in rows:
+            lrn = min(lrn, self.reportLimit) + min(dayLrn, self.reportLimit)
+            counts[did] = (new, lrn, rev)
+        return counts
+
     def deckDueTree(self):
         return self._groupChildren(self.deckDueList())
 
@@ -328,13 +448,62 @@ order by due""" % (self._deckLimit(), QUEUE_REV),
         # collapse or finish
         return self._getLrnCard(collapse=True)
 
+    # Prefetching cards
+    ##########################################################################
+
+    def _loadCard(self, id):
+        """The card id, popped from the prefetched cards. When it isn't
+        there, it is loaded with the next cards of the queues."""
+        if id not in self._prefetched:
+            self._prefetch(id)
+        return self._prefetched.pop(id, None) or self.col.getCard(id)
+
+    def _prefetch(self, id):
+        """Load with a single query the card id and the next prefetchLimit
+        cards of each queue, unless they are already prefetched."""
+        lim = self.prefetchLimit
+        ids = [id]
+        for queue in (self._newQueue, self._revQueue, self._lrnDayQueue):
+            ids += queue[max(0, len(queue) - lim):]
+        ids += [cid for (due, cid) in nsmallest(lim, self._lrnQueue)]
+        ids = [cid for cid in ids if cid not in self._prefetched]
+        for row in self.col.db.execute(
+                "select * from cards where id in " + ids2str(ids)):
+            self._prefetched[row[0]] = Card(self.col, row=row)
+
+    def _dropPrefetched(self, cids=None):
+        """Forget the prefetched cards whose id is in cids, or all of them,
+        as they are modified."""
+        if cids is None:
+            self._prefetched = {}
+        else:
+            for cid in cids:
+                self._prefetched.pop(cid, None)
+
+    def upcomingCards(self):
+        """The cards getCard() may return next, in order to render them in
+        advance. They are the cards at the head of each queue, and are
+        returned by getCard() with what they have already computed."""
+        if not self._haveQueues:
+            return []
+        ids = [queue[-1] for queue in (
+            self._newQueue, self._revQueue, self._lrnDayQueue) if queue]
+        if self._lrnQueue:
+            ids.append(self._lrnQueue[0][1])
+        cards = []
+        for id in ids:
+            if id not in self._prefetched:
+                self._prefetch(id)
+            if id in self._prefetched:
+                cards.append(self._prefetched[id])
+        return cards
+
     # New cards
     ##########################################################################
 
     def _resetNewCount(self):
-        cntFn = lambda did, lim: self.col.db.scalar(("""
-select count() from (select 1 from cards where
-did = ? and queue = %d limit ?)"""%QUEUE_NEW_CRAM), did, lim)
+        counts = self._dueCounts()
+        cntFn = lambda did, lim: min(counts.get((did, QUEUE_NEW_CRAM), 0), lim)
         self.newCount = self._walkingCount(self._deckNewLimitSingle, cntFn)
 
     def _resetNew(self):
@@ -370,7 +539,7 @@ did = ? and queue = %d limit ?)"""%QUEUE_NEW_CRAM), did, lim)
     def _getNewCard(self):
         if self._fillNew():
             self.newCount -= 1
-            return self.col.getCard(self._newQueue.pop())
+            return self._loadCard(self._newQueue.pop())
 
     def _updateNewCardRatio(self):
         if self.col.conf['newSpread'] == NEW_CARDS_DISTRIBUTE:
@@ -493,7 +662,7 @@ limit %d""" % (self._deckLimit(), QUEUE_LRN, QUEUE_PREVIEW, self.reportLimit), l
                 cutoff += self.col.conf['collapseTime']
             if self._lrnQueue[0][0] < cutoff:
                 id = heappop(self._lrnQueue)[1]
-                card = self.col.getCard(id)
+                card = self._loadCard(id)
                 self.lrnCount -= 1
                 return card
 
@@ -525,7 +694,7 @@ did = ? and queue = %d and due <= ? limit ?"""% QUEUE_DAY_LRN),
     def _getLrnDayCard(self):
         if self._fillLrnDay():
             self.lrnCount -= 1
-            return self.col.getCard(self._lrnDayQueue.pop())
+            return self._loadCard(self._lrnDayQueue.pop())
 
     def _answerLrnCard(self, card, ease):
         conf = self._lrnConf(card)
@@ -703,17 +872,7 @@ did = ? and queue = %d and due <= ? limit ?"""% QUEUE_DAY_LRN),
     def _logLrn(self, card, ease, conf, leaving, type, lastLeft):
         lastIvl = -(self._delayForGrade(conf, lastLeft))
         ivl = card.ivl if leaving else -(self._delayForGrade(conf, card.left))
-        def log():
-            self.col.db.execute(
-                "insert into revlog values (?,?,?,?,?,?,?,?,?)",
-                int(time.time()*1000), card.id, self.col.usn(), ease,
-                ivl, lastIvl, card.factor, card.timeTaken(), type)
-        try:
-            log()
-        except:
-            # duplicate pk; retry in 10ms
-            time.sleep(0.01)
-            log()
+        self._logReview(card, ease, ivl, lastIvl, type)
 
     def _lrnForDeck(self, did):
         cnt = self.col.db.scalar(
@@ -767,11 +926,11 @@ and due <= ? limit ?)""" % (ids2str(dids), QUEUE_REV),
             self.today, lim)
 
     def _resetRevCount(self):
+        counts = self._dueCounts()
         lim = self._currentRevLimit()
-        self.revCount = self.col.db.scalar("""
-select count() from (select id from cards where
-did in %s and queue = %d and due <= ? limit %d)""" % (
-            ids2str(self.col.decks.active()), QUEUE_REV, lim), self.today)
+        self.revCount = min(lim, sum(
+            counts.get((did, QUEUE_REV), 0)
+            for did in self.col.decks.active()))
 
     def _resetRev(self):
         self._resetRevCount()
@@ -813,7 +972,7 @@ limit ?""" % (ids2str(self.col.decks.active()), QUEUE_REV),
     def _getRevCard(self):
         if self._fillRev():
             self.revCount -= 1
-            return self.col.getCard(self._revQueue.pop())
+            return self._loadCard(self._revQueue.pop())
 
     def totalRevForCurrentDeck(self):
         return self.col.db.scalar(
@@ -879,18 +1038,19 @@ select id from cards where did in %s and queue = %d and due <= ? limit ?)"""
         self._removeFromFiltered(card)
 
     def _logRev(self, card, ease, delay, type):
-        def log():
-            self.col.db.execute(
-                "insert into revlog values (?,?,?,?,?,?,?,?,?)",
-                int(time.time()*1000), card.id, self.col.usn(), ease,
-                -delay or card.ivl, card.lastIvl, card.factor, card.timeTaken(),
-                type)
-        try:
-            log()
-        except:
-            # duplicate pk; retry in 10ms
-            time.sleep(0.01)
-            log()
+        self._logReview(card, ease, -delay or card.ivl, card.lastIvl, type)
+
+    def _logReview(self, card, ease, ivl, lastIvl, type):
+        """Add the review of card to the revlog, with an id greater than
+        the ones of the previous reviews. The insert is deferred."""
+        if self._lastLogId is None:
+            self._lastLogId = self.col.db.scalar(
+                "select max(id) from revlog") or 0
+        self._lastLogId = max(int(time.time()*1000), self._lastLogId + 1)
+        self.col.db.defer(
+            "insert into revlog values (?,?,?,?,?,?,?,?,?)",
+            self._lastLogId, card.id, self.col.usn(), ease, ivl, lastIvl,
+            card.factor, card.timeTaken(), type)
 
     # Interval management
     ##########################################################################
@@ -1027,6 +1187,7 @@ select id from cards where did in %s and queue = %d and due <= ? limit ?)"""
         return total
 
     def emptyDyn(self, did, lim=None):
+        self._dropPrefetched()
         if not lim:
             lim = "did = %s" % did
         self.col.log(self.col.db.list("select id from cards where %s" % lim))
@@ -1211,8 +1372,7 @@ where id = ?
                 key = t+"Today"
                 if g[key][0] != self.today:
                     g[key] = [self.today, 0]
-        for deck in self.col.decks.all():
-            update(deck)
+        self.col.decks.updateAll(update)
         # unbury if the day has rolled over
         unburied = self.col.conf.get("lastUnburied", 0)
         if unburied < self.today:
@@ -1378,6 +1538,7 @@ end)
 
     def suspendCards(self, ids):
         "Suspend cards."
+        self._dropPrefetched(ids)
         self.col.log(ids)
         self.col.db.execute(
             ("update cards set queue=%d,mod=?,usn=? where id in "%QUEUE_SUSPENDED)+
@@ -1385,6 +1546,7 @@ end)
 
     def unsuspendCards(self, ids):
         "Unsuspend cards."
+        self._dropPrefetched(ids)
         self.col.log(ids)
         self.col.db.execute(
             ("update cards set %s,mod=?,usn=? "
@@ -1392,6 +1554,7 @@ end)
             intTime(), self.col.usn())
 
     def buryCards(self, cids, manual=True):
+        self._dropPrefetched(cids)
         queue = manual and QUEUE_SCHED_BURIED or QUEUE_USER_BURIED
         self.col.log(cids)
         self.col.db.execute("""
@@ -1406,12 +1569,14 @@ update cards set queue=?,mod=?,usn=? where id in """+ids2str(cids),
 
     def unburyCards(self):
         "Unbury all buried cards in all decks."
+        self._dropPrefetched()
         self.col.log(
             self.col.db.list("select id from cards where queue in (%d,%d)"%(QUEUE_SCHED_BURIED, QUEUE_USER_BURIED)))
         self.col.db.execute(
             "update cards set %s where queue in (%d, %d)" % (self._restoreQueueSnippet,QUEUE_SCHED_BURIED, QUEUE_USER_BURIED))
 
     def unburyCardsForDeck(self, type="all"):
+        self._dropPrefetched()
         if type == "all":
             queue = "queue in (%d, %d)" % (QUEUE_USER_BURIED, QUEUE_SCHED_BURIED)
         elif type == "manual":
@@ -1468,6 +1633,7 @@ and (queue=%d or (queue=%d and due<=?))"""%(QUEUE_NEW_CRAM, QUEUE_REV),
 
     def forgetCards(self, ids):
         "Put cards at the end of the new queue."
+        self._dropPrefetched(ids)
         self.remFromDyn(ids)
         self.col.db.execute(
             ("update cards set type=%d,queue=%d,ivl=0,due=0,odue=0,factor=?"
@@ -1480,6 +1646,7 @@ and (queue=%d or (queue=%d and due<=?))"""%(QUEUE_NEW_CRAM, QUEUE_REV),
 
     def reschedCards(self, ids, imin, imax):
         "Put cards in review queue with a new interval in days (min, max)."
+        self._dropPrefetched(ids)
         d = []
         t = self.today
         mod = intTime()
@@ -1514,6 +1681,7 @@ usn=:usn,mod=:mod,factor=:fact where id=:id"""%(CARD_DUE, QUEUE_REV),
     ##########################################################################
 
     def sortCards(self, cids, start=1, step=1, shuffle=False, shift=False):
+        self._dropPrefetched()
         scids = ids2str(cids)
         now = intTime()
         nids = []
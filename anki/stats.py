@@ -5,9 +5,13 @@
 import time
 import datetime
 import json
+import copy
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from anki.utils import fmtTimeSpan, ids2str
 from anki.lang import _, ngettext
+from anki.db import DBError
 
 
 # Card stats
@@ -99,34 +103,62 @@ colSusp = "#ff0"
 
 class CollectionStats:
 
+    """
+    col -- the collection
+    db -- the connection the queries are run on; the collection's one,
+    unless the section is computed by a ParallelReport.
+    _prepared -- whether the aggregates of the revlog are known to be up
+    to date.
+    """
+
+    # the methods returning the sections of the report, in order
+    sections = ("todayStats", "dueGraph", "repsGraphs", "introductionGraph",
+                "ivlGraph", "hourGraph", "easeGraph", "cardGraph", "footer")
+
     def __init__(self, col):
         self.col = col
+        self.db = col.db
+        self._prepared = False
         self._stats = None
         self.type = 0
         self.width = 600
         self.height = 200
         self.wholeCollection = False
+        # whether the graphs read the aggregates of the revlog, instead of
+        # every review
+        self.useRevlogStats = True
 
     # assumes jquery & plot are available in document
     def report(self, type=0):
         # 0=days, 1=weeks, 2=months
         self.type = type
+        return self._assemble(
+            [self._sectionHtml(name) for name in self.sections])
+
+    def _sectionHtml(self, name):
+        "The html of the section computed by the method name."
+        txt = getattr(self, name)()
+        if name == "repsGraphs":
+            # already split in several sections
+            return txt
+        return self._section(txt)
+
+    def _assemble(self, sections):
+        "The report whose sections' html are sections."
         from .statsbg import bg
         txt = self.css % bg
-        txt += self._section(self.todayStats())
-        txt += self._section(self.dueGraph())
-        txt += self.repsGraphs()
-        txt += self._section(self.introductionGraph())
-        txt += self._section(self.ivlGraph())
-        txt += self._section(self.hourGraph())
-        txt += self._section(self.easeGraph())
-        txt += self._section(self.cardGraph())
-        txt += self._section(self.footer())
+        txt += "".join(sections)
         return "<center>%s</center>" % txt
 
     def _section(self, txt):
         return "<div class=section>%s</div>" % txt
 
+    def _prepare(self):
+        "Ensure the aggregates of the revlog are up to date."
+        if not self._prepared and self.useRevlogStats:
+            self.col.revlogStats.check(self.col.sched.dayCutoff)
+        self._prepared = True
+
     css = """
 <style>
 h1 { margin-bottom: 0; margin-top: 1em; }
@@ -147,7 +179,7 @@ body {background-image: url(data:image/png;base64,%s); }
         lim = self._revlogLimit()
         if lim:
             lim = " and " + lim
-        cards, thetime, failed, lrn, rev, relrn, filt = self.col.db.first("""
+        cards, thetime, failed, lrn, rev, relrn, filt = self.db.first("""
 select count(), sum(time)/1000,
 sum(case when ease = 1 then 1 else 0 end), /* failed */
 sum(case when type = 0 then 1 else 0 end), /* learning */
@@ -181,7 +213,7 @@ from revlog where id > ? """+lim, (self.col.sched.dayCutoff-86400)*1000)
             b += (_("Learn: %(a)s, Review: %(b)s, Relearn: %(c)s, Filtered: %(d)s")
                   % dict(a=bold(lrn), b=bold(rev), c=bold(relrn), d=bold(filt)))
             # mature today
-            mcnt, msum = self.col.db.first("""
+            mcnt, msum = self.db.first("""
     select count(), sum(case when ease = 1 then 0 else 1 end) from revlog
     where lastIvl >= 21 and id > ?"""+lim, (self.col.sched.dayCutoff-86400)*1000)
             b += "<br>"
@@ -240,7 +272,7 @@ from revlog where id > ? """+lim, (self.col.sched.dayCutoff-86400)*1000)
         self._line(i, _("Total"), ngettext("%d review", "%d reviews", tot) % tot)
         self._line(i, _("Average"), self._avgDay(
             tot, num, _("reviews")))
-        tomorrow = self.col.db.scalar("""
+        tomorrow = self.db.scalar("""
 select count() from cards where did in %s and queue in (2,3)
 and due = ?""" % self._limit(), self.col.sched.today+1)
         tomorrow = ngettext("%d card", "%d cards", tomorrow) % tomorrow
@@ -253,7 +285,7 @@ and due = ?""" % self._limit(), self.col.sched.today+1)
             lim += " and due-:today >= %d" % start
         if end is not None:
             lim += " and day < %d" % end
-        return self.col.db.all("""
+        return self.db.all("""
 select (due-:today)/:chunk as day,
 sum(case when ivl < 21 then 1 else 0 end), -- yng
 sum(case when ivl >= 21 then 1 else 0 end) -- mtr
@@ -450,7 +482,7 @@ group by day order by day""" % (self._limit(), lim),
             tf = 60.0 # minutes
         else:
             tf = 3600.0 # hours
-        return self.col.db.all("""
+        return self.db.all("""
 select
 (cast((id/1000.0 - :cut) / 86400.0 as int))/:chunk as day,
 count(id)
@@ -459,12 +491,10 @@ group by day order by day""" % lim, cut=self.col.sched.dayCutoff,tf=tf, chunk=ch
 
     def _done(self, num=7, chunk=1):
         lims = []
+        since = None
         if num is not None:
-            lims.append("id > %d" % (
-                (self.col.sched.dayCutoff-(num*chunk*86400))*1000))
-        lim = self._revlogLimit()
-        if lim:
-            lims.append(lim)
+            since = (self.col.sched.dayCutoff-(num*chunk*86400))*1000
+            lims.append("id > %d" % since)
         if lims:
             lim = "where " + " and ".join(lims)
         else:
@@ -473,45 +503,39 @@ group by day order by day""" % lim, cut=self.col.sched.dayCutoff,tf=tf, chunk=ch
             tf = 60.0 # minutes
         else:
             tf = 3600.0 # hours
-        return self.col.db.all("""
+        return self.db.all("""
 select
 (cast((id/1000.0 - :cut) / 86400.0 as int))/:chunk as day,
-sum(case when type = 0 then 1 else 0 end), -- lrn count
-sum(case when type = 1 and lastIvl < 21 then 1 else 0 end), -- yng count
-sum(case when type = 1 and lastIvl >= 21 then 1 else 0 end), -- mtr count
-sum(case when type = 2 then 1 else 0 end), -- lapse count
-sum(case when type = 3 then 1 else 0 end), -- cram count
+sum(case when type = 0 then n else 0 end), -- lrn count
+sum(case when type = 1 and lastIvl < 21 then n else 0 end), -- yng count
+sum(case when type = 1 and lastIvl >= 21 then n else 0 end), -- mtr count
+sum(case when type = 2 then n else 0 end), -- lapse count
+sum(case when type = 3 then n else 0 end), -- cram count
 sum(case when type = 0 then time/1000.0 else 0 end)/:tf, -- lrn time
 -- yng + mtr time
 sum(case when type = 1 and lastIvl < 21 then time/1000.0 else 0 end)/:tf,
 sum(case when type = 1 and lastIvl >= 21 then time/1000.0 else 0 end)/:tf,
 sum(case when type = 2 then time/1000.0 else 0 end)/:tf, -- lapse time
 sum(case when type = 3 then time/1000.0 else 0 end)/:tf -- cram time
-from revlog %s
-group by day order by day""" % lim,
+from %s %s
+group by day order by day""" % (self._revlog(since), lim),
                             cut=self.col.sched.dayCutoff,
                             tf=tf,
                             chunk=chunk)
 
     def _daysStudied(self):
-        lims = []
+        lims = ["n > 0"]
+        since = None
         num = self._periodDays()
         if num:
-            lims.append(
-                "id > %d" %
-                ((self.col.sched.dayCutoff-(num*86400))*1000))
-        rlim = self._revlogLimit()
-        if rlim:
-            lims.append(rlim)
-        if lims:
-            lim = "where " + " and ".join(lims)
-        else:
-            lim = ""
-        return self.col.db.first("""
+            since = (self.col.sched.dayCutoff-(num*86400))*1000
+            lims.append("id > %d" % since)
+        lim = "where " + " and ".join(lims)
+        return self.db.first("""
 select count(), abs(min(day)) from (select
 (cast((id/1000 - :cut) / 86400.0 as int)+1) as day
-from revlog %s
-group by day order by day)""" % lim,
+from %s %s
+group by day order by day)""" % (self._revlog(since), lim),
                                    cut=self.col.sched.dayCutoff)
 
     # Intervals
@@ -553,12 +577,12 @@ group by day order by day)""" % lim,
             chunk = 7; lim = " and grp <= 52"
         else:
             chunk = 30; lim = ""
-        data = [self.col.db.all("""
+        data = [self.db.all("""
 select ivl / :chunk as grp, count() from cards
 where did in %s and queue = 2 %s
 group by grp
 order by grp""" % (self._limit(), lim), chunk=chunk)]
-        return data + list(self.col.db.first("""
+        return data + list(self.db.first("""
 select count(), avg(ivl), max(ivl) from cards where did in %s and queue = 2""" %
                                          self._limit()))
 
@@ -621,18 +645,16 @@ select count(), avg(ivl), max(ivl) from cards where did in %s and queue = 2""" %
 
     def _eases(self):
         lims = []
-        lim = self._revlogLimit()
-        if lim:
-            lims.append(lim)
         if self.type == 0:
             days = 30
         elif self.type == 1:
             days = 365
         else:
             days = None
+        since = None
         if days is not None:
-            lims.append("id > %d" % (
-                (self.col.sched.dayCutoff-(days*86400))*1000))
+            since = (self.col.sched.dayCutoff-(days*86400))*1000
+            lims.append("id > %d" % since)
         if lims:
             lim = "where " + " and ".join(lims)
         else:
@@ -641,14 +663,14 @@ select count(), avg(ivl), max(ivl) from cards where did in %s and queue = 2""" %
             ease4repl = "3"
         else:
             ease4repl = "ease"
-        return self.col.db.all("""
+        return self.db.all("""
 select (case
 when type in (0,2) then 0
 when lastIvl < 21 then 1
 else 2 end) as thetype,
-(case when type in (0,2) and ease = 4 then %s else ease end), count() from revlog %s
+(case when type in (0,2) and ease = 4 then %s else ease end), sum(n) from %s %s
 group by thetype, ease
-order by thetype, ease""" % (ease4repl, lim))
+order by thetype, ease""" % (ease4repl, self._revlog(since), lim))
 
     # Hourly retention
     ######################################################################
@@ -701,25 +723,25 @@ order by thetype, ease""" % (ease4repl, lim))
         return txt
 
     def _hourRet(self):
-        lim = self._revlogLimit()
-        if lim:
-            lim = " and " + lim
+        lim = ""
         if self.col.schedVer() == 1:
             sd = datetime.datetime.fromtimestamp(self.col.crt)
             rolloverHour = sd.hour
         else:
             rolloverHour = self.col.conf.get("rollover", 4)
+        since = None
         pd = self._periodDays()
         if pd:
-            lim += " and id > %d" % ((self.col.sched.dayCutoff-(86400*pd))*1000)
-        return self.col.db.all("""
+            since = (self.col.sched.dayCutoff-(86400*pd))*1000
+            lim += " and id > %d" % since
+        return self.db.all("""
 select
 23 - ((cast((:cut - id/1000) / 3600.0 as int)) %% 24) as hour,
-sum(case when ease = 1 then 0 else 1 end) /
-cast(count() as float) * 100,
-count()
-from revlog where type in (0,1,2) %s
-group by hour having count() > 30 order by hour""" % lim,
+sum(case when ease = 1 then 0 else n end) /
+cast(sum(n) as float) * 100,
+sum(n)
+from %s where type in (0,1,2) %s
+group by hour having sum(n) > 30 order by hour""" % (self._revlog(since), lim),
                             cut=self.col.sched.dayCutoff-(rolloverHour*3600))
 
     # Cards
@@ -737,7 +759,7 @@ group by hour having count() > 30 order by hour""" % lim,
             d.append(dict(data=div[c], label="%s: %s" % (t, div[c]), color=col))
         # text data
         i = []
-        (c, f) = self.col.db.first("""
+        (c, f) = self.db.first("""
 select count(id), count(distinct nid) from cards
 where did in %s """ % self._limit())
         self._line(i, _("Total cards"), c)
@@ -770,7 +792,7 @@ when you answer "good" on a review.''')
         return "<table width=400>" + "".join(i) + "</table>"
 
     def _factors(self):
-        return self.col.db.first("""
+        return self.db.first("""
 select
 min(factor) / 10.0,
 avg(factor) / 10.0,
@@ -778,7 +800,7 @@ max(factor) / 10.0
 from cards where did in %s and queue = 2""" % self._limit())
 
     def _cards(self):
-        return self.col.db.first("""
+        return self.db.first("""
 select
 sum(case when queue=2 and ivl >= 21 then 1 else 0 end), -- mtr
 sum(case when queue in (1,3) or (queue=2 and ivl < 21) then 1 else 0 end), -- yng/lrn
@@ -914,6 +936,27 @@ $(function () {
         return ("cid in (select id from cards where did in %s)" %
                 ids2str(self.col.decks.active()))
 
+    def _revlog(self, since=None):
+        """The reviews of the selected decks, as a relation with the columns
+        id, type, ease, lastIvl, time, and n, the number of reviews a row
+        stands for. See RevlogStats.relation().
+
+        since -- if not None, the reviews whose id is not greater than
+        this day boundary may be omitted."""
+        if not self.useRevlogStats:
+            lim = self._revlogLimit()
+            if lim:
+                lim = "where " + lim
+            return """(
+select id, type, ease, lastIvl, 1 as n, time from revlog %s)""" % lim
+        if self.wholeCollection:
+            dids = None
+        else:
+            dids = self.col.decks.active()
+        self._prepare()
+        return self.col.revlogStats.relation(
+            dids, self.col.sched.dayCutoff, since)
+
     def _title(self, title, subtitle=""):
         return '<h1>%s</h1>%s' % (title, subtitle)
 
@@ -922,10 +965,10 @@ $(function () {
         if lim:
             lim = " where " + lim
         if by == 'review':
-            t = self.col.db.scalar("select id from revlog %s order by id limit 1" % lim)
+            t = self.db.scalar("select id from revlog %s order by id limit 1" % lim)
         elif by == 'add':
             lim = "where did in %s" % ids2str(self.col.decks.active())
-            t = self.col.db.scalar("select id from cards %s order by id limit 1" % lim)
+            t = self.db.scalar("select id from cards %s order by id limit 1" % lim)
         if not t:
             period = 1
         else:
@@ -948,3 +991,107 @@ $(function () {
             return ", ".join(vals)
         except ZeroDivisionError:
             return ""
+
+# Parallel report
+##########################################################################
+
+class ParallelReport:
+
+    """The report of a CollectionStats, whose sections are computed
+    concurrently by a pool of threads, so that the caller doesn't wait
+    for them. Each section is computed on its own read-only connection,
+    which only sees what was committed; start() thus saves the
+    collection.
+
+    stats -- the CollectionStats
+    type -- the period, as in CollectionStats.report()
+    _futures -- dictionnary associating to the name of each section the
+    future of its html.
+    _dbs -- the connections of the sections being computed.
+    """
+
+    def __init__(self, stats, type=0, threads=4):
+        self.stats = stats
+        self.type = type
+        self.threads = threads
+        self._futures = {}
+        self._dbs = set()
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._pool = None
+
+    def supported(self):
+        """Whether the sections can be computed in parallel: the collection
+        is in WAL mode, so that it can be read while the main connection
+        writes, and saving it doesn't lose the undo of an operation."""
+        col = self.stats.col
+        if col.db.scalar("pragma journal_mode") != "wal":
+            return False
+        return not (col.db.mod and col._undo and col._undo[0] == 2)
+
+    def start(self):
+        "Start computing the sections."
+        self.stats.type = self.type
+        # the aggregates and the changes must be committed to be seen
+        self.stats._prepare()
+        self.stats.col.save()
+        self._pool = ThreadPoolExecutor(self.threads)
+        for name in self.stats.sections:
+            self._futures[name] = self._pool.submit(self._sectionHtml, name)
+        self._pool.shutdown(wait=False)
+
+    def _sectionHtml(self, name):
+        "The html of the section name, None if the report was cancelled."
+        if self._cancelled:
+            return None
+        db = self.stats.col.db.readOnly()
+        with self._lock:
+            self._dbs.add(db)
+        try:
+            if self._cancelled:
+                return None
+            stats = copy.copy(self.stats)
+            stats.db = db
+            return stats._sectionHtml(name)
+        except DBError:
+            if self._cancelled:
+                # interrupted
+                return None
+            raise
+        finally:
+            with self._lock:
+                self._dbs.discard(db)
+            db.close()
+
+    def cancel(self):
+        "Stop computing the sections, e.g. because the report was closed."
+        self._cancelled = True
+        for future in self._futures.values():
+            future.cancel()
+        with self._lock:
+            for db in self._dbs:
+                db.interrupt()
+
+    def skeleton(self):
+        """The report, where each section is an empty div whose id is
+        stats-name, name being the name of the section's method."""
+        return self.stats._assemble(
+            ['<div id="stats-%s"></div>' % name
+             for name in self.stats.sections])
+
+    def completed(self):
+        """The list of the (name, html) of the sections computed, in the
+        order of the report. Raise the error of a section which failed."""
+        return [(name, future.result())
+                for name, future in self._futures.items()
+                if future.done() and not future.cancelled()]
+
+    def done(self):
+        "Whether all the sections are computed, or cancelled."
+        return all(f.done() for f in self._futures.values())
+
+    def html(self):
+        "The report, once all its sections are computed."
+        wait(self._futures.values())
+        return self.stats._assemble(
+            [f.result() for f in self._futures.values()])
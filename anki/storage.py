@@ -23,7 +23,7 @@ def Collection(path, lock=True, server=False, log=False):
         for c in ("/", ":", "\\"):
             assert c not in base
     # connect
-    db = DB(path)
+    db = DB(path, timeout=_Collection.busyTimeout)
     db.setAutocommit(True)
     if create:
         ver = _createDB(db)
@@ -206,6 +206,8 @@ def _upgradeClozeModel(col, m):
 def _createDB(db):
     db.execute("pragma page_size = 4096")
     db.execute("pragma legacy_file_format = 0")
+    # so that free pages can be released without rebuilding the database
+    db.execute("pragma auto_vacuum = incremental")
     db.execute("vacuum")
     _addSchema(db)
     _updateIndices(db)
@@ -5,6 +5,8 @@
 import io
 import gzip
 import random
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import requests
 
 from anki.db import DB, DBError
@@ -18,6 +20,8 @@ from .lang import ngettext
 HTTP_TIMEOUT = 90
 HTTP_PROXY = None
 HTTP_BUF_SIZE = 64*1024
+# bodies larger than this are spooled to disk rather than kept in memory
+HTTP_SPOOL_SIZE = 4*1024*1024
 
 # Incremental syncing
 ##########################################################################
@@ -451,7 +455,6 @@ class AnkiRequestsClient:
         self.session = requests.Session()
 
     def post(self, url, data, headers):
-        data = _MonitoringFile(data)
         headers['User-Agent'] = self._agentName()
         return self.session.post(
             url, data=data, headers=headers, stream=True, timeout=self.timeout, verify=self.verify)
@@ -463,13 +466,23 @@ class AnkiRequestsClient:
         return self.session.get(url, stream=True, headers=headers, timeout=self.timeout, verify=self.verify)
 
     def streamContent(self, resp):
+        """The content of the response, as bytes."""
+        with self.streamToFile(resp) as f:
+            return f.read()
+
+    def streamToFile(self, resp, fileobj=None):
+        """Write the content of the response to fileobj, as it is received,
+        and return fileobj, positioned at its start. By default, a
+        temporary file, kept in memory unless the content is large."""
         resp.raise_for_status()
 
-        buf = io.BytesIO()
+        if fileobj is None:
+            fileobj = tempfile.SpooledTemporaryFile(max_size=HTTP_SPOOL_SIZE)
         for chunk in resp.iter_content(chunk_size=HTTP_BUF_SIZE):
             runHook("httpRecv", len(chunk))
-            buf.write(chunk)
-        return buf.getvalue()
+            fileobj.write(chunk)
+        fileobj.seek(0)
+        return fileobj
 
     def _agentName(self):
         """Anki versionNumber"""
@@ -483,9 +496,19 @@ if os.environ.get("ANKI_NOVERIFYSSL"):
     import warnings
     warnings.filterwarnings("ignore")
 
-class _MonitoringFile(io.BufferedReader):
+class _StreamingBody:
+    """A request body, read from the chunks a generator yields. As its
+    size is known in advance, requests sends it with a Content-Length
+    header, reading it as a file, instead of using a chunked encoding."""
+    def __init__(self, chunks, size):
+        self.chunks = chunks
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
     def read(self, size=-1):
-        data = io.BufferedReader.read(self, HTTP_BUF_SIZE)
+        data = next(self.chunks, b"")
         runHook("httpSend", len(data))
         return data
 
@@ -524,6 +547,10 @@ class HttpSyncer:
     # costly. We could send it as a raw post, but more HTTP clients seem to
     # support file uploading, so this is the more compatible choice.
 
+    # The payload is first written, optionally compressed, to a temporary
+    # file, which stays in memory only while it is small; this gives the
+    # size of the body, which is then generated chunk by chunk.
+
     def _buildPostData(self, fobj, comp):
         BOUNDARY=b"Anki-sync-boundary"
         bdry = b"--"+BOUNDARY
@@ -537,41 +564,63 @@ class HttpSyncer:
                 (key, value)).encode("utf8"))
         # payload as raw data or json
         rawSize = 0
+        payload = None
         if fobj:
             # header
             buf.write(bdry + b"\r\n")
             buf.write(b"""\
 Content-Disposition: form-data; name="data"; filename="data"\r\n\
 Content-Type: application/octet-stream\r\n\r\n""")
-            # write file into buffer, optionally compressing
+            # write file into payload, optionally compressing
+            payload = tempfile.SpooledTemporaryFile(max_size=HTTP_SPOOL_SIZE)
             if comp:
-                tgt = gzip.GzipFile(mode="wb", fileobj=buf, compresslevel=comp)
+                tgt = gzip.GzipFile(mode="wb", fileobj=payload,
+                                    compresslevel=comp)
             else:
-                tgt = buf
+                tgt = payload
             while 1:
-                data = fobj.read(65536)
+                data = fobj.read(HTTP_BUF_SIZE)
                 if not data:
                     if comp:
                         tgt.close()
                     break
                 rawSize += len(data)
                 tgt.write(data)
-            buf.write(b"\r\n")
-        buf.write(bdry + b'--\r\n')
-        size = buf.tell()
+        head = buf.getvalue()
+        tail = (b"\r\n" if fobj else b"") + bdry + b'--\r\n'
+        size = len(head) + (payload.tell() if payload else 0) + len(tail)
         # connection headers
         headers = {
             'Content-Type': 'multipart/form-data; boundary=%s' % BOUNDARY.decode("utf8"),
             'Content-Length': str(size),
         }
-        buf.seek(0)
 
         if size >= 100*1024*1024 or rawSize >= 250*1024*1024:
+            if payload:
+                payload.close()
             raise Exception("Collection too large to upload to AnkiWeb.")
 
-        return headers, buf
-
-    def req(self, method, fobj=None, comp=6, badAuthRaises=True):
+        def chunks():
+            yield head
+            if payload:
+                payload.seek(0)
+                with payload:
+                    while 1:
+                        data = payload.read(HTTP_BUF_SIZE)
+                        if not data:
+                            break
+                        yield data
+            yield tail
+
+        return headers, _StreamingBody(chunks(), size)
+
+    def req(self, method, fobj=None, comp=6, badAuthRaises=True,
+            fileobj=None):
+        """The content of the response to the method, as bytes. False if
+        the authentication failed and badAuthRaises is False.
+
+        fileobj -- if set, the content is written to it instead, as it
+        is received, and fileobj is returned."""
         headers, body = self._buildPostData(fobj, comp)
 
         r = self.client.post(self.syncURL()+method, data=body, headers=headers)
@@ -579,6 +628,8 @@ Content-Type: application/octet-stream\r\n\r\n""")
             return False
         self.assertOk(r)
 
+        if fileobj is not None:
+            return self.client.streamToFile(r, fileobj)
         buf = self.client.streamContent(r)
         return buf
 
@@ -661,12 +712,15 @@ class FullSyncer(HttpSyncer):
         runHook("sync", "download")
         localNotEmpty = self.col.db.scalar("select 1 from cards")
         self.col.close()
-        cont = self.req("download")
         tpath = self.col.path + ".tmp"
-        if cont == "upgradeRequired":
+        # the collection is written to disk as it is received
+        with open(tpath, "w+b") as f:
+            self.req("download", fileobj=f)
+            upgradeRequired = f.read(16) == b"upgradeRequired"
+        if upgradeRequired:
+            os.unlink(tpath)
             runHook("sync", "upgradeRequired")
             return
-        open(tpath, "wb").write(cont)
         # check the received file is ok
         d = DB(tpath)
         assert d.scalar("pragma integrity_check") == "ok"
@@ -691,8 +745,9 @@ class FullSyncer(HttpSyncer):
             return False
         # apply some adjustments, then upload
         self.col.beforeUpload()
-        if self.req("upload", open(self.col.path, "rb")) != b"OK":
-            return False
+        with open(self.col.path, "rb") as f:
+            if self.req("upload", f) != b"OK":
+                return False
         return True
 
 # Media syncing
@@ -739,6 +794,7 @@ class MediaSyncer:
                 break
 
             need = []
+            clean = []
             lastUsn = data[-1][1]
             for fname, rusn, rsum in data:
                 lsum, ldirty = self.col.media.syncInfo(fname)
@@ -757,7 +813,7 @@ class MediaSyncer:
                         need.append(fname)
                     else:
                         self.col.log("have same already")
-                    ldirty and self.col.media.markClean([fname])
+                    ldirty and clean.append(fname)
                 elif lsum:
                     # deleted remotely
                     if not ldirty:
@@ -769,8 +825,9 @@ class MediaSyncer:
                 else:
                     # deleted both sides
                     self.col.log("both sides deleted")
-                    ldirty and self.col.media.markClean([fname])
+                    ldirty and clean.append(fname)
 
+            self.col.media.markClean(clean)
             self._downloadFiles(need)
 
             self.col.log("update last usn to %d"%lastUsn)
@@ -784,13 +841,15 @@ class MediaSyncer:
         while True:
             zip, fnames = self.col.media.mediaChangesZip()
             if not fnames:
+                zip.close()
                 break
 
             runHook("syncMsg", ngettext(
                 "%d media change to upload", "%d media changes to upload", toSend)
                     % toSend)
 
-            processedCnt, serverLastUsn = self.server.uploadChanges(zip)
+            with zip:
+                processedCnt, serverLastUsn = self.server.uploadChanges(zip)
             self.col.media.markClean(fnames[0:processedCnt])
 
             self.col.log("processed %d, serverUsn %d, clientUsn %d" % (
@@ -822,20 +881,43 @@ class MediaSyncer:
             return ret
 
     def _downloadFiles(self, fnames):
+        """Download the files fnames, by zips of SYNC_ZIP_COUNT files, with
+        up to SYNC_ZIP_PARALLEL requests in flight.
+
+        Each zip is spooled to a temporary file as it is received, and
+        extracted by the thread which downloaded it. The media DB is only
+        written by this thread, once per zip."""
         self.col.log("%d files to fetch"%len(fnames))
-        while fnames:
-            top = fnames[0:SYNC_ZIP_COUNT]
-            self.col.log("fetch %s"%top)
-            zipData = self.server.downloadFiles(files=top)
-            cnt = self.col.media.addFilesFromZip(zipData)
-            self.downloadCount += cnt
-            self.col.log("received %d files"%cnt)
-            fnames = fnames[cnt:]
-
-            n = self.downloadCount
-            runHook("syncMsg", ngettext(
-                "%d media file downloaded", "%d media files downloaded", n)
-                    % n)
+        todo = [fnames[i:i+SYNC_ZIP_COUNT]
+                for i in range(0, len(fnames), SYNC_ZIP_COUNT)]
+        def fetch(top):
+            zip = tempfile.SpooledTemporaryFile(max_size=SYNC_ZIP_SIZE)
+            with self.server.downloadFiles(files=top, fileobj=zip):
+                return self.col.media.extractZip(zip)
+        with ThreadPoolExecutor(SYNC_ZIP_PARALLEL) as pool:
+            running = {}
+            while todo or running:
+                while todo and len(running) < SYNC_ZIP_PARALLEL:
+                    top = todo.pop(0)
+                    self.col.log("fetch %s"%top)
+                    running[pool.submit(fetch, top)] = top
+                done = wait(running, return_when=FIRST_COMPLETED)[0]
+                for future in done:
+                    top = running.pop(future)
+                    media = future.result()
+                    self.col.media.addMedia(media)
+                    cnt = len(media)
+                    self.downloadCount += cnt
+                    self.col.log("received %d files"%cnt)
+                    if cnt < len(top):
+                        # the server limits the size of a zip; fetch the
+                        # remaining files next
+                        todo.insert(0, top[cnt:])
+
+                n = self.downloadCount
+                runHook("syncMsg", ngettext(
+                    "%d media file downloaded", "%d media files downloaded", n)
+                        % n)
 
 # Remote media syncing
 ##########################################################################
@@ -866,13 +948,18 @@ class RemoteMediaServer(HttpSyncer):
             self.req("mediaChanges", io.BytesIO(json.dumps(kw).encode("utf8"))))
 
     # args: files
-    def downloadFiles(self, **kw):
-        return self.req("downloadFiles", io.BytesIO(json.dumps(kw).encode("utf8")))
+    def downloadFiles(self, fileobj=None, **kw):
+        """The zip of the files, as bytes, or written to fileobj as it is
+        received."""
+        return self.req(
+            "downloadFiles", io.BytesIO(json.dumps(kw).encode("utf8")),
+            fileobj=fileobj)
 
     def uploadChanges(self, zip):
+        """Upload the zip, a file as returned by mediaChangesZip()."""
         # no compression, as we compress the zip file instead
         return self._dataOnly(
-            self.req("uploadChanges", io.BytesIO(zip), comp=0))
+            self.req("uploadChanges", zip, comp=0))
 
     # args: local
     def mediaSanity(self, **kw):
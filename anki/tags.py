@@ -23,13 +23,29 @@ class TagManager:
         self.col = col
 
     def load(self, json_):
-        self.tags = json.loads(json_)
+        """Load the registry from JSON. It is only decoded when tags are
+        first accessed."""
+        self._tags = None
         self.changed = False
+        # the JSON of tags as it is in the database
+        self._flushed = json_
+
+    @property
+    def tags(self):
+        if self._tags is None:
+            self._tags = json.loads(self._flushed)
+        return self._tags
+
+    @tags.setter
+    def tags(self, tags):
+        self._tags = tags
 
     def flush(self):
-        if self.changed:
-            self.col.db.execute("update col set tags=?",
-                                 json.dumps(self.tags))
+        if self.changed and self._tags is not None:
+            tags = json.dumps(self._tags)
+            if tags != self._flushed:
+                self.col.db.execute("update col set tags=?", tags)
+                self._flushed = tags
             self.changed = False
 
     # Registering and fetching tags
@@ -55,14 +71,11 @@ class TagManager:
     def registerNotes(self, nids=None):
         "Add any missing tags from notes to the tags list."
         # when called without an argument, the old list is cleared first.
-        if nids:
-            lim = " where id in " + ids2str(nids)
-        else:
-            lim = ""
+        if not nids:
+            nids = None
             self.tags = {}
             self.changed = True
-        self.register(set(self.split(
-            " ".join(self.col.db.list("select distinct tags from notes"+lim)))))
+        self.register(self.col.noteTags.tags(nids))
 
     def allItems(self):
         return list(self.tags.items())
@@ -71,17 +84,11 @@ class TagManager:
         self.changed = True
 
     def byDeck(self, did, children=False):
-        basequery = "select n.tags from cards c, notes n WHERE c.nid = n.id"
-        if not children:
-            query = basequery + " AND c.did=?"
-            res = self.col.db.list(query, did)
-            return list(set(self.split(" ".join(res))))
         dids = [did]
-        for name, id in self.col.decks.children(did):
-            dids.append(id)
-        query = basequery + " AND c.did IN " + ids2str(dids)
-        res = self.col.db.list(query)
-        return list(set(self.split(" ".join(res))))
+        if children:
+            for name, id in self.col.decks.children(did):
+                dids.append(id)
+        return list(self.col.noteTags.tags(dids=dids))
 
     # Bulk addition/removal from notes
     #############################################################
@@ -102,18 +109,18 @@ class TagManager:
             self.register(newTags)
         # find notes missing the tags
         if add:
-            l = "tags not "
+            l = "id not in "
             fn = self.addToStr
         else:
-            l = "tags "
+            l = "id in "
             fn = self.remFromStr
+        args = []
         lim = " or ".join(
-            [l+"like :_%d" % c for c, t in enumerate(newTags)])
+            "%s(%s)" % (l, self.col.noteTags.query(t.replace('*', '%'), args))
+            for t in newTags)
         res = self.col.db.all(
-            f"select id, tags from notes where id in
-            {ids2str(ids)} and ({lim})" ,
-            **dict([("_%d" % x, '%% %s %%' % y.replace('*', '%'))
-                    for x, y in enumerate(newTags)]))
+            "select id, tags from notes where id in %s and (%s)" % (
+                ids2str(ids), lim), *args)
         # update tags
         nids = []
         def fix(row):
@@ -123,6 +130,7 @@ class TagManager:
         self.col.db.executemany(
             "update notes set tags=:t,mod=:n,usn=:u where id = :id",
             [fix(row) for row in res])
+        self.col.noteTags.update(nids)
 
     def bulkRem(self, ids, tags):
         self.bulkAdd(ids, tags, False)
@@ -1,4 +1,4 @@
-from anki.template.template import Template
+from anki.template.template import Template, compiled
 from anki.template.view import View
 
 def render(template, context=None, **kwargs):
@@ -13,4 +13,4 @@ def render(template, context=None, **kwargs):
     """
     context = context and context.copy() or {}
     context.update(kwargs)
-    return Template(template, context).render()
+    return compiled(template).render(context)
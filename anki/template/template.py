@@ -1,4 +1,5 @@
 import re
+import functools
 from anki.utils import stripHTML, stripHTMLMedia
 from anki.hooks import runFilter
 from anki.template import furigana; furigana.install()
@@ -67,6 +68,9 @@ class Template:
     # Closing tag delimiter
     ctag = '}}'
 
+    # (otag, ctag) -> (section_re, tag_re), shared by all templates
+    _regexps = {}
+
     def __init__(self, template, context=None):
         self.template = template
         self.context = context or {}
@@ -85,16 +89,19 @@ class Template:
 
     def compile_regexps(self):
         """Compiles our section and tag regular expressions."""
-        #Opening and closing tag. Currently {{ and }}
-        tags = { 'otag': re.escape(self.otag), 'ctag': re.escape(self.ctag) }
-
-        # See the comment for section_re
-        section = r"%(otag)s[\#|^]([^\}]*)%(ctag)s(.+?)%(otag)s/\1%(ctag)s"
-        self.section_re = re.compile(section % tags, re.M|re.S)
-
-        # See the comment for tag_re
-        tag = r"%(otag)s(#|=|&|!|>|\{)?(.+?)\1?%(ctag)s+"
-        self.tag_re = re.compile(tag % tags)
+        key = (self.otag, self.ctag)
+        if key not in self._regexps:
+            #Opening and closing tag. Currently {{ and }}
+            tags = { 'otag': re.escape(self.otag),
+                     'ctag': re.escape(self.ctag) }
+
+            # See the comment for section_re
+            section = r"%(otag)s[\#|^]([^\}]*)%(ctag)s(.+?)%(otag)s/\1%(ctag)s"
+            # See the comment for tag_re
+            tag = r"%(otag)s(#|=|&|!|>|\{)?(.+?)\1?%(ctag)s+"
+            self._regexps[key] = (re.compile(section % tags, re.M|re.S),
+                                  re.compile(tag % tags))
+        self.section_re, self.tag_re = self._regexps[key]
 
     def render_sections(self, template, context):
         """replace {{#foo}}bar{{/foo}} and {{^foo}}bar{{/foo}} by
@@ -107,25 +114,11 @@ class Template:
             section, section_name, inner = match.group(0, 1, 2)
             section_name = section_name.strip()
 
-            # val will contain the content of the field considered
-            # right now
-            val = None
-            m = re.match("c[qa]:(\d+):(.+)", section_name)
-            if m:
-                # get full field text
-                txt = get_or_attr(context, m.group(2), None)
-                m = re.search(clozeReg%m.group(1), txt)
-                if m:
-                    val = m.group(1)
-            else:
-                val = get_or_attr(context, section_name, None)
+            val = self.section_value(section_name, context)
 
             replacer = ''
             # Whether it's {{^
             inverted = section[2] == "^"
-            # Ensuring we don't consider whitespace in wval
-            if val:
-                val = stripHTMLMedia(val).strip()
             if (val and not inverted) or (not val and inverted):
                 replacer = inner
 
@@ -133,6 +126,27 @@ class Template:
 
         return template
 
+    def section_value(self, section_name, context):
+        """The content of the field tested by the section section_name,
+        without HTML and whitespace. For {{#cq:n:field}} and
+        {{#ca:n:field}}, the content of the cloze n of the field."""
+        # val will contain the content of the field considered
+        # right now
+        val = None
+        m = re.match("c[qa]:(\d+):(.+)", section_name)
+        if m:
+            # get full field text
+            txt = get_or_attr(context, m.group(2), None)
+            m = re.search(clozeReg%m.group(1), txt)
+            if m:
+                val = m.group(1)
+        else:
+            val = get_or_attr(context, section_name, None)
+        # Ensuring we don't consider whitespace in wval
+        if val:
+            val = stripHTMLMedia(val).strip()
+        return val
+
     def render_tags(self, template, context):
         """Renders all the tags in a template for a context. Normally
         {{# and {{^ are already removed."""
@@ -275,3 +289,129 @@ class Template:
             return
         self.compile_regexps()
         return ''
+
+
+class _SectionRecorder(Template):
+    """A template remembering the name of the sections it evaluates."""
+
+    def __init__(self, template, context=None):
+        Template.__init__(self, template, context)
+        self.evaluated = set()
+
+    def section_value(self, section_name, context):
+        self.evaluated.add(section_name)
+        return Template.section_value(self, section_name, context)
+
+
+class CompiledTemplate:
+    """A template parsed once, and rendered in a single pass over its
+    tags.
+
+    The output is the same as Template(template, context).render(). When
+    that can't be guaranteed, the rendering is delegated to Template.
+
+    template -- the mustache source
+    sectionNames -- the name of the sections appearing in the source
+    _nodes -- dictionnary associating to the tuple of the values of
+    sectionNames (as booleans) the result of _parse on the source once
+    its sections are rendered, or None if it must be rendered by
+    Template.
+    """
+
+    # Above this number of section's values, _nodes is emptied
+    maxNodes = 64
+
+    def __init__(self, template):
+        self.template = template
+        names = []
+        for match in re.finditer(r"\{\{[\#|^]([^\}]*)\}\}", template):
+            name = match.group(1).strip()
+            if name not in names:
+                names.append(name)
+        self.sectionNames = names
+        self._nodes = {}
+
+    def render(self, context):
+        """The template rendered with the fields of context."""
+        t = Template(self.template, context)
+        try:
+            key = tuple(bool(t.section_value(name, context))
+                        for name in self.sectionNames)
+        except Exception:
+            # Template only evaluates the sections it reaches
+            return t.render()
+        if key not in self._nodes:
+            if len(self._nodes) >= self.maxNodes:
+                self._nodes.clear()
+            recorder = _SectionRecorder(self.template, context)
+            text = recorder.render_sections(self.template, context)
+            if recorder.evaluated.issubset(self.sectionNames):
+                self._nodes[key] = self._parse(text, t.tag_re)
+            else:
+                # a section appeared once others were removed
+                self._nodes[key] = None
+        nodes = self._nodes[key]
+        if nodes is None:
+            return t.render()
+        res = self._renderNodes(t, nodes, context)
+        if res is None:
+            return t.render()
+        return res
+
+    def _parse(self, text, tag_re):
+        """The list of literal strings and of tags (tag, type, name)
+        of text, or None if replacing the tags one at a time, as
+        render_tags does, may not give the same result as replacing
+        them in a single pass."""
+        nodes = []
+        tags = {}
+        last = 0
+        for match in tag_re.finditer(text):
+            tag, tag_type, tag_name = match.group(0, 1, 2)
+            if tag_type == "=":
+                # the delimiters change while rendering
+                return None
+            nodes.append(text[last:match.start()])
+            nodes.append((tag, tag_type, tag_name.strip()))
+            tags[tag] = tags.get(tag, 0) + 1
+            last = match.end()
+        nodes.append(text[last:])
+        if len(tags) > 100:
+            # render_tags gives up after 100 replacements
+            return None
+        for tag, cnt in tags.items():
+            if text.count(tag) != cnt:
+                # render_tags would also replace text inside another tag
+                return None
+        return nodes
+
+    def _renderNodes(self, t, nodes, context):
+        """The rendering of nodes, or None if the value of a tag may
+        form a new tag with its neighbours. render_tags would then
+        render it too."""
+        values = {}
+        buf = []
+        for node in nodes:
+            if isinstance(node, str):
+                buf.append(node)
+                continue
+            tag, tag_type, tag_name = node
+            if tag not in values:
+                try:
+                    func = modifiers[tag_type]
+                    value = func(t, tag_name, context)
+                except (SyntaxError, KeyError):
+                    return "{{invalid template}}"
+                if ("{{" in value or "}}" in value or
+                        value.startswith(("{", "}")) or
+                        value.endswith(("{", "}"))):
+                    return None
+                values[tag] = value
+            buf.append(values[tag])
+        return "".join(buf)
+
+
+@functools.lru_cache(maxsize=1000)
+def compiled(template):
+    """The CompiledTemplate of template, created on first use."""
+    return CompiledTemplate(template)
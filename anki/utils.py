@@ -215,8 +215,10 @@ def timestampID(db, table):
     # be careful not to create multiple objects without flushing them, or they
     # may share an ID.
     t = intTime(1000)
-    while db.scalar("select id from %s where id = ?" % table, t):
-        t += 1
+    if db.scalar("select id from %s where id = ?" % table, t):
+        # ids were allocated ahead of the clock; skip them all at once
+        # rather than probing them one at a time
+        t = db.scalar("select max(id) from %s" % table) + 1
     return t
 
 def maxID(db):
@@ -268,6 +270,45 @@ def splitFields(string):
     """Transform the fields as in the database in a list of field"""
     return string.split("\x1f")
 
+# JSON registries
+##############################################################################
+
+class JsonCache:
+
+    """Serialize a dictionnary of objects as json.dumps does, keeping the
+    serialization of each value, so that only the values marked as
+    modified are serialized again.
+
+    cache -- dictionnary from key to the serialization of its value
+    dirty -- set of keys whose value must be serialized again
+    """
+
+    def __init__(self):
+        self.cache = {}
+        self.dirty = set()
+
+    def mark(self, key=None):
+        """Mark the value of key as modified. Without key, mark every
+        value, as when it is not known which values were modified."""
+        if key is None:
+            self.cache = {}
+        else:
+            self.dirty.add(key)
+
+    def dumps(self, objs):
+        "The same string as json.dumps(objs)."
+        cache = {}
+        for key, value in objs.items():
+            if key in self.cache and key not in self.dirty:
+                cache[key] = self.cache[key]
+            else:
+                cache[key] = json.dumps(value)
+        self.cache = cache
+        self.dirty = set()
+        return "{%s}" % ", ".join(
+            "%s: %s" % (json.dumps(key), value)
+            for key, value in cache.items())
+
 # Checksums
 ##############################################################################
 
@@ -7,6 +7,7 @@ import html
 import time
 import re
 import unicodedata
+import collections
 from operator import  itemgetter
 from anki.lang import ngettext
 import json
@@ -15,7 +16,7 @@ from aqt.qt import *
 import anki
 import aqt.forms
 from anki.utils import fmtTimeSpan, ids2str, stripHTMLMedia, htmlToTextLine, \
-    isWin, intTime, \
+    isWin, intTime, splitFields, \
     isMac, isLin, bodyClass
 from aqt.utils import saveGeom, restoreGeom, saveSplitter, restoreSplitter, \
     saveHeader, restoreHeader, saveState, restoreState, getTag, \
@@ -30,14 +31,126 @@ from anki.sound import playFromText, clearAudioQueue, allSounds, play
 # Data model
 ##########################################################################
 
+class CardRow:
+
+    """The columns of a card and of its note needed to display a row of
+    the browser, as fetched by DataModel.
+
+    The card's columns are attributes with the same name as in Card. The
+    note's columns are prefixed by note: noteMid, noteMod, noteTags (the
+    string of the database) and noteFlds. Only the columns some active column
+    needs are fetched; the other ones are not set.
+
+    text -- dictionnary from column type to the text already computed
+    for this column.
+    """
+
+    # for each column type, the database columns it needs, besides the
+    # ones of baseCols
+    colsForType = {
+        "question": ("c.did", "c.odid", "n.flds"),
+        "answer": ("c.did", "c.odid", "n.flds"),
+        "noteFld": ("n.flds",),
+        "template": (),
+        "cardDue": ("c.odid", "c.type", "c.due"),
+        "noteCrt": (),
+        "noteMod": ("n.mod",),
+        "cardMod": ("c.mod",),
+        "cardReps": ("c.reps",),
+        "cardLapses": ("c.lapses",),
+        "noteTags": (),
+        "note": (),
+        "cardIvl": ("c.type", "c.ivl"),
+        "cardEase": ("c.type", "c.factor"),
+        "deck": ("c.did", "c.odid"),
+    }
+    # needed to paint and sort rows, and by model() and template()
+    baseCols = ("c.id", "c.nid", "c.ord", "c.queue", "c.flags", "n.mid",
+                "n.tags")
+
+    def __init__(self, col, values):
+        self.col = col
+        self.__dict__.update(values)
+        self.text = {}
+        self._qa = None
+
+    @classmethod
+    def columns(cls, types):
+        """The list of database columns to fetch to display the column
+        types. Unknown types, added by add-ons, need every column."""
+        cols = list(cls.baseCols)
+        for type in types:
+            needed = cls.colsForType.get(type)
+            if needed is None:
+                needed = set().union(*cls.colsForType.values())
+            for c in needed:
+                if c not in cols:
+                    cols.append(c)
+        return cols
+
+    @staticmethod
+    def attribute(col):
+        "The attribute of CardRow containing the database column col."
+        table, name = col.split(".")
+        if table == "c":
+            return name
+        return "note" + name.capitalize()
+
+    def model(self):
+        return self.col.models.get(self.noteMid)
+
+    def template(self):
+        m = self.model()
+        if m['type'] == MODEL_STD:
+            return m['tmpls'][self.ord]
+        return m['tmpls'][0]
+
+    def userFlag(self):
+        return self.flags & 0b111
+
+    def hasTag(self, tag):
+        return self.col.tags.inList(tag, self.col.tags.split(self.noteTags))
+
+    def sortField(self):
+        m = self.model()
+        return splitFields(self.noteFlds)[self.col.models.sortIdx(m)]
+
+    def q(self, reload=False, browser=False):
+        return self.css() + self._getQA(browser)['q']
+
+    def a(self):
+        return self.css() + self._getQA()['a']
+
+    def css(self):
+        return "<style>%s</style>" % self.model()['css']
+
+    def _getQA(self, browser=False):
+        if not self._qa:
+            t = self.template()
+            data = [self.id, self.nid, self.noteMid, self.odid or self.did,
+                    self.ord, self.noteTags, self.noteFlds, self.flags]
+            if browser:
+                args = (t.get('bqfmt'), t.get('bafmt'))
+            else:
+                args = tuple()
+            self._qa = self.col._renderQA(data, *args)
+        return self._qa
+
 class DataModel(QAbstractTableModel):
 
     """
     sortKey -- never used
     activeCols -- the list of columns to display in the browser
     cards -- the set of cards corresponding to current browser's search
-    cardObjs -- dictionnady from card's id to the card object.
+    rows -- ordered dictionnary from card's id to its CardRow, from the
+    least to the most recently used. At most rowCacheSize rows are kept.
     """
+
+    # number of rows kept in rows
+    rowCacheSize = 2000
+    # number of rows fetched before and after a row which isn't in rows
+    prefetch = 100
+
     def __init__(self, browser):
         QAbstractTableModel.__init__(self)
         self.browser = browser
@@ -46,19 +159,46 @@ class DataModel(QAbstractTableModel):
         self.activeCols = self.col.conf.get(
             "activeCols", ["noteFld", "template", "cardDue", "deck"])
         self.cards = []
-        self.cardObjs = {}
+        self.rows = collections.OrderedDict()
 
     def getCard(self, index):
+        "The card object of the row of index."
+        return self.col.getCard(self.cards[index.row()])
+
+    def getRow(self, index):
+        "The CardRow of the row of index."
         id = self.cards[index.row()]
-        if not id in self.cardObjs:
-            self.cardObjs[id] = self.col.getCard(id)
-        return self.cardObjs[id]
+        if id not in self.rows:
+            self._fetchRows(index.row())
+        self.rows.move_to_end(id)
+        return self.rows[id]
+
+    def _fetchRows(self, row):
+        """Fetch, with a single query, the rows around row which are not
+        already in rows."""
+        start = max(0, row - self.prefetch)
+        ids = [id for id in self.cards[start:row + self.prefetch + 1]
+               if id not in self.rows]
+        cols = CardRow.columns(self.activeCols)
+        names = [CardRow.attribute(c) for c in cols]
+        fetched = {}
+        for values in self.col.db.execute("""
+select %s from cards c, notes n where c.nid = n.id and c.id in %s""" % (
+            ", ".join(cols), ids2str(ids))):
+            fetched[values[0]] = CardRow(self.col, zip(names, values))
+        # rows are inserted in the order of the cards, after the rows
+        # already cached, which are evicted first
+        for id in ids:
+            if id in fetched:
+                self.rows[id] = fetched[id]
+        while len(self.rows) > self.rowCacheSize:
+            self.rows.popitem(last=False)
 
     def refreshNote(self, note):
         refresh = False
-        for c in note.cards():
-            if c.id in self.cardObjs:
-                del self.cardObjs[c.id]
+        for id, row in list(self.rows.items()):
+            if row.nid == note.id:
+                del self.rows[id]
                 refresh = True
         if refresh:
             self.layoutChanged.emit()
@@ -84,7 +224,7 @@ class DataModel(QAbstractTableModel):
                 "question", "answer", "noteFld"):
                 return
             row = index.row()
-            c = self.getCard(index)
+            c = self.getRow(index)
             t = c.template()
             if not t.get("bfont"):
                 return
@@ -160,7 +300,7 @@ class DataModel(QAbstractTableModel):
         self.browser.mw.progress.start()
         self.saveSelection()
         self.beginResetModel()
-        self.cardObjs = {}
+        self.rows = collections.OrderedDict()
 
     def endReset(self):
         t = time.time()
@@ -235,17 +375,20 @@ class DataModel(QAbstractTableModel):
         return self.activeCols[column]
 
     def columnData(self, index):
-        row = index.row()
         col = index.column()
         type = self.columnType(col)
-        c = self.getCard(index)
+        c = self.getRow(index)
+        if type not in c.text:
+            c.text[type] = self._columnData(c, type, index)
+        return c.text[type]
+
+    def _columnData(self, c, type, index):
         if type == "question":
             return self.question(c)
         elif type == "answer":
             return self.answer(c)
         elif type == "noteFld":
-            f = c.note()
-            return htmlToTextLine(f.fields[self.col.models.sortIdx(f.model())])
+            return htmlToTextLine(c.sortField())
         elif type == "template":
             t = c.template()['name']
             if c.model()['type'] == MODEL_CLOZE:
@@ -261,9 +404,9 @@ class DataModel(QAbstractTableModel):
                 t = "(" + t + ")"
             return t
         elif type == "noteCrt":
-            return time.strftime("%Y-%m-%d", time.localtime(c.note().id/1000))
+            return time.strftime("%Y-%m-%d", time.localtime(c.nid/1000))
         elif type == "noteMod":
-            return time.strftime("%Y-%m-%d", time.localtime(c.note().mod))
+            return time.strftime("%Y-%m-%d", time.localtime(c.noteMod))
         elif type == "cardMod":
             return time.strftime("%Y-%m-%d", time.localtime(c.mod))
         elif type == "cardReps":
@@ -271,7 +414,7 @@ class DataModel(QAbstractTableModel):
         elif type == "cardLapses":
             return str(c.lapses)
         elif type == "noteTags":
-            return " ".join(c.note().tags)
+            return " ".join(self.col.tags.split(c.noteTags))
         elif type == "note":
             return c.model()['name']
         elif type == "cardIvl":
@@ -327,9 +470,8 @@ class DataModel(QAbstractTableModel):
         if type != "noteFld":
             return False
 
-        row = index.row()
-        c = self.getCard(index)
-        nt = c.note().model()
+        c = self.getRow(index)
+        nt = c.model()
         return nt['flds'][self.col.models.sortIdx(nt)]['rtl']
 
 # Line painter
@@ -355,7 +497,7 @@ class StatusDelegate(QItemDelegate):
     def paint(self, painter, option, index):
         self.browser.mw.progress.blockUpdates = True
         try:
-            c = self.model.getCard(index)
+            c = self.model.getRow(index)
         except:
             # in the the middle of a reset; return nothing so this row is not
             # rendered until we have a chance to reset the model
@@ -369,7 +511,7 @@ class StatusDelegate(QItemDelegate):
         col = None
         if c.userFlag() > 0:
             col = flagColours[c.userFlag()]
-        elif c.note().hasTag("Marked"):
+        elif c.hasTag("Marked"):
             col = COLOUR_MARKED
         elif c.queue == -1:
             col = COLOUR_SUSPENDED
@@ -162,8 +162,16 @@ you can enter it here. Use \\t to represent tab."""),
             self.importer.model['did'] = did
             self.mw.col.models.save(self.importer.model)
         self.mw.col.decks.select(did)
-        self.mw.progress.start(immediate=True)
+        prog = self.mw.progress.start(immediate=True)
+        # an import of several chunks is saved as it goes, which drops
+        # this checkpoint; the log then says it can't be undone
         self.mw.checkpoint(_("Import"))
+        def onImported(cnt):
+            self.mw.progress.update(label=ngettext(
+                "Imported %d note", "Imported %d notes", cnt) % cnt)
+            if prog and prog.wantCancel:
+                self.importer.cancel()
+        addHook("importedNotes", onImported)
         try:
             self.importer.run()
         except UnicodeDecodeError:
@@ -181,6 +189,7 @@ you can enter it here. Use \\t to represent tab."""),
             showText(msg)
             return
         finally:
+            remHook("importedNotes", onImported)
             self.mw.progress.finish()
         txt = _("Importing complete.") + "\n"
         if self.importer.log:
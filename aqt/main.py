@@ -9,13 +9,13 @@ import gc
 import time
 import faulthandler
 import platform
-from threading import Thread
+from threading import Thread, Lock, Event
 
 from send2trash import send2trash
 from aqt.qt import *
 from anki import Collection
 from anki.utils import  isWin, isMac, intTime, splitFields, ids2str, \
-        devMode
+        devMode, namedtmp
 from anki.hooks import runHook, addHook, runFilter
 import aqt
 import aqt.progress
@@ -24,6 +24,7 @@ import aqt.toolbar
 import aqt.stats
 import aqt.mediasrv
 from aqt.utils import showWarning
+import anki.backup
 import anki.sound
 import anki.mpv
 from aqt.utils import saveGeom, restoreGeom, showInfo, showWarning, \
@@ -96,6 +97,7 @@ class AnkiQt(QMainWindow):
         self.setupAutoUpdate()
         self.setupHooks()
         self.setupRefreshTimer()
+        self.setupVacuumTimer()
         self.updateTitleBar()
         # screens
         self.setupDeckBrowser()
@@ -122,6 +124,7 @@ class AnkiQt(QMainWindow):
     def setupProfile(self):
         self.pendingImport = None
         self.restoringBackup = False
+        self._backupThread = None
         # profile not provided on command line?
         if not self.pm.name:
             # if there's a single profile, load it automatically
@@ -232,9 +235,16 @@ Replace your collection with an earlier backup?"""),
         def doOpen(path):
             self._openBackup(path)
         getFile(self.profileDiag, _("Revert to backup"),
-                cb=doOpen, filter="*.colpkg", dir=self.pm.backupFolder())
+                cb=doOpen, filter="*.colpkg *.chunks",
+                dir=self.pm.backupFolder())
 
     def _openBackup(self, path):
+        if path.endswith(".chunks"):
+            # a backup of the chunk store, imported as a collection package
+            colpkg = namedtmp("backup.colpkg")
+            anki.backup.restoreColpkg(path, colpkg)
+            path = colpkg
+        self.waitForBackup()
         try:
             # move the existing collection to the trash, as it may not open
             self.pm.trashCollection()
@@ -252,6 +262,8 @@ close the profile or restart Anki."""))
         self.onOpenProfile()
 
     def loadProfile(self, onsuccess=None):
+        # syncing or loading may save the collection
+        self.waitForBackup()
         self.maybeAutoSync()
 
         if not self.loadCollection():
@@ -412,50 +424,55 @@ from the profile screen."))
     ##########################################################################
 
     class BackupThread(Thread):
-        def __init__(self, path, data):
+        """Back up the collection at path into folder, so that keep backups
+        remain. The collection is read with the online backup API; copied
+        is set once it is read, so that it can be opened again.
+
+        The collection is closed in the delete journal mode, where saving
+        it would wait for a step of the copy and make the copy start
+        again, so the profile is only loaded once copied is set."""
+
+        # backups are stored one at a time, as they prune the same folder
+        lock = Lock()
+
+        def __init__(self, path, folder, keep, chunks):
             Thread.__init__(self)
             self.path = path
-            self.data = data
-            # create the file in calling thread to ensure the same
-            # file is not created twice
-            open(self.path, "wb").close()
+            self.folder = folder
+            self.keep = keep
+            self.chunks = chunks
+            self.copied = Event()
 
         def run(self):
-            z = zipfile.ZipFile(self.path, "w", zipfile.ZIP_DEFLATED)
-            z.writestr("collection.anki2", self.data)
-            z.writestr("media", "{}")
-            z.close()
+            try:
+                tmp = anki.backup.snapshot(self.path, self.folder)
+            finally:
+                self.copied.set()
+            with self.lock:
+                anki.backup.storeSnapshot(tmp, self.keep, chunks=self.chunks)
 
     def backup(self):
         nbacks = self.pm.profile['numBackups']
         if not nbacks or devMode:
             return
-        dir = self.pm.backupFolder()
-        path = self.pm.collectionPath()
-
-        # do backup
-        fname = time.strftime("backup-%Y-%m-%d-%H.%M.%S.colpkg", time.localtime(time.time()))
-        newpath = os.path.join(dir, fname)
-        with open(path, "rb") as f:
-            data = f.read()
-        b = self.BackupThread(newpath, data)
+        b = self.BackupThread(self.pm.collectionPath(), self.pm.backupFolder(),
+                              nbacks, self.pm.profile.get('backupChunks',
+                                                          False))
         b.start()
+        self._backupThread = b
 
-        # find existing backups
-        backups = []
-        for file in os.listdir(dir):
-            # only look for new-style format
-            m = re.match(r"backup-\d{4}-\d{2}-.+.colpkg", file)
-            if not m:
-                continue
-            backups.append(file)
-        backups.sort()
-
-        # remove old ones
-        while len(backups) > nbacks:
-            fname = backups.pop(0)
-            path = os.path.join(dir, fname)
-            os.unlink(path)
+    def waitForBackup(self):
+        "Wait until the last backup has read the collection."
+        if self._backupThread:
+            self._backupThread.copied.wait()
+
+    def setupVacuumTimer(self):
+        # every minute
+        self.progress.timer(60*1000, self.onVacuumTimer, True)
+
+    def onVacuumTimer(self):
+        "Release some of the free pages of the collection, if it is saved."
+        self.col.vacuumSlice()
 
     def maybeOptimize(self):
         # have two weeks passed?
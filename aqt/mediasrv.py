@@ -7,6 +7,10 @@ from http import HTTPStatus
 import http.server
 import socketserver
 import socket
+import collections
+import email.utils
+import gzip
+import io
 from anki.utils import devMode
 import threading
 
@@ -59,9 +63,95 @@ class MediaServer(threading.Thread):
     def shutdown(self):
         self.server.shutdown()
 
+class WebCache:
+
+    """An LRU cache of the content of the small files of the web folder,
+    shared by the threads serving requests. The content of text files is
+    also kept compressed with gzip.
+
+    entries -- ordered dictionnary associating to a path the tuple
+    ((mtime, size), data, gzdata) of the file, the least recently used
+    first; gzdata is None if the file is not compressed.
+    used -- the number of bytes of data and gzdata in entries."""
+
+    # files larger than this are not kept
+    fileSize = 256*1024
+    # number of bytes kept
+    size = 8*1024*1024
+    # whether text files are also kept compressed
+    compress = True
+
+    def __init__(self):
+        self.entries = collections.OrderedDict()
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def get(self, path, f, fs, compress):
+        """The pair (data, gzdata) of the file at path, opened as f, of
+        stat fs. gzdata is None unless compress is set and compression
+        reduces the file's size."""
+        key = (fs.st_mtime_ns, fs.st_size)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry[0] == key:
+                self.entries.move_to_end(path)
+                return entry[1], entry[2]
+        data = f.read()
+        gzdata = None
+        if compress and self.compress:
+            gzdata = gzip.compress(data)
+            if len(gzdata) >= len(data):
+                gzdata = None
+        with self.lock:
+            self._remove(path)
+            self.entries[path] = (key, data, gzdata)
+            self.used += self._size(self.entries[path])
+            while self.used > self.size:
+                self._remove(next(iter(self.entries)))
+        return data, gzdata
+
+    def _remove(self, path):
+        entry = self.entries.pop(path, None)
+        if entry:
+            self.used -= self._size(entry)
+
+    def _size(self, entry):
+        return len(entry[1]) + len(entry[2] or b"")
+
+_webCache = WebCache()
+
+class _FileSlice:
+
+    "The length next bytes of the file f, as a file."
+
+    def __init__(self, f, length):
+        self.f = f
+        self.left = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.left:
+            size = self.left
+        data = self.f.read(size)
+        self.left -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
 class RequestHandler(http.server.SimpleHTTPRequestHandler):
 
+    """Serves the collection's media, and the web folder under /_anki/.
+
+    Responses have a strong ETag, built from the file's mtime and size,
+    so that the webview can revalidate its cache with If-None-Match
+    and get a 304 response. Single byte ranges are served with a 206
+    response, so that audio and video can seek."""
+
     timeout = 1
+    # Cache-Control of the collection's media, which the user may modify
+    mediaCacheControl = "no-cache"
+    # Cache-Control of the web folder, which only changes on upgrade
+    webCacheControl = "no-cache" if devMode else "max-age=3600"
 
     def do_GET(self):
         f = self.send_head()
@@ -82,6 +172,7 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
     def send_head(self):
         path = self.translate_path(self.path)
         path = self._redirectWebExports(path)
+        web = path.startswith(os.path.join(_exportFolder, ""))
         try:
             isdir = os.path.isdir(path)
         except ValueError:
@@ -100,18 +191,137 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
             self.send_error(HTTPStatus.NOT_FOUND, "File not found")
             return None
         try:
-            self.send_response(HTTPStatus.OK)
-            self.send_header("Content-type", ctype)
             fs = os.fstat(f.fileno())
-            self.send_header("Content-Length", str(fs[6]))
-            self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
-            self.send_header("Access-Control-Allow-Origin", "*")
+            size = fs.st_size
+            etag = '"%x-%x"' % (fs.st_mtime_ns, size)
+            headers = [
+                ("Content-type", ctype),
+                ("Last-Modified", self.date_time_string(fs.st_mtime)),
+                ("Cache-Control", self.webCacheControl if web
+                 else self.mediaCacheControl),
+                ("Access-Control-Allow-Origin", "*"),
+            ]
+            if web and size <= _webCache.fileSize:
+                data, gzdata = _webCache.get(
+                    path, f, fs, self._compressible(ctype))
+                f.close()
+                if gzdata is not None:
+                    headers.append(("Vary", "Accept-Encoding"))
+                    if not self.headers.get("Range") and self._acceptsGzip():
+                        data = gzdata
+                        etag = etag[:-1] + '-gzip"'
+                        headers.append(("Content-Encoding", "gzip"))
+                f = io.BytesIO(data)
+                size = len(data)
+            headers.append(("ETag", etag))
+
+            if self._notModified(etag, fs.st_mtime):
+                f.close()
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                for header in headers[1:]:
+                    self.send_header(*header)
+                self.end_headers()
+                return None
+
+            byteRange = self._range(size, etag, fs.st_mtime)
+            if byteRange is False:
+                f.close()
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header("Content-Range", "bytes */%d" % size)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return None
+            if byteRange:
+                start, end = byteRange
+                self.send_response(HTTPStatus.PARTIAL_CONTENT)
+                self.send_header("Content-Range", "bytes %d-%d/%d" % (
+                    start, end, size))
+                f.seek(start)
+                f = _FileSlice(f, end - start + 1)
+                length = end - start + 1
+            else:
+                self.send_response(HTTPStatus.OK)
+                length = size
+            for header in headers:
+                self.send_header(*header)
+            self.send_header("Content-Length", str(length))
+            self.send_header("Accept-Ranges", "bytes")
             self.end_headers()
             return f
         except:
             f.close()
             raise
 
+    def _notModified(self, etag, mtime):
+        """Whether the request is conditional, and the client's copy of the
+        file is current."""
+        match = self.headers.get("If-None-Match")
+        if match is not None:
+            # weak comparison, as the client may have weakened the tag
+            tags = [t.strip() for t in match.split(",")]
+            return "*" in tags or etag in [
+                t[2:] if t.startswith("W/") else t for t in tags]
+        since = self.headers.get("If-Modified-Since")
+        if since is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(since).timestamp()
+            except (TypeError, ValueError, IndexError, OverflowError):
+                return False
+            return int(mtime) <= since
+        return False
+
+    def _range(self, size, etag, mtime):
+        """The pair (start, end) of the byte range requested, both included,
+        None if the whole file should be sent, and False if the range
+        can't be satisfied.
+
+        Several ranges are not supported; the whole file is sent
+        instead, as HTTP allows."""
+        value = self.headers.get("Range")
+        if not value or not value.startswith("bytes="):
+            return None
+        ifRange = self.headers.get("If-Range")
+        if ifRange is not None and ifRange.strip() not in (
+                etag, self.date_time_string(mtime)):
+            # the client's copy is outdated, it needs the whole file
+            return None
+        spec = value[len("bytes="):].strip()
+        if "," in spec:
+            return None
+        if not size:
+            # an empty file has no byte to send
+            return False
+        start, sep, end = spec.partition("-")
+        try:
+            if not start:
+                # the last bytes of the file
+                length = int(end)
+                if not length:
+                    return False
+                return max(0, size - length), size - 1
+            start = int(start)
+            end = int(end) if end else size - 1
+        except ValueError:
+            return None
+        if start >= size:
+            return False
+        if end < start:
+            return None
+        return start, min(end, size - 1)
+
+    def _compressible(self, ctype):
+        "Whether files of type ctype are worth compressing."
+        return ctype.startswith("text/") or ctype in (
+            "application/javascript", "application/json", "image/svg+xml")
+
+    def _acceptsGzip(self):
+        "Whether the client accepts a content compressed with gzip."
+        for coding in self.headers.get("Accept-Encoding", "").split(","):
+            name, sep, params = coding.partition(";")
+            if name.strip().lower() == "gzip":
+                return params.replace(" ", "") not in ("q=0", "q=0.0")
+        return False
+
     def log_message(self, format, *args):
         if not devMode:
             return
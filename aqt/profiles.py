@@ -41,6 +41,8 @@ profileConf = dict(
     mainWindowGeom=None,
     mainWindowState=None,
     numBackups=50,
+    # whether backups share their unchanged pages in a chunk store
+    backupChunks=False,
     lastOptimize=intTime(),
     # editing
     fullSearch=False,
@@ -5,6 +5,7 @@
 import difflib
 import re
 import html
+import time
 import unicodedata as ucd
 import html.parser
 
@@ -22,6 +23,10 @@ import aqt
 class Reviewer:
     "Manage reviews.  Maintains a separate state."
 
+    # number of card updates and revlog entries kept in memory before they
+    # are written, see DB.defer()
+    deferLimit = 100
+
     def __init__(self, mw):
         self.mw = mw
         self.web = mw.web
@@ -32,10 +37,14 @@ class Reviewer:
         self._recordedAudio = None
         self.typeCorrect = None # web init happens before this is set
         self.state = None
+        # when the last card was answered
+        self._answeredAt = None
         self.bottom = aqt.toolbar.BottomBar(mw, mw.bottomWeb)
         addHook("leech", self.onLeech)
 
     def show(self):
+        # write the answers in batches
+        self.mw.col.db.deferLimit = self.deferLimit
         self.mw.col.reset()
         self.web.resetHandlers()
         self.mw.setStateShortcuts(self._shortcutKeys())
@@ -54,6 +63,9 @@ class Reviewer:
                     return
 
     def cleanup(self):
+        if self.mw.col:
+            self.mw.col.db.deferLimit = 0
+            self.mw.col.db.flushDeferred()
         runHook("reviewCleanup")
 
     # Fetching a card
@@ -180,6 +192,7 @@ The front of this card is empty. Please run Tools>Empty Cards.""")
         # if we have a type answer field, focus main web
         if self.typeCorrect:
             self.mw.web.setFocus()
+        self._recordNextCardTime()
         # user hook
         runHook('showQuestion')
 
@@ -220,6 +233,17 @@ The front of this card is empty. Please run Tools>Empty Cards.""")
         self._showEaseButtons()
         # user hook
         runHook('showAnswer')
+        # while the answer is read, render the cards which may follow
+        self.mw.progress.timer(0, self._renderUpcoming, False)
+
+    def _renderUpcoming(self):
+        """Render the question and answer of the cards which may be shown
+        next; they keep them until they are shown."""
+        if self.mw.state != "review" or self.state != "answer":
+            return
+        for card in self.mw.col.sched.upcomingCards():
+            card.q()
+            card.a()
 
     # Answering a card
     ############################################################
@@ -233,11 +257,20 @@ The front of this card is empty. Please run Tools>Empty Cards.""")
             return
         if self.mw.col.sched.answerButtons(self.card) < ease:
             return
+        self._answeredAt = time.time()
         self.mw.col.sched.answerCard(self.card, ease)
         self._answeredIds.append(self.card.id)
         self.mw.autosave()
         self.nextCard()
 
+    def _recordNextCardTime(self):
+        "Log the time taken since the last answer to show the next question."
+        if self._answeredAt is None:
+            return
+        self.mw.col.log("next card shown in %dms" % (
+            (time.time() - self._answeredAt)*1000))
+        self._answeredAt = None
+
     # Handlers
     ############################################################
 
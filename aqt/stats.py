@@ -7,6 +7,8 @@ import os, time
 from aqt.utils import saveGeom, restoreGeom, maybeHideClose, addCloseShortcut, \
     tooltip, getSaveFile
 import aqt
+import json
+from anki.stats import ParallelReport
 
 # Deck Stats
 ######################################################################
@@ -22,6 +24,9 @@ class DeckStats(QDialog):
         self.form = aqt.forms.stats.Ui_Dialog()
         self.oldPos = None
         self.wholeCollection = False
+        # the report being computed, and the timer showing its sections
+        self._report = None
+        self._timer = None
         self.setMinimumWidth(700)
         f = self.form
         f.setupUi(self)
@@ -43,6 +48,7 @@ class DeckStats(QDialog):
         self.activateWindow()
 
     def reject(self):
+        self._cancelReport()
         saveGeom(self, self.name)
         aqt.dialogs.markClosed("DeckStats")
         QDialog.reject(self)
@@ -78,10 +84,50 @@ class DeckStats(QDialog):
         self.refresh()
 
     def refresh(self):
-        self.mw.progress.start(immediate=True, parent=self)
+        self._cancelReport()
         stats = self.mw.col.stats()
         stats.wholeCollection = self.wholeCollection
-        self.report = stats.report(type=self.period)
-        self.form.web.stdHtml("<html><body>"+self.report+"</body></html>",
-                              js=["jquery.js", "plot.js"])
-        self.mw.progress.finish()
+        report = ParallelReport(stats, type=self.period)
+        if not report.supported():
+            self.mw.progress.start(immediate=True, parent=self)
+            self.report = stats.report(type=self.period)
+            self.form.web.stdHtml("<html><body>"+self.report+"</body></html>",
+                                  js=["jquery.js", "plot.js"])
+            self.mw.progress.finish()
+            return
+        # show the sections as they are computed
+        report.start()
+        self._report = report
+        self._shown = set()
+        self.form.web.stdHtml(
+            "<html><body>"+report.skeleton()+"</body></html>",
+            js=["jquery.js", "plot.js"])
+        self._timer = self.mw.progress.timer(50, self._showSections, True)
+
+    def _showSections(self):
+        "Show the sections of the report computed since the last call."
+        report = self._report
+        try:
+            sections = report.completed()
+        except Exception:
+            # a section failed; don't report it again
+            self._cancelReport()
+            raise
+        for name, html in sections:
+            if name not in self._shown:
+                self._shown.add(name)
+                self.form.web.eval("$('#stats-%s').html(%s);" % (
+                    name, json.dumps(html)))
+        if report.done():
+            self._timer.stop()
+            self._timer = None
+            self.report = report.html()
+
+    def _cancelReport(self):
+        "Stop computing the report being shown, if any."
+        if self._timer:
+            self._timer.stop()
+            self._timer = None
+        if self._report:
+            self._report.cancel()
+            self._report = None
@@ -325,6 +325,9 @@ class SyncThread(QThread):
             self.fireEvent("sync", type)
         def syncMsg(msg):
             self.fireEvent("syncMsg", msg)
+        def hashedMedia(done, total):
+            self.fireEvent("syncMsg", _("Checking media... %(a)d/%(b)d") %
+                           dict(a=done, b=total))
         def sendEvent(bytes):
             if not self._abort:
                 self.sentTotal += bytes
@@ -341,6 +344,7 @@ class SyncThread(QThread):
                 raise Exception("sync cancelled")
         addHook("sync", syncEvent)
         addHook("syncMsg", syncMsg)
+        addHook("hashedMedia", hashedMedia)
         addHook("httpSend", sendEvent)
         addHook("httpRecv", recvEvent)
         # run sync and catch any errors
@@ -354,6 +358,7 @@ class SyncThread(QThread):
             self.col.close(save=False)
             remHook("sync", syncEvent)
             remHook("syncMsg", syncMsg)
+            remHook("hashedMedia", hashedMedia)
             remHook("httpSend", sendEvent)
             remHook("httpRecv", recvEvent)
 
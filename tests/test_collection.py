@@ -1,6 +1,6 @@
 # coding: utf-8
 
-import os, tempfile
+import os, tempfile, time
 from tests.shared import assertException, getEmptyCol
 from anki.stdmodels import addBasicModel, models
 
@@ -78,6 +78,46 @@ def test_noteAddDelete():
     f2['Front'] = " "
     assert f2.dupeOrEmpty()
 
+def test_addNotes():
+    deck = getEmptyCol()
+    m = deck.models.byName("Basic (optional reversed card)")
+    deck.models.setCurrent(m)
+    notes = []
+    for i in range(10):
+        f = deck.newNote()
+        f['Front'] = "front %d" % i
+        f['Back'] = "back"
+        f['Add Reverse'] = "y" if i % 2 else ""
+        f.tags = ["Batch"]
+        notes.append(f)
+    # a note without cards is reported, and not added
+    f = deck.newNote()
+    notes.append(f)
+    res = deck.addNotes(notes)
+    assert [n for n, err in res] == [1, 2] * 5 + [0]
+    assert res[-1][1] and not any(err for n, err in res[:-1])
+    assert deck.noteCount() == 10
+    assert deck.cardCount() == 15
+    # ids were allocated for each note, and siblings share their due
+    assert len(set(f.id for f in notes[:10])) == 10
+    assert deck.db.scalar("select count(distinct due) from cards") == 10
+    assert deck.conf['nextPos'] == 11
+    assert deck.tags.all() == ["Batch"]
+    # cards are identical to the ones addNote creates
+    f = deck.newNote()
+    f['Front'] = "front 1"; f['Back'] = "back"; f['Add Reverse'] = "y"
+    f.tags = ["Batch"]
+    deck.addNote(f)
+    cols = "did, ord, type, queue, ivl, factor, reps, lapses, left, data"
+    assert (deck.db.all("select %s from cards where nid = ? order by ord"
+                        % cols, notes[1].id) ==
+            deck.db.all("select %s from cards where nid = ? order by ord"
+                        % cols, f.id))
+    assert (deck.db.first("select tags, flds, sfld, csum from notes where "
+                          "id = ?", notes[1].id) ==
+            deck.db.first("select tags, flds, sfld, csum from notes where "
+                          "id = ?", f.id))
+
 def test_fieldChecksum():
     deck = getEmptyCol()
     f = deck.newNote()
@@ -137,3 +177,185 @@ def test_furigana():
     m['tmpls'][0]['qfmt'] = '{{kana:}}'
     mm.save(m)
     c.q(reload=True)
+
+def test_profiler():
+    deck = getEmptyCol()
+    assert deck.db.profiler is None
+    p = deck.db.startProfiling()
+    for i in range(3):
+        f = deck.newNote()
+        f['Front'] = str(i)
+        deck.addNote(f)
+    deck.db.all("select id from notes where id in (1, 2, 3)")
+    deck.db.all("select id from notes where id in (4, 5)")
+    nids = deck.db.list("select id from notes where mid = 'x'")
+    assert not nids
+    # literals and lists of values share a shape
+    shape = "select id from notes where id in (?, ...)"
+    assert p.shape("select id from notes  where id in ( 7,8 )") == shape
+    assert p.shape("select * from n2 where x = 'a''b'") == (
+        "select * from n2 where x = ?")
+    stats = dict((s['sql'], s) for s in p.report())
+    assert stats[shape]['calls'] == 2
+    assert stats["select id from notes where mid = ?"]['rows'] == 0
+    assert stats["select id from notes where mid = ?"]['calls'] == 1
+    for s in stats.values():
+        assert s['p50'] <= s['p99']
+    assert p.report(key="calls")[0]['calls'] >= 3
+    assert len(p.report(limit=2)) == 2
+    assert "SCAN" in p.dump(deck.db) or "SEARCH" in p.dump(deck.db)
+    # only the first arguments of executemany are kept
+    sql = "update notes set usn = ? where id = ?"
+    deck.db.executemany(sql, ((-1, i) for i in range(1000)))
+    entry = p.entries[p.shape(sql)]
+    assert entry['args'] == (-1, 0)
+    assert entry['rows'] == 0
+    deck.db.executemany(sql, [])
+    assert entry['calls'] == 2
+    assert deck.db.stopProfiling() is p
+    deck.db.all("select id from notes")
+    assert "select id from notes" not in dict(
+        (s['sql'], s) for s in p.report())
+
+def test_backup():
+    import zipfile
+    from anki.backup import backup, restoreColpkg, ChunkStore
+    deck = getEmptyCol()
+    f = deck.newNote()
+    f['Front'] = "1"
+    deck.addNote(f)
+    deck.save()
+    folder = tempfile.mkdtemp()
+    # the collection is open while it is backed up
+    path = backup(deck.path, folder, 2)
+    assert path.endswith(".colpkg")
+    z = zipfile.ZipFile(path)
+    assert sorted(z.namelist()) == ["collection.anki2", "media"]
+    # consecutive backups share their unchanged chunks
+    ChunkStore.chunkSize = 4096
+    paths = []
+    try:
+        for i in range(2):
+            time.sleep(1)
+            f = deck.newNote()
+            f['Front'] = str(i + 2)
+            deck.addNote(f)
+            deck.save()
+            paths.append(backup(deck.path, folder, 2, chunks=True))
+    finally:
+        ChunkStore.chunkSize = 64*1024
+    store = ChunkStore(folder)
+    chunks = [store._manifest(p)['chunks'] for p in paths]
+    assert set(chunks[0]) & set(chunks[1])
+    stored = sum(len(os.listdir(os.path.join(store.dir, d)))
+                 for d in os.listdir(store.dir))
+    assert stored == len(set(chunks[0]) | set(chunks[1]))
+    # the oldest backup was removed
+    assert not os.path.exists(path)
+    assert sorted(os.listdir(folder)) == sorted(
+        ["chunks"] + [os.path.basename(p) for p in paths])
+    colpkg = os.path.join(folder, "restored.colpkg")
+    restoreColpkg(paths[0], colpkg)
+    z = zipfile.ZipFile(colpkg)
+    with open(os.path.join(folder, "restored.anki2"), "wb") as f:
+        f.write(z.read("collection.anki2"))
+    col = aopen(os.path.join(folder, "restored.anki2"))
+    assert col.noteCount() == 2
+    col.close()
+
+def test_backupWhileSaving():
+    import threading
+    import anki.backup
+    from anki.backup import copyCollection
+    deck = getEmptyCol()
+    for i in range(200):
+        f = deck.newNote()
+        f['Front'] = "x" * 1000 + str(i)
+        deck.addNote(f)
+    deck.save()
+    folder = tempfile.mkdtemp()
+    # with a rollback journal, as on Windows, and in the WAL mode
+    for mode in ("delete", "wal"):
+        deck.db.setAutocommit(True)
+        assert deck.db.scalar("pragma journal_mode = %s" % mode) == mode
+        deck.db.setAutocommit(False)
+        errors = []
+        def copies():
+            try:
+                for i in range(20):
+                    copyCollection(deck.path,
+                                   os.path.join(folder, "%d.anki2" % i))
+            except Exception as e:
+                errors.append(e)
+        t = threading.Thread(target=copies)
+        # in several steps
+        anki.backup.backupPages = 16
+        try:
+            t.start()
+            saves = 0
+            while t.is_alive():
+                # would raise "database is locked" if the copy held the lock
+                deck.setMod()
+                deck.save()
+                saves += 1
+                time.sleep(0.005)
+            t.join()
+        finally:
+            anki.backup.backupPages = 256
+        assert not errors
+        assert saves
+        col = aopen(os.path.join(folder, "19.anki2"))
+        assert col.noteCount() == 200
+        col.close()
+
+def test_vacuum():
+    deck = getEmptyCol()
+    assert deck.db.scalar("pragma auto_vacuum") == 2
+    for i in range(200):
+        f = deck.newNote()
+        f['Front'] = "x" * 1000 + str(i)
+        deck.addNote(f)
+    deck.save()
+    deck.remNotes(deck.db.list("select id from notes"))
+    deck.save()
+    free = deck.db.scalar("pragma freelist_count")
+    assert free
+    # not while there are unsaved changes
+    deck.db.execute("update col set ls = 1")
+    assert deck.vacuumSlice()
+    assert deck.db.scalar("pragma freelist_count") == free
+    deck.save()
+    assert deck.vacuumSlice(0)
+    # each statement releases vacuumPages pages
+    deck.db.vacuumPages = 8
+    p = deck.db.startProfiling()
+    while deck.vacuumSlice():
+        pass
+    deck.db.stopProfiling()
+    assert not deck.db.scalar("pragma freelist_count")
+    assert [s['calls'] for s in p.report()
+            if "incremental_vacuum" in s['sql']] == [-(-free // 8)]
+    # only the tables which changed a lot are analyzed again
+    deck.optimize()
+    stat = "select stat from sqlite_stat1 where idx = 'ix_notes_usn'"
+    assert not deck.db.scalar(stat)
+    for i in range(100):
+        f = deck.newNote()
+        f['Front'] = str(i)
+        deck.addNote(f)
+    deck.optimize()
+    assert deck.db.scalar(stat).startswith("100 ")
+    deck.db.executemany(
+        "insert into notes select ?, guid || ?, mid, mod, usn, tags, flds, "
+        "sfld, csum, flags, data from notes limit 1",
+        [(i, i) for i in range(1, 11)])
+    deck.optimize()
+    assert deck.db.scalar(stat).startswith("100 ")
+    # older collections are rebuilt once in incremental mode
+    deck.db.setAutocommit(True)
+    deck.db.execute("pragma auto_vacuum = none")
+    deck.db.execute("vacuum")
+    deck.db.setAutocommit(False)
+    assert deck.db.scalar("pragma auto_vacuum") == 0
+    deck.optimize()
+    assert deck.db.scalar("pragma auto_vacuum") == 2
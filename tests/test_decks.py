@@ -1,5 +1,6 @@
 # coding: utf-8
 
+from anki.utils import json
 from tests.shared import assertException, getEmptyCol
 
 def test_basic():
@@ -41,6 +42,35 @@ def test_basic():
     # this will error if child and parent case don't match
     deck.sched.deckDueList()
 
+def test_flush():
+    deck = getEmptyCol()
+    # only modified decks are serialized again, but the registry is
+    # written whole
+    ids = [deck.decks.id("deck%d" % i) for i in range(5)]
+    conf = deck.decks.confForDid(ids[0])
+    deck.save()
+    g = deck.decks.get(ids[2])
+    g['desc'] = "changed"
+    deck.decks.save(g)
+    conf['new']['perDay'] = 5
+    deck.decks.save(conf)
+    deck.save()
+    decks, dconf = deck.db.first("select decks, dconf from col")
+    assert decks == json.dumps(deck.decks.decks)
+    assert dconf == json.dumps(deck.decks.dconf)
+    deck.decks.rem(ids[3])
+    deck.save()
+    deck.rollback()
+    assert deck.decks.get(ids[2])['desc'] == "changed"
+    assert deck.decks.confForDid(ids[0])['new']['perDay'] == 5
+    assert not deck.decks.get(ids[3], default=False)
+    # selecting a deck only modifies the collection's configuration
+    deck.decks.select(ids[1])
+    assert not deck.decks.changed
+    deck.save()
+    deck.rollback()
+    assert deck.decks.selected() == ids[1]
+
 def test_remove():
     deck = getEmptyCol()
     # create a new deck, and add a note/card to it
@@ -88,6 +118,47 @@ def test_rename():
     for n in "yo", "yo::two", "yo::two::three":
         assert n in d.decks.allNames()
 
+def test_nameIndex():
+    d = getEmptyCol()
+    a = d.decks.id("a")
+    ab = d.decks.id("a::b")
+    abc = d.decks.id("a::b::c")
+    ax = d.decks.id("ax")
+    # names are looked up regardless of the case
+    assert d.decks.id("A::B", create=False) == ab
+    assert d.decks.byName("a::b")['id'] == ab
+    assert not d.decks.byName("A::B")
+    # descendants, but not decks sharing a prefix
+    assert d.decks.children(a) == [("a::b", ab), ("a::b::c", abc)]
+    assert d.decks.children(ax) == []
+    # renaming moves the subtree
+    d.decks.rename(d.decks.get(ab), "x::b")
+    assert d.decks.id("a::b", create=False) is None
+    assert d.decks.id("x::b::c", create=False) == abc
+    assert d.decks.children(a) == []
+    assert [x[1] for x in d.decks.children(d.decks.id("x"))] == [ab, abc]
+    # as do names changed directly
+    g = d.decks.get(ax)
+    g['name'] = "y"
+    d.decks.save(g)
+    assert d.decks.id("y", create=False) == ax
+    # removals
+    d.decks.rem(ab)
+    assert d.decks.id("x::b::c", create=False) is None
+    assert d.decks.children(d.decks.id("x")) == []
+    # and decks merged by sync
+    g = dict(d.decks.get(a), name="z", id=1234)
+    d.decks.update(g)
+    assert d.decks.id("z", create=False) == 1234
+    g = dict(g, name="z2")
+    d.decks.update(g)
+    assert d.decks.id("z", create=False) is None
+    assert d.decks.byName("z2")['id'] == 1234
+    # the index is built again when the decks are reloaded
+    d.save()
+    d.load()
+    assert d.decks.id("z2", create=False) == 1234
+
 def test_renameForDragAndDrop():
     d = getEmptyCol()
 
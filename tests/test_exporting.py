@@ -1,6 +1,6 @@
 # coding: utf-8
 
-import nose, os, tempfile
+import nose, os, tempfile, io, zipfile
 from anki import Collection as aopen
 from anki.exporting import *
 from anki.importing import Anki2Importer
@@ -112,6 +112,37 @@ def test_export_anki_due():
     deck2.sched.reset()
     assert c.due - deck2.sched.today == 1
 
+def test_export_media():
+    deck = getEmptyCol(schedVer=2)
+    mdir = deck.media.dir()
+    for name in ("a.mp3", "_font.ttf", "_unused.ttf", "b.svg"):
+        with open(os.path.join(mdir, name), "w") as f:
+            f.write("data of " + name)
+    os.mkdir(os.path.join(mdir, "_dir"))
+    m = deck.models.current()
+    m['css'] += "@font-face { src: url(_font.ttf); }"
+    deck.models.save(m)
+    f = deck.newNote()
+    f['Front'] = '[sound:a.mp3]<img src="b.svg">'
+    deck.addNote(f)
+    e = AnkiExporter(deck)
+    e.includeSched = True
+    fd, newname = tempfile.mkstemp(prefix="ankitest", suffix=".anki2")
+    os.close(fd)
+    os.unlink(newname)
+    e.exportInto(newname)
+    assert sorted(e.mediaFiles) == ["_font.ttf", "a.mp3", "b.svg"]
+    # files are zipped in order, whether read by the threads or not
+    e = AnkiPackageExporter(deck)
+    e.mediaBlock = 15
+    z = zipfile.ZipFile(io.BytesIO(), "w")
+    files = ["b.svg", "missing.mp3", "_dir", "a.mp3", "_font.ttf"]
+    media = e._exportMedia(z, files, mdir)
+    assert media == {"0": "b.svg", "3": "a.mp3", "4": "_font.ttf"}
+    assert z.read("4") == b"data of _font.ttf"
+    assert z.getinfo("0").compress_type == zipfile.ZIP_DEFLATED
+    assert z.getinfo("3").compress_type == zipfile.ZIP_STORED
+
 # @nose.with_setup(setup1)
 # def test_export_textcard():
 #     e = TextCardExporter(deck)
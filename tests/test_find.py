@@ -282,3 +282,116 @@ def test_findDupes():
     assert not r
     # front isn't dupe
     assert deck.findDupes("Front") == []
+
+def test_fullTextIndex():
+    deck = getEmptyCol()
+    if not deck.fts.supported():
+        return
+    f = deck.newNote()
+    f['Front'] = 'the <b>dog</b> barks'
+    f['Back'] = 'cat <img src="pig.jpg">'
+    deck.addNote(f)
+    f2 = deck.newNote()
+    f2['Front'] = 'goats'
+    f2['Back'] = 'sheep'
+    deck.addNote(f2)
+    assert not deck.fts.enabled()
+    assert deck.fts.enable()
+    assert deck.fts.enabled()
+    # text searches are answered by the index, without html
+    assert deck.findNotes("dog barks") == [f.id]
+    assert deck.findNotes("'dog barks'") == [f.id]
+    assert deck.findNotes("DOG") == [f.id]
+    assert deck.findNotes("img src") == []
+    # but media filenames are kept
+    assert deck.findNotes("pig.jpg") == [f.id]
+    assert deck.findNotes("goat") == [f2.id]
+    assert deck.findNotes("-goat") == [f.id]
+    # short or wildcard searches fall back to LIKE
+    assert deck.findNotes("ca") == [f.id]
+    assert deck.findNotes("g*ts") == [f2.id]
+    # field searches
+    assert deck.findNotes("front:goats") == [f2.id]
+    assert deck.findNotes("front:GOA*") == [f2.id]
+    assert deck.findNotes("front:goa") == []
+    assert deck.findNotes("back:she_p") == [f2.id]
+    assert deck.findNotes("back:sheep") == [f2.id]
+    assert sorted(deck.findNotes("front:*")) == sorted([f.id, f2.id])
+    # edits, find&replace and deletions update the index
+    f['Front'] = 'horse'
+    f.flush()
+    assert deck.findNotes("barks") == []
+    assert deck.findNotes("horse") == [f.id]
+    deck.findReplace([f2.id], "goats", "cows")
+    assert deck.findNotes("goats") == []
+    assert deck.findNotes("front:cows") == [f2.id]
+    deck.remNotes([f2.id])
+    assert deck.db.scalar("select count() from notes_fts") == 1
+    # adding fields to the model keeps the ordinals in sync
+    m = deck.models.current()
+    fld = deck.models.newField("Extra")
+    deck.models.addField(m, fld)
+    deck.models.moveField(m, fld, 0)
+    assert deck.findNotes("front:horse") == [f.id]
+    # changes made by other clients are picked up when reloading
+    deck.save()
+    deck.db.execute("update notes set flds = ?, mod = mod + 1 where id = ?",
+                    "\x1fzebra\x1fcat", f.id)
+    deck.save()
+    deck.db.execute("update notes_fts_state set mod = 0")
+    deck.load()
+    assert deck.findNotes("zebra") == [f.id]
+    # the index is not uploaded
+    deck.fts.disable()
+    assert not deck.fts.enabled()
+    assert deck.findNotes("zebra") == [f.id]
+
+def test_noteTagIndex():
+    deck = getEmptyCol()
+    f = deck.newNote()
+    f['Front'] = 'one'
+    f.tags = ["Animal::Dog", "pet"]
+    deck.addNote(f)
+    f2 = deck.newNote()
+    f2['Front'] = 'two'
+    f2.tags = ["animal::cat"]
+    deck.addNote(f2)
+    f3 = deck.newNote()
+    f3['Front'] = 'three'
+    deck.addNote(f3)
+    # created by the first search
+    assert not deck.noteTags.enabled()
+    assert deck.findNotes("tag:pet") == [f.id]
+    assert deck.noteTags.enabled()
+    assert deck.findNotes("tag:PET") == [f.id]
+    assert deck.findNotes("tag:pe") == []
+    assert sorted(deck.findNotes("tag:animal::*")) == sorted([f.id, f2.id])
+    assert deck.findNotes("tag:animal::d*") == [f.id]
+    assert deck.findNotes("tag:*dog") == [f.id]
+    assert deck.findNotes("tag:none") == [f3.id]
+    assert len(deck.findNotes("tag:*")) == 3
+    # the case of the tags is kept
+    assert deck.noteTags.tags() == set(["Animal::Dog", "pet", "animal::cat"])
+    assert deck.noteTags.tags([f2.id]) == set(["animal::cat"])
+    # edits, bulk operations and deletions update the index
+    f.tags = ["pet"]
+    f.flush()
+    assert deck.findNotes("tag:animal::*") == [f2.id]
+    deck.tags.bulkAdd([f2.id, f3.id], "pet")
+    assert len(deck.findNotes("tag:pet")) == 3
+    deck.tags.bulkRem([f.id, f2.id], "pet")
+    assert deck.findNotes("tag:pet") == [f3.id]
+    deck.remNotes([f3.id])
+    assert deck.findNotes("tag:pet") == []
+    assert deck.db.scalar("select count() from note_tags") == 1
+    # changes made by other clients are picked up when reloading
+    deck.save()
+    deck.db.execute("update notes set tags = ' zebra ', mod = mod + 1 "
+                    "where id = ?", f.id)
+    deck.save()
+    deck.db.execute("update note_tags_state set mod = 0")
+    deck.load()
+    assert deck.findNotes("tag:zebra") == [f.id]
+    # and the index is dropped before a full sync
+    deck.beforeUpload()
+    assert not deck.noteTags.enabled()
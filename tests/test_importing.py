@@ -3,6 +3,7 @@
 import  os
 from tests.shared import  getUpgradeDeckPath, getEmptyCol
 from anki.utils import ids2str
+from anki.hooks import addHook, remHook
 from anki.importing import Anki2Importer, TextImporter, \
     SupermemoXmlImporter, MnemosyneImporter, AnkiPackageImporter
 
@@ -127,6 +128,54 @@ def test_anki2_updates():
     assert dst.noteCount() == 1
     assert dst.db.scalar("select flds from notes").startswith("goodbye")
 
+def test_anki2_merge():
+    # a file whose note and card ids are already used by other notes,
+    # with a filtered card and a review
+    src = getEmptyCol()
+    n = src.newNote()
+    n['Front'] = "one"
+    src.addNote(n)
+    n2 = src.newNote()
+    n2['Front'] = "two"
+    src.addNote(n2)
+    c = n.cards()[0]
+    src.db.execute("""
+update cards set type = 2, queue = 2, due = 20, odue = 30, odid = 1
+where id = ?""", c.id)
+    src.db.execute("insert into revlog values (1, ?, 0, 3, 5, 1, 2500, 1, 1)",
+                   c.id)
+    src.close()
+    dst = getEmptyCol()
+    n3 = dst.newNote()
+    n3['Front'] = "three"
+    dst.addNote(n3)
+    dst.db.execute("update notes set id = ? where id = ?", n.id, n3.id)
+    dst.db.execute("update cards set id = ?, nid = ?", c.id, n.id)
+    imp = Anki2Importer(dst, src.path)
+    imp.run()
+    assert imp.added == 2
+    assert dst.noteCount() == 3
+    assert dst.db.scalar("select flds from notes where id = ?",
+                         n.id).startswith("three")
+    nid = dst.db.scalar("select id from notes where guid = ?", n.guid)
+    assert nid == n.id + 999
+    assert dst.db.scalar("select id from notes where guid = ?",
+                         n2.guid) == n2.id
+    # the filtered card is back in its deck, and keeps its review
+    cid = dst.db.scalar("select id from cards where nid = ?", nid)
+    assert cid == c.id + 999
+    assert dst.db.first("select type, queue, due, odue, odid from cards "
+                        "where id = ?", cid) == (2, 2, 30, 0, 0)
+    assert dst.db.scalar("select cid from revlog") == cid
+    # the file is no longer attached
+    assert "src" not in [r[1] for r in dst.db.all("pragma database_list")]
+    # importing again finds the same notes
+    imp = Anki2Importer(dst, src.path)
+    imp.run()
+    assert imp.dupes == 2
+    assert imp.added == 0
+    assert dst.cardCount() == 3
+
 def test_csv():
     deck = getEmptyCol()
     file = str(os.path.join(testDir, "support/text-2fields.txt"))
@@ -161,6 +210,47 @@ def test_csv():
     assert deck.cardCount() == 11
     deck.close()
 
+def test_csv_chunks():
+    deck = getEmptyCol()
+    file = str(os.path.join(testDir, "support/text-2fields.txt"))
+    i = TextImporter(deck, file)
+    i.initMapping()
+    # duplicates are found across chunks too
+    i.chunkSize = 2
+    i.run()
+    assert len(i.log) == 6
+    assert i.total == 5
+    assert deck.noteCount() == 5
+    # an import saved in several chunks can't be undone
+    assert not i.undoable
+    assert i.log[-1] == \
+        "This import was saved as it went and can't be undone."
+    # but an import of a single chunk can
+    deck = getEmptyCol()
+    deck.save("Import")
+    i = TextImporter(deck, file)
+    i.initMapping()
+    i.run()
+    assert i.undoable
+    assert deck.noteCount() == 5
+    assert deck.undoName() == "Import"
+    deck.undo()
+    assert deck.noteCount() == 0
+    # cancelling keeps the chunks already saved
+    deck = getEmptyCol()
+    i = TextImporter(deck, file)
+    i.initMapping()
+    i.chunkSize = 2
+    cancel = lambda cnt: i.cancel()
+    addHook("importedNotes", cancel)
+    try:
+        i.run()
+    finally:
+        remHook("importedNotes", cancel)
+    assert deck.noteCount() == 2
+    assert i.log[-1] == "Import cancelled."
+    deck.close()
+
 def test_csv2():
     deck = getEmptyCol()
     mm = deck.models
@@ -22,6 +22,9 @@ def test_latex():
     msg = f.cards()[0].q()
     assert "executing nolatex" in msg
     assert "installed" in msg
+    # and Check Media reports the image it couldn't generate
+    nohave = d.media.check()[0]
+    assert len(nohave) == 1 and nohave[0].startswith("latex-")
     # check if we have latex installed, and abort test if we don't
     if not shutil.which("latex") or not shutil.which("dvipng"):
         print("aborting test; latex or dvipng is not installed")
@@ -4,6 +4,7 @@ import tempfile
 import os
 import time
 
+from anki.utils import checksum
 from .shared import getEmptyCol, testDir
 
 
@@ -70,6 +71,50 @@ def test_deckIntegration():
     assert ret[0] == ["fake2.png"]
     assert ret[1] == ["foo.jpg"]
 
+def test_noteMedia():
+    d = getEmptyCol()
+    index = d.noteMedia
+    f = d.newNote()
+    f['Front'] = "<img src='one.png'>[sound:two.mp3]"
+    f['Back'] = "[latex]x[/latex]"
+    d.addNote(f)
+    # the index is created when first needed
+    assert not index.enabled()
+    files = index.files()
+    assert index.enabled()
+    latex = [x for x in files if x.startswith("latex-")]
+    assert len(latex) == 1
+    assert files == set(["one.png", "two.mp3"] + latex)
+    # without the image being built
+    assert not os.path.exists(os.path.join(d.media.dir(), latex[0]))
+    # and kept up to date when notes change
+    f['Front'] = "<img src='three.png'>"
+    f.flush()
+    f2 = d.newNote()
+    f2['Front'] = "[sound:two.mp3]"
+    d.addNote(f2)
+    assert index.files([f.id]) == set(["three.png"] + latex)
+    assert index.notes(["two.mp3"]) == [f2.id]
+    from anki.find import findReplace
+    findReplace(d, [f2.id], "two", "four")
+    assert index.notes(["four.mp3"]) == [f2.id]
+    d.remNotes([f2.id])
+    assert not index.notes(["four.mp3"])
+    # more names than sqlite allows variables
+    names = ["%d.png" % i for i in range(2000)] + ["three.png"]
+    assert index.notes(names) == [f.id]
+    # changes made by clients not knowing about the index are noticed
+    d.save()
+    d.db.execute("update notes set flds = '[sound:five.mp3]', mod = mod + 1")
+    d.db.execute("update col set mod = mod + 1")
+    d.db.commit()
+    d.load()
+    assert index.files() == set(["five.mp3"])
+    # and the index can be rebuilt
+    d.db.execute("delete from note_media")
+    index.rebuild()
+    assert index.files() == set(["five.mp3"])
+
 def test_changes():
     d = getEmptyCol()
     def added():
@@ -109,6 +154,71 @@ def test_changes():
     assert len(list(added())) == 1
     assert len(list(removed())) == 1
 
+def test_hashing():
+    d = getEmptyCol()
+    d.media.hashThreads = 3
+    d.media.hashBlock = 4
+    d.media.hashBatch = 2
+    from anki.hooks import addHook, remHook
+    progress = []
+    def onHashed(done, total):
+        progress.append((done, total))
+    addHook("hashedMedia", onHashed)
+    try:
+        for i in range(5):
+            with open(os.path.join(d.media.dir(), "%d.txt" % i), "w") as f:
+                f.write("content of file %d" % i)
+        d.media.findChanges()
+    finally:
+        remHook("hashedMedia", onHashed)
+    assert progress == [(2, 5), (4, 5), (5, 5)]
+    for i in range(5):
+        assert d.media.syncInfo("%d.txt" % i) == (
+            checksum("content of file %d" % i), 1)
+    # files whose mtime changed but not the content aren't marked
+    d.media.markClean(["%d.txt" % i for i in range(5)])
+    time.sleep(1)
+    with open(os.path.join(d.media.dir(), "0.txt"), "w") as f:
+        f.write("content of file 0")
+    with open(os.path.join(d.media.dir(), "1.txt"), "w") as f:
+        f.write("new content")
+    os.utime(d.media.dir(), None)
+    d.media.db.execute("update meta set dirMod = 0")
+    d.media.findChanges()
+    assert d.media.syncInfo("0.txt")[1] == 0
+    assert d.media.syncInfo("1.txt") == (checksum("new content"), 1)
+
+def test_zips():
+    import io, json, zipfile
+    d = getEmptyCol()
+    for i in range(3):
+        with open(os.path.join(d.media.dir(), "%d.txt" % i), "w") as f:
+            f.write("content of file %d" % i)
+    d.media.findChanges()
+    zip, fnames = d.media.mediaChangesZip()
+    assert sorted(fnames) == ["0.txt", "1.txt", "2.txt"]
+    with zip, zipfile.ZipFile(zip) as z:
+        meta = json.loads(z.read("_meta").decode("utf8"))
+        assert sorted(fname for fname, zipname in meta) == sorted(fnames)
+    d.media.markClean(fnames)
+    assert not d.media.dirtyCount()
+    # in zips sent by the server, _meta maps the zip's names to the files
+    f = io.BytesIO()
+    with zipfile.ZipFile(f, "w") as z:
+        for i in range(3):
+            z.writestr(str(i), "content of file %d" % i)
+        z.writestr("_meta", json.dumps(dict(
+            (str(i), "%d.txt" % i) for i in range(3))))
+    d2 = getEmptyCol()
+    d2.media.hashBlock = 4
+    f.seek(0)
+    assert d2.media.addFilesFromZip(f) == 3
+    for i in range(3):
+        assert d2.media.syncInfo("%d.txt" % i) == (
+            checksum("content of file %d" % i), 0)
+        with open(os.path.join(d2.media.dir(), "%d.txt" % i)) as f:
+            assert f.read() == "content of file %d" % i
+
 def test_illegal():
     d = getEmptyCol()
     aString = "a:b|cd\\e/f\0g*h"
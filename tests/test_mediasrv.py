@@ -0,0 +1,34 @@
+# coding: utf-8
+
+class _Request:
+    "The part of a request the handler's _range() reads."
+
+    def __init__(self, **headers):
+        self.headers = headers
+
+    def date_time_string(self, timestamp):
+        return "Thu, 01 Jan 1970 00:00:00 GMT"
+
+def test_range():
+    try:
+        from aqt.mediasrv import RequestHandler
+    except ImportError:
+        print("aborting test; PyQt is not installed")
+        return
+    def range(size, **headers):
+        return RequestHandler._range(_Request(**headers), size, '"etag"', 0)
+    assert range(100) is None
+    assert range(100, Range="bytes=10-19") == (10, 19)
+    assert range(100, Range="bytes=90-") == (90, 99)
+    assert range(100, Range="bytes=90-200") == (90, 99)
+    assert range(100, Range="bytes=-5") == (95, 99)
+    assert range(100, Range="bytes=-500") == (0, 99)
+    assert range(100, Range="bytes=100-") is False
+    assert range(100, Range="bytes=-0") is False
+    # several ranges, or an outdated copy: the whole file
+    assert range(100, Range="bytes=0-1,5-6") is None
+    assert range(100, Range="bytes=0-1", **{"If-Range": '"old"'}) is None
+    assert range(100, Range="bytes=0-1", **{"If-Range": '"etag"'}) == (0, 1)
+    # no range of an empty file can be satisfied
+    assert range(0, Range="bytes=0-") is False
+    assert range(0, Range="bytes=-5") is False
@@ -2,6 +2,7 @@
 
 import time
 import copy
+import random
 
 from anki.consts import STARTING_FACTOR
 from tests.shared import  getEmptyCol
@@ -970,6 +971,51 @@ def test_deckDue():
     d.sched.deckDueList()
     d.sched.deckDueTree()
 
+def test_deckDueCounts():
+    d = getEmptyCol()
+    random.seed(1)
+    names = ["a", "a::b", "a::b::c", "a::d", "e", "e::f"]
+    for name in names:
+        did = d.decks.id(name)
+        m = d.models.current()
+        m['did'] = did
+        d.models.save(m)
+        for i in range(12):
+            f = d.newNote()
+            f['Front'] = name + str(i)
+            d.addNote(f)
+    # mix the queues
+    for cid in d.db.list("select id from cards"):
+        c = d.getCard(cid)
+        c.queue = c.type = random.choice((0, 1, 2, 3))
+        if c.queue == 1:
+            c.left = 1002
+            c.due = intTime() - 10
+        elif c.queue in (2, 3):
+            c.due = d.sched.today - random.randint(0, 1)
+        c.flush()
+    conf = d.decks.confForDid(1)
+    conf['new']['perDay'] = 5
+    conf['rev']['perDay'] = 7
+    d.decks.updateConf(conf)
+    d.reset()
+    # compare with the per-deck queries
+    expected = []
+    lims = {}
+    for deck in sorted(d.decks.all(), key=lambda x: x['name']):
+        p = "::".join(deck['name'].split("::")[:-1])
+        nlim = d.sched._deckNewLimitSingle(deck)
+        rlim = d.sched._deckRevLimitSingle(deck)
+        if p:
+            nlim = min(nlim, lims[p][0])
+            rlim = min(rlim, lims[p][1])
+        lims[deck['name']] = [nlim, rlim]
+        expected.append([deck['name'], deck['id'],
+                         d.sched._revForDeck(deck['id'], rlim),
+                         d.sched._lrnForDeck(deck['id']),
+                         d.sched._newForDeck(deck['id'], nlim)])
+    assert d.sched.deckDueList() == expected
+
 def test_deckTree():
     d = getEmptyCol()
     d.decks.id("new::b::c")
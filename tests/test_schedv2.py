@@ -2,6 +2,7 @@
 
 import time
 import copy
+import random
 
 from anki.consts import STARTING_FACTOR
 from tests.shared import getEmptyCol as _getEmptyCol
@@ -968,6 +969,52 @@ def test_deckDue():
     d.sched.deckDueList()
     d.sched.deckDueTree()
 
+def test_deckDueCounts():
+    d = getEmptyCol()
+    random.seed(1)
+    names = ["a", "a::b", "a::b::c", "a::d", "e", "e::f"]
+    for name in names:
+        did = d.decks.id(name)
+        m = d.models.current()
+        m['did'] = did
+        d.models.save(m)
+        for i in range(12):
+            f = d.newNote()
+            f['Front'] = name + str(i)
+            d.addNote(f)
+    # mix the queues
+    for cid in d.db.list("select id from cards"):
+        c = d.getCard(cid)
+        c.queue = c.type = random.choice((0, 1, 2, 3))
+        if c.queue == 1:
+            c.left = 1002
+            c.due = intTime() - 10
+        elif c.queue in (2, 3):
+            c.due = d.sched.today - random.randint(0, 1)
+        c.flush()
+    conf = d.decks.confForDid(1)
+    conf['new']['perDay'] = 5
+    conf['rev']['perDay'] = 7
+    d.decks.updateConf(conf)
+    d.reset()
+    # compare with the per-deck queries
+    expected = []
+    lims = {}
+    childMap = d.decks.childMap()
+    for deck in sorted(d.decks.all(), key=lambda x: x['name']):
+        p = "::".join(deck['name'].split("::")[:-1])
+        nlim = d.sched._deckNewLimitSingle(deck)
+        if p:
+            nlim = min(nlim, lims[p][0])
+        rlim = d.sched._deckRevLimitSingle(
+            deck, parentLimit=lims[p][1] if p else None)
+        lims[deck['name']] = [nlim, rlim]
+        expected.append([deck['name'], deck['id'],
+                         d.sched._revForDeck(deck['id'], rlim, childMap),
+                         d.sched._lrnForDeck(deck['id']),
+                         d.sched._newForDeck(deck['id'], nlim)])
+    assert d.sched.deckDueList() == expected
+
 def test_deckTree():
     d = getEmptyCol()
     d.decks.id("new::b::c")
@@ -1149,3 +1196,155 @@ def test_moveVersions():
     col.sched.unburyCards()
     c.load()
     assert c.queue == c.type == 0
+
+def test_prefetch():
+    d = getEmptyCol()
+    for i in range(20):
+        f = d.newNote()
+        f['Front'] = "note %d" % i
+        d.addNote(f)
+    # some of the cards are due for review
+    d.db.execute("update cards set type=2,queue=2,due=?,ivl=1,factor=2500 "
+                 "where id in (select id from cards limit 8)", d.sched.today)
+    d.reset()
+    # the queues are filled when the first card is shown
+    assert not d.sched.upcomingCards()
+    d.sched.answerCard(d.sched.getCard(), 3)
+    # cards rendered in advance are rendered again once edited
+    upcoming = d.sched.upcomingCards()
+    assert upcoming
+    for c in upcoming:
+        c.q()
+    f = upcoming[0].note()
+    f['Front'] = "edited"
+    f.flush()
+    assert "edited" in d.sched.upcomingCards()[0].q()
+    # the cards returned are the ones in the database, whatever happened
+    # to them since they were loaded
+    r = random.Random(0)
+    def same(c):
+        fresh = d.getCard(c.id)
+        assert [getattr(c, k) for k in ("queue", "type", "due", "ivl",
+                                         "factor", "reps", "left", "mod")] \
+            == [getattr(fresh, k) for k in ("queue", "type", "due", "ivl",
+                                             "factor", "reps", "left", "mod")]
+        assert c.q() == fresh.q()
+    for i in range(60):
+        c = d.sched.getCard()
+        if not c:
+            break
+        same(c)
+        others = [u.id for u in d.sched.upcomingCards()]
+        action = r.randrange(5)
+        if action == 0 and others:
+            d.sched.reschedCards([others[0]], 2, 3)
+        elif action == 1 and others:
+            f = d.getCard(others[-1]).note()
+            f['Front'] += "!"
+            f.flush()
+        elif action == 2:
+            d.sched.answerCard(c, 3)
+            d.undo()
+            d.reset()
+            continue
+        d.sched.answerCard(c, r.randrange(1, 5))
+
+def test_countsCache():
+    d = getEmptyCol()
+    parent = d.decks.id("parent")
+    child = d.decks.id("parent::child")
+    for i in range(30):
+        f = d.newNote()
+        f['Front'] = "note %d" % i
+        f.model()['did'] = (parent, child)[i % 2]
+        d.addNote(f)
+    d.db.execute("update cards set type=2,queue=2,due=?,ivl=1,factor=2500 "
+                 "where id in (select id from cards limit 12)", d.sched.today)
+    d.decks.select(parent)
+    def check():
+        d.reset()
+        counts = d.sched.counts()
+        cached = d.sched._dueCounts()
+        # counting again from scratch gives the same result
+        d.sched._dropCounts()
+        d.reset()
+        assert d.sched.counts() == counts
+        assert d.sched._dueCounts() == cached
+    check()
+    r = random.Random(0)
+    for i in range(40):
+        d.reset()
+        c = d.sched.getCard()
+        if not c:
+            break
+        cids = d.db.list("select id from cards")
+        action = r.randrange(6)
+        if action == 0:
+            d.sched.buryCards([r.choice(cids)])
+        elif action == 1:
+            d.sched.suspendCards([r.choice(cids)])
+        elif action == 2:
+            d.sched.unsuspendCards(cids)
+        elif action == 3:
+            d.db.execute("update cards set did = ? where id = ?",
+                         r.choice((parent, child)), r.choice(cids))
+        elif action == 4:
+            d.sched.answerCard(c, 3)
+            d.undo()
+        else:
+            d.sched.answerCard(c, r.randrange(1, 5))
+        check()
+    # the counts are lost with the transaction creating them
+    d.save()
+    d.sched._dropCounts()
+    d.reset()
+    d.rollback()
+    check()
+
+def test_deferredWrites():
+    d = getEmptyCol()
+    for i in range(10):
+        f = d.newNote()
+        f['Front'] = "note %d" % i
+        d.addNote(f)
+    d.save()
+    d.db.deferLimit = 100
+    d.reset()
+    c = d.sched.getCard()
+    d.sched.answerCard(c, 3)
+    # nothing is written yet, but the collection is modified
+    assert d.db._deferredCount == 2
+    assert d.db.mod
+    # queries see the answer
+    assert d.db.scalar("select queue from cards where id = ?", c.id) == 1
+    assert d.db.scalar("select count() from revlog") == 1
+    assert not d.db._deferredCount
+    # reviews done in the same millisecond have distinct ids
+    for i in range(5):
+        d.sched.answerCard(d.sched.getCard(), 3)
+    d.db.flushDeferred()
+    assert d.db.scalar("select count(distinct id) from revlog") == 6
+    # undo sees the deferred writes
+    c = d.sched.getCard()
+    d.sched.answerCard(c, 3)
+    d.undo()
+    assert d.db.scalar("select count() from revlog") == 6
+    assert d.getCard(c.id).queue == 0
+    # statements are written when enough of them are waiting
+    d.db.deferLimit = 3
+    c = d.sched.getCard()
+    c.flushSched()
+    c.flushSched()
+    assert d.db._deferredCount == 2
+    c.flushSched()
+    assert not d.db._deferredCount
+    # and forgotten on rollback
+    d.sched.answerCard(d.sched.getCard(), 3)
+    d.rollback()
+    assert not d.db.scalar("select count() from revlog")
+    # saving writes them
+    d.reset()
+    d.sched.answerCard(d.sched.getCard(), 3)
+    d.save()
+    d.rollback()
+    assert d.db.scalar("select count() from revlog") == 1
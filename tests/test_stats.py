@@ -1,6 +1,11 @@
 # coding: utf-8
 
 import  os
+import random
+from concurrent.futures import wait
+
+from anki.utils import ids2str
+from anki.stats import CollectionStats, ParallelReport
 from tests.shared import  getEmptyCol
 
 def test_stats():
@@ -29,3 +34,108 @@ def test_graphs():
     with open(os.path.expanduser("~/test.html"), "w") as f:
         f.write(rep)
     return
+
+def test_revlogStats():
+    d = getEmptyCol(schedVer=2)
+    dids = [1, d.decks.id("other")]
+    cids = []
+    for i in range(20):
+        f = d.newNote()
+        f['Front'] = "note %d" % i
+        f.model()['did'] = dids[i % 2]
+        d.addNote(f)
+        cids.append(f.cards()[0].id)
+    r = random.Random(0)
+    cut = d.sched.dayCutoff
+    def addReviews(count):
+        for i in range(count):
+            # some reviews are done at the start or end of an hour, or of
+            # a day
+            ms = (cut - r.randrange(1, 400*24) * 3600) * 1000
+            ms += r.choice([-1, 0, 1, 999, 1000, r.randrange(3600000)])
+            # some of them are of deleted cards
+            cid = r.choice(cids + [1])
+            d.db.execute(
+                "insert or ignore into revlog values (?,?,0,?,?,?,?,?,?)",
+                ms, cid, r.randrange(1, 5), 1, r.choice([-60, 3, 21, 100]),
+                2500, r.randrange(60000), r.randrange(4))
+    def check():
+        g = d.stats()
+        for whole in (False, True):
+            g.wholeCollection = whole
+            for type in range(3):
+                g.type = type
+                results = []
+                for use in (False, True):
+                    g.useRevlogStats = use
+                    results.append((g._done(None, 7), g._done(30, 1),
+                                    g._daysStudied(), g._eases(),
+                                    g._hourRet()))
+                raw, agg = results
+                assert agg[2:] == raw[2:]
+                for (rawDone, aggDone) in zip(raw[:2], agg[:2]):
+                    assert len(rawDone) == len(aggDone)
+                    for (a, b) in zip(rawDone, aggDone):
+                        assert a[:6] == b[:6]
+                        # times are summed in a different order
+                        assert all(abs(x - y) < 1e-9 for (x, y) in
+                                   zip(a[6:], b[6:]))
+    addReviews(3000)
+    check()
+    # the aggregates are kept up to date
+    addReviews(100)
+    d.decks.select(dids[1])
+    check()
+    d.db.execute("update cards set did = ? where id in %s" % ids2str(
+        cids[:5]), dids[1])
+    d.remCards(cids[5:8])
+    d.db.execute("delete from revlog where id in "
+                 "(select id from revlog order by random() limit 50)")
+    c = d.getCard(cids[10])
+    c.flush()
+    check()
+    # and computed again when the collection is modified by another
+    # client
+    d.save()
+    d.revlogStats._dropTriggers()
+    addReviews(10)
+    d.db.execute("update col set mod = mod + 1")
+    d.db.commit()
+    d.load()
+    assert not d.revlogStats._tracking()
+    check()
+
+def test_parallelReport():
+    d = getEmptyCol(schedVer=2)
+    for i in range(10):
+        f = d.newNote()
+        f['Front'] = "note %d" % i
+        d.addNote(f)
+    d.reset()
+    for i in range(5):
+        d.sched.answerCard(d.sched.getCard(), 3)
+    for type in range(3):
+        report = ParallelReport(d.stats(), type)
+        assert report.supported()
+        report.start()
+        # the reviews were saved, so that the other connections see them
+        assert not d.db.mod
+        txt = report.html()
+        sections = report.completed()
+        assert [name for (name, html) in sections] == list(
+            CollectionStats.sections)
+        assert txt == report.stats._assemble(
+            [html for (name, html) in sections])
+        stats = d.stats()
+        stats.type = type
+        for name, html in sections:
+            # the footer contains the current time
+            if name != "footer":
+                assert html == stats._sectionHtml(name)
+    # the report can be cancelled
+    report = ParallelReport(d.stats(), threads=1)
+    report.start()
+    report.cancel()
+    wait(report._futures.values())
+    assert report.done()
+    assert not report._dbs
@@ -0,0 +1,65 @@
+# coding: utf-8
+
+from anki.template import Template, render
+from anki.template.template import CompiledTemplate
+from anki.hooks import addHook, remHook
+from tests.shared import assertException
+
+def legacy(template, context):
+    return Template(template, context).render()
+
+def check(template, context):
+    compiled = CompiledTemplate(template)
+    try:
+        expected = legacy(template, context)
+    except Exception as e:
+        assertException(type(e), lambda: compiled.render(context))
+        return
+    # twice, to also use the cached nodes
+    for i in range(2):
+        assert compiled.render(context) == expected
+
+def test_compiledSameOutput():
+    fields = {'Front': 'one', 'Back': '<b>two</b>', 'Empty': ' <br> ',
+              'Text': 'a {{c1::b::hint}} {{c2::c}}', 'Tags': 'x y',
+              'Braces': 'f(x) = {a}', 'Curly': '{{Front}}', 'c1': '1'}
+    templates = [
+        "",
+        "no tags at all",
+        "{{Front}} and {{Back}} and {{Front}}",
+        "{{{Front}}} {{!comment}} {{ Back }}",
+        "{{text:Back}} {{type:Front}} {{Missing}} {{foo:Missing}}",
+        "{{#Front}}yes {{Back}}{{/Front}}{{^Front}}no{{/Front}}",
+        "{{#Empty}}shown{{/Empty}}{{^Empty}}hidden{{/Empty}}",
+        "{{#Front}}{{#Back}}both{{/Back}}{{/Front}}",
+        "{{cq-1:Text}}|{{ca-2:Text}}|{{cloze:Text}}",
+        "{{#cq:1:Text}}has c1{{/cq:1:Text}}",
+        "{{Braces}} and {{Front}}",
+        "{{Curly}} then {{Back}}",
+        "{{Front}}{{Front}}}",
+        "{{&Front}}",
+        "{{#Front}}unterminated",
+        "{{=<% %>=}}<%Front%>",
+        "{{Front {{Back}}",
+        "{{Front}} {{x {{Front}}",
+        " ".join("{{f%d}}" % i for i in range(120)),
+    ]
+    for template in templates:
+        check(template, fields)
+        check(template, {})
+
+def test_compiledFilters():
+    def upper(txt, extra, context, tag, fullname):
+        return txt.upper() + extra
+    addHook("fmod_upper", upper)
+    try:
+        check("{{upper:Front}} {{upper(!):Back}} {{nope:Front}}",
+              {'Front': 'abc', 'Back': 'def'})
+    finally:
+        remHook("fmod_upper", upper)
+
+def test_render():
+    assert render("{{Front}}-{{#Back}}{{Back}}{{/Back}}",
+                  {'Front': 'a', 'Back': 'b'}) == "a-b"
+    assert render("{{Front}}-{{#Back}}{{Back}}{{/Back}}",
+                  {'Front': 'a', 'Back': ''}) == "a-"
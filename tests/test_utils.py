@@ -1,7 +1,24 @@
 # coding: utf-8
 
-from anki.utils import fmtTimeSpan
+from anki.utils import fmtTimeSpan, json, JsonCache
 
 def test_fmtTimeSpan():
     assert fmtTimeSpan(5) == "5 seconds"
     assert fmtTimeSpan(5, inTime=True) == "in 5 seconds"
+
+def test_jsonCache():
+    objs = {"1": {"name": "a"}, "2": {"name": "b", "list": [1, 2]}}
+    cache = JsonCache()
+    assert cache.dumps(objs) == json.dumps(objs)
+    # values which aren't marked are not serialized again
+    objs["1"]["name"] = "c"
+    objs["2"]["name"] = "d"
+    cache.mark("2")
+    objs["3"] = {"name": "é"}
+    cache.mark("3")
+    del objs["1"]
+    assert json.loads(cache.dumps(objs)) == {
+        "2": {"name": "d", "list": [1, 2]}, "3": {"name": "é"}}
+    objs["2"]["name"] = "e"
+    cache.mark()
+    assert cache.dumps(objs) == json.dumps(objs)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""Time importing a .anki2 file into a collection, and measure the peak
+memory used by python while doing so.
+
+Half of the notes of the file are already in the collection, half of
+those are more recent in the file and so are updated, and each note has
+two cards with a review each.
+
+Usage: PYTHONPATH=. tools/bench/apkgimport.py [notes...]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from anki import Collection
+from anki.importing import Anki2Importer
+from anki.utils import intTime
+
+def buildCol(path, empty, nids, mod):
+    """Copy the collection empty to path, and add the notes whose id is in
+    nids, with their cards and revlog."""
+    shutil.copy(empty, path)
+    col = Collection(path)
+    mid = col.models.byName("Basic (and reversed card)")['id']
+    col.db.executemany(
+        "insert into notes values (?,?,?,?,0,'','front\x1fback','front',0,0,'')",
+        ((nid, "g%d" % nid, mid, mod) for nid in nids))
+    col.db.executemany("""
+insert into cards values (?,?,1,?,0,0,2,2,10,5,2500,1,0,0,0,0,0,'')""",
+        ((nid*2 + ord, nid, ord) for nid in nids for ord in range(2)))
+    col.db.executemany("""
+insert into revlog values (?,?,0,3,5,1,2500,1000,1)""",
+        ((nid*2 + ord, nid*2 + ord) for nid in nids for ord in range(2)))
+    col.close()
+
+def importTime(tmp, n):
+    # both collections need the same models
+    empty = os.path.join(tmp, "empty.anki2")
+    if not os.path.exists(empty):
+        Collection(empty).close()
+    src = os.path.join(tmp, "src.anki2")
+    dst = os.path.join(tmp, "dst.anki2")
+    base = intTime(1000) * 10
+    buildCol(src, empty, range(base, base + n), 2)
+    buildCol(dst, empty, range(base + n//2, base + n + n//2), 1)
+    col = Collection(dst)
+    # the collection's notes more recent than the file's are identical
+    col.db.execute("update notes set mod = 3 where id >= ?", base + 3*n//4)
+    tracemalloc.start()
+    t = time.time()
+    imp = Anki2Importer(col, src)
+    imp.run()
+    t = time.time() - t
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert (imp.added, imp.updated, imp.dupes) == (n//2, n//4, n//4)
+    col.close()
+    os.unlink(src)
+    os.unlink(dst)
+    return t, peak
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [1000, 10000, 100000]
+    tmp = tempfile.mkdtemp()
+    try:
+        print("%-8s %10s %10s" % ("notes", "time", "peak"))
+        for n in sizes:
+            t, peak = importTime(tmp, n)
+            print("%-8d %9.2fs %8.1fMB" % (n, t, peak / 1024 / 1024))
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main()
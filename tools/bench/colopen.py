@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""Time opening a collection and running a first query, for small,
+medium and huge collections.
+
+The eager column also decodes the models, decks, deck options and tags,
+as opening a collection used to; the lazy column only decodes what the
+query needs, i.e. nothing.
+
+Usage: PYTHONPATH=. tools/bench/colopen.py [runs]
+"""
+
+import copy
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from anki import Collection
+from anki.utils import intTime
+
+# name: (decks, models, tags)
+sizes = (
+    ("small", 10, 5, 10),
+    ("medium", 1000, 50, 1000),
+    ("huge", 10000, 300, 20000),
+)
+
+def buildCol(path, ndecks, nmodels, ntags):
+    col = Collection(path)
+    # bypass id() and add(), which check names against every deck/model
+    deck = col.decks.get(1)
+    for i in range(ndecks):
+        g = copy.deepcopy(deck)
+        g['id'] = intTime(1000) + i
+        g['name'] = "top%d::deck%d" % (i // 100, i)
+        col.decks.decks[str(g['id'])] = g
+    col.decks.save()
+    model = col.models.current()
+    for i in range(nmodels):
+        m = copy.deepcopy(model)
+        m['id'] = str(intTime(1000) + i)
+        m['name'] = "model%d" % i
+        m['css'] = model['css'] + ".c%d { color: red; }\n" % i * 500
+        col.models.models[m['id']] = m
+    col.models.save()
+    col.tags.register(["tag%d" % i for i in range(ntags)])
+    col.close()
+
+def openTime(path, eager):
+    t = time.time()
+    col = Collection(path)
+    if eager:
+        col.models.models, col.decks.decks, col.decks.dconf, col.tags.tags
+    col.db.scalar("select count() from cards")
+    t = time.time() - t
+    col.close(save=False)
+    return t
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    tmp = tempfile.mkdtemp()
+    try:
+        print("%-8s %10s %10s" % ("", "eager", "lazy"))
+        for name, ndecks, nmodels, ntags in sizes:
+            path = os.path.join(tmp, name + ".anki2")
+            buildCol(path, ndecks, nmodels, ntags)
+            res = []
+            for eager in (True, False):
+                res.append(statistics.median(
+                    openTime(path, eager) for i in range(runs)))
+            print("%-8s %8.1fms %8.1fms" % (name, res[0]*1000, res[1]*1000))
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main()
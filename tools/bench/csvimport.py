@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""Time importing a tab separated file into a collection, and measure the
+peak memory used by python while doing so.
+
+The collection already contains a tenth of the notes of the file, with
+another back, so that they are updated.
+
+Usage: PYTHONPATH=. tools/bench/csvimport.py [lines...]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from anki import Collection
+from anki.importing import TextImporter
+
+def importTime(tmp, n):
+    path = os.path.join(tmp, "words.txt")
+    with open(path, "w", encoding="utf8") as f:
+        for i in range(n):
+            f.write("word%d\tthe meaning of word %d with some text\n" % (i, i))
+    col = Collection(os.path.join(tmp, "col%d.anki2" % n))
+    for i in range(0, n, 10):
+        note = col.newNote()
+        note['Front'] = "word%d" % i
+        note['Back'] = "old"
+        col.addNote(note)
+    col.save()
+    tracemalloc.start()
+    t = time.time()
+    imp = TextImporter(col, path)
+    imp.initMapping()
+    imp.run()
+    t = time.time() - t
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert imp.total == n
+    assert col.noteCount() == n
+    col.close()
+    return t, peak
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [10000, 100000]
+    tmp = tempfile.mkdtemp()
+    try:
+        print("%-8s %10s %10s" % ("lines", "time", "peak"))
+        for n in sizes:
+            t, peak = importTime(tmp, n)
+            print("%-8d %9.2fs %8.1fMB" % (n, t, peak / 1024 / 1024))
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main()
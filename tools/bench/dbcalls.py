@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""Time the small queries the scheduler and the browser issue by the
+thousand, with the profiler off and on, and print the profiler's
+report.
+
+Usage: PYTHONPATH=. tools/bench/dbcalls.py [calls]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from anki import Collection
+
+def callTime(col, n):
+    "The mean time taken by a scalar query and an update."
+    t = time.perf_counter()
+    for i in range(n):
+        col.db.scalar("select count() from cards where id = ?", i)
+        col.db.execute("update col set ls = ?", i)
+    return (time.perf_counter() - t) / n / 2
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    tmp = tempfile.mkdtemp()
+    try:
+        col = Collection(os.path.join(tmp, "dbcalls.anki2"))
+        print("%-12s %8.2fus" % ("off", callTime(col, n) * 1e6))
+        profiler = col.db.startProfiling()
+        print("%-12s %8.2fus" % ("profiling", callTime(col, n) * 1e6))
+        col.db.stopProfiling()
+        print(profiler.dump(col.db))
+        col.close()
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""Time Scheduler.deckDueList() for a growing number of decks.
+
+The per-deck column runs the _newForDeck/_lrnForDeck/_revForDeck
+queries for each deck, as deckDueList used to. The grouped column is
+the current deckDueList, which scans the cards once.
+
+Usage: PYTHONPATH=. tools/bench/deckdue.py [--sched 1|2] [decks ...]
+"""
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from anki import Collection
+from anki.collection import _Collection
+from anki.utils import intTime
+
+def buildCol(path, ndecks, cardsPerDeck, schedVer):
+    _Collection.defaultSchedulerVersion = schedVer
+    col = Collection(path)
+    random.seed(0)
+    m = col.models.current()
+    for i in range(ndecks):
+        # three levels of nesting
+        name = "top%d::mid%d::leaf%d" % (i // 100, i // 10, i)
+        m['did'] = col.decks.id(name)
+        col.models.save(m)
+        for j in range(cardsPerDeck):
+            n = col.newNote()
+            n['Front'] = "%d-%d" % (i, j)
+            col.addNote(n)
+    # spread the cards over the queues
+    today = col.sched.today
+    for (cid,) in col.db.execute("select id from cards").fetchall():
+        queue = random.choice((0, 0, 1, 2, 2, 3))
+        due = {0: cid, 1: intTime() - 60, 3: today}.get(
+            queue, today - random.randint(0, 5))
+        col.db.execute("update cards set queue=?, type=?, due=?, left=1001 "
+                       "where id=?", queue, min(queue, 2), due, cid)
+    col.close()
+
+def perDeck(col):
+    "deckDueList as it was: several queries for every deck."
+    sched = col.sched
+    decks = sorted(col.decks.all(), key=lambda d: d['name'])
+    childMap = col.decks.childMap()
+    lims = {}
+    data = []
+    for deck in decks:
+        p = "::".join(deck['name'].split("::")[:-1])
+        nlim = sched._deckNewLimitSingle(deck)
+        if p:
+            nlim = min(nlim, lims[p][0])
+        new = sched._newForDeck(deck['id'], nlim)
+        lrn = sched._lrnForDeck(deck['id'])
+        if col.schedVer() == 1:
+            rlim = sched._deckRevLimitSingle(deck)
+            if p:
+                rlim = min(rlim, lims[p][1])
+            rev = sched._revForDeck(deck['id'], rlim)
+        else:
+            rlim = sched._deckRevLimitSingle(
+                deck, parentLimit=lims[p][1] if p else None)
+            rev = sched._revForDeck(deck['id'], rlim, childMap)
+        data.append([deck['name'], deck['id'], rev, lrn, new])
+        lims[deck['name']] = [nlim, rlim]
+    return data
+
+def best(fn, runs=3):
+    times = []
+    for i in range(runs):
+        t = time.time()
+        res = fn()
+        times.append(time.time() - t)
+    return min(times), res
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sched", type=int, default=2)
+    parser.add_argument("--cards", type=int, default=10,
+                        help="cards per deck")
+    parser.add_argument("decks", type=int, nargs="*",
+                        default=[100, 1000, 3000])
+    args = parser.parse_args()
+    tmp = tempfile.mkdtemp()
+    print("%8s %8s %12s %12s" % ("decks", "cards", "per-deck", "grouped"))
+    try:
+        for ndecks in args.decks:
+            path = os.path.join(tmp, "bench%d.anki2" % ndecks)
+            buildCol(path, ndecks, args.cards, args.sched)
+            col = Collection(path)
+            col.sched.deckDueList()
+            old, expected = best(lambda: perDeck(col))
+            new, got = best(col.sched.deckDueList)
+            assert got == expected
+            print("%8d %8d %10.1fms %10.1fms" % (
+                col.decks.count(), col.cardCount(), old*1000, new*1000))
+            col.close()
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""Time the operations of the deck manager walking the deck tree, on a
+collection with many nested decks: creating them, looking them up by
+name, listing their children and parents, renaming and removing them.
+
+Usage: PYTHONPATH=. tools/bench/decktree.py [decks]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from anki import Collection
+
+def deckNames(n):
+    "n names of decks, three levels deep, ten children per deck."
+    names = []
+    i = 0
+    while len(names) < n:
+        top = "Top %d" % i
+        names.append(top)
+        for j in range(10):
+            names.append("%s::Sub %d" % (top, j))
+            for k in range(8):
+                names.append("%s::Sub %d::Leaf %d" % (top, j, k))
+        i += 1
+    return names[:n]
+
+def timed(label, fn):
+    t = time.time()
+    fn()
+    print("%-28s %9.3fs" % (label, time.time() - t))
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    tmp = tempfile.mkdtemp()
+    try:
+        col = Collection(os.path.join(tmp, "collection.anki2"))
+        decks = col.decks
+        names = deckNames(n)
+        timed("create %d decks" % n,
+              lambda: [decks.id(name) for name in names])
+        dids = [int(did) for did in decks.allIds()]
+        timed("look up by name",
+              lambda: [decks.id(name.upper(), create=False) for name in names])
+        timed("byName", lambda: [decks.byName(name) for name in names])
+        timed("children", lambda: [decks.children(did) for did in dids])
+        timed("parents", lambda: [decks.parents(did) for did in dids])
+        timed("select", lambda: [decks.select(did) for did in dids[:1000]])
+        timed("search deck:", lambda: [col.findCards('"deck:%s"' % name)
+                                       for name in names[:1000]])
+        tops = [decks.id(name) for name in names if "::" not in name]
+        timed("rename top decks", lambda: [
+            decks.rename(decks.get(did), "Renamed::%d" % did)
+            for did in tops])
+        timed("remove top decks", lambda: [decks.rem(did) for did in tops])
+        col.close()
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""Time exporting a whole collection as an .apkg, and measure the peak
+memory used by python while doing so.
+
+Each note has two cards with a review each, and every tenth card's note
+references a media file of its own.
+
+Usage: PYTHONPATH=. tools/bench/export.py [cards] [media files]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from anki import Collection
+from anki.exporting import AnkiPackageExporter
+from anki.utils import intTime
+
+def buildCol(path, n, files):
+    col = Collection(path)
+    mid = col.models.byName("Basic (and reversed card)")['id']
+    base = intTime(1000) * 10
+    nids = range(base, base + n//2)
+    step = max(1, (n//2) // files) if files else n
+    def flds(nid):
+        if (nid - base) % step or (nid - base) // step >= files:
+            return "front %d\x1fback" % nid
+        return "front\x1f<img src=\"img%d.jpg\">" % ((nid - base) // step)
+    col.db.executemany(
+        "insert into notes values (?,?,?,1,0,' tag ',?,'front',0,0,'')",
+        ((nid, "g%d" % nid, mid, flds(nid)) for nid in nids))
+    col.db.executemany("""
+insert into cards values (?,?,1,?,0,0,2,2,10,5,2500,1,0,0,0,0,0,'')""",
+        ((nid*2 + ord, nid, ord) for nid in nids for ord in range(2)))
+    col.db.executemany("""
+insert into revlog values (?,?,0,3,5,1,2500,1000,1)""",
+        ((nid*2 + ord, nid*2 + ord) for nid in nids for ord in range(2)))
+    mdir = col.media.dir()
+    data = os.urandom(2000)
+    for i in range(files):
+        with open(os.path.join(mdir, "img%d.jpg" % i), "wb") as f:
+            f.write(data)
+    # the index of the files referenced is kept in the collection
+    col.noteMedia.check()
+    col.close()
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    files = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, "collection.anki2")
+        buildCol(path, n, files)
+        col = Collection(path)
+        e = AnkiPackageExporter(col)
+        e.includeSched = True
+        tracemalloc.start()
+        t = time.time()
+        e.exportInto(os.path.join(tmp, "exported.apkg"))
+        t = time.time() - t
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        assert e.count == n
+        assert len(e.mediaFiles) == files
+        print("%-8s %-8s %10s %10s" % ("cards", "media", "time", "peak"))
+        print("%-8d %-8d %9.2fs %8.1fMB" % (n, files, t, peak / 1024 / 1024))
+        col.close()
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main()
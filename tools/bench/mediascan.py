@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""Time the first scan of a media folder into which many files were
+copied, and measure the peak memory used by python while doing so, for
+one hashing thread and for the default number of threads.
+
+Usage: PYTHONPATH=. tools/bench/mediascan.py [files [kilobytes]]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from anki import Collection
+from anki.media import MediaManager
+
+def scanTime(tmp, n, size, threads):
+    col = Collection(os.path.join(tmp, "col%d.anki2" % threads))
+    mdir = col.media.dir()
+    for i in range(n):
+        with open(os.path.join(mdir, "sound%d.mp3" % i), "wb") as f:
+            f.write(os.urandom(size))
+    col.media.hashThreads = threads
+    tracemalloc.start()
+    t = time.time()
+    col.media.findChanges()
+    t = time.time() - t
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert col.media.dirtyCount() == n
+    col.close()
+    return t, peak
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    size = (int(sys.argv[2]) if len(sys.argv) > 2 else 512) * 1024
+    tmp = tempfile.mkdtemp()
+    try:
+        print("%-8s %10s %10s" % ("threads", "time", "peak"))
+        for threads in sorted(set([1, MediaManager.hashThreads])):
+            t, peak = scanTime(tmp, n, size, threads)
+            print("%-8d %9.2fs %8.1fMB" % (threads, t, peak / 1024 / 1024))
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""Time the initial media sync of an empty collection, downloading many
+files from a local stand-in for the media server, then uploading them
+to it again, with one zip in flight and with SYNC_ZIP_PARALLEL zips in
+flight.
+
+The stand-in waits for the given latency before answering each request,
+as a remote server would.
+
+Usage: PYTHONPATH=. tools/bench/mediasync.py [files [milliseconds]]
+"""
+
+import gzip
+import http.server
+import io
+import json
+import os
+import shutil
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+import anki.sync
+from anki import Collection
+from anki.consts import SYNC_ZIP_COUNT
+from anki.sync import MediaSyncer, RemoteMediaServer
+from anki.utils import checksum
+
+class StandIn(http.server.BaseHTTPRequestHandler):
+    "Serve the files of the folder store, and accept uploads."
+
+    store = None
+    # list of (fname, usn, csum)
+    changes = []
+    latency = 0
+
+    def do_POST(self):
+        time.sleep(self.latency)
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        vars = {}
+        for part in body.split(b"--Anki-sync-boundary")[1:-1]:
+            head, value = part[2:-2].split(b"\r\n\r\n", 1)
+            name = head.split(b'name="')[1].split(b'"')[0].decode("utf8")
+            vars[name] = value
+        data = vars.get("data", b"")
+        if vars['c'] == b"1":
+            data = gzip.decompress(data)
+        method = self.path.split("/")[-1]
+        if method == "downloadFiles":
+            reply = self.downloadFiles(json.loads(data.decode("utf8")))
+        else:
+            if method == "begin":
+                ret = dict(sk="key", usn=len(self.changes))
+            elif method == "mediaChanges":
+                usn = json.loads(data.decode("utf8"))['lastUsn']
+                ret = self.changes[usn:usn+250]
+            elif method == "uploadChanges":
+                z = zipfile.ZipFile(io.BytesIO(data))
+                meta = json.loads(z.read("_meta").decode("utf8"))
+                for fname, zipname in meta:
+                    self.changes.append([fname, len(self.changes) + 1,
+                                         checksum(z.read(zipname))])
+                ret = [len(meta), len(self.changes)]
+            else:
+                ret = "OK"
+            reply = json.dumps(dict(data=ret, err="")).encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def downloadFiles(self, args):
+        f = io.BytesIO()
+        z = zipfile.ZipFile(f, "w", compression=zipfile.ZIP_DEFLATED)
+        meta = {}
+        for c, fname in enumerate(args['files'][:SYNC_ZIP_COUNT]):
+            z.write(os.path.join(self.store, fname), str(c))
+            meta[str(c)] = fname
+        z.writestr("_meta", json.dumps(meta))
+        z.close()
+        return f.getvalue()
+
+    def log_message(self, *args):
+        pass
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+def buildStore(tmp, n):
+    store = os.path.join(tmp, "store")
+    os.makedirs(store)
+    for i in range(n):
+        fname = "sound%d.mp3" % i
+        data = os.urandom(2048)
+        with open(os.path.join(store, fname), "wb") as f:
+            f.write(data)
+        StandIn.changes.append([fname, i + 1, checksum(data)])
+    StandIn.store = store
+
+def syncTime(tmp, n, parallel):
+    del StandIn.changes[n:]
+    col = Collection(os.path.join(tmp, "col%d.anki2" % parallel))
+    anki.sync.SYNC_ZIP_PARALLEL = parallel
+    server = RemoteMediaServer(col, "hkey", None, None)
+    client = MediaSyncer(col, server)
+    t = time.time()
+    assert client.sync() == "OK"
+    down = time.time() - t
+    assert client.downloadCount == n
+    # upload them again
+    col.media.db.execute("update media set dirty = 1")
+    t = time.time()
+    assert client.sync() == "OK"
+    up = time.time() - t
+    assert not col.media.dirtyCount()
+    col.close()
+    return down, up
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    StandIn.latency = (int(sys.argv[2]) if len(sys.argv) > 2 else 20) / 1000
+    tmp = tempfile.mkdtemp()
+    buildStore(tmp, n)
+    server = Server(("127.0.0.1", 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:%d/msync/" % server.server_address[1]
+    RemoteMediaServer.syncURL = lambda self: url
+    try:
+        print("%-9s %10s %10s %12s" % ("parallel", "download", "upload",
+                                        "files/s down"))
+        for parallel in sorted(set([1, anki.sync.SYNC_ZIP_PARALLEL])):
+            down, up = syncTime(tmp, n, parallel)
+            print("%-9d %9.2fs %9.2fs %12d" % (parallel, down, up, n / down))
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main()
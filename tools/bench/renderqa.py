@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""Render cards through _Collection._renderQA, with the templates parsed
+for every card as before, then with the cached compiled templates.
+
+Usage: PYTHONPATH=. tools/bench/renderqa.py [cards]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import anki.collection
+import anki.template
+from anki import Collection
+from anki.template import Template
+
+def legacyRender(template, context=None, **kwargs):
+    context = context and context.copy() or {}
+    context.update(kwargs)
+    return Template(template, context).render()
+
+def buildCol(path):
+    col = Collection(path)
+    # basic with an optional reverse card, and cloze
+    basic = col.models.byName("Basic (optional reversed card)")
+    cloze = col.models.byName("Cloze")
+    for i in range(200):
+        col.models.setCurrent(basic)
+        n = col.newNote()
+        n['Front'] = "front <b>%d</b>" % i
+        n['Back'] = "back %d<br><img src=\"img%d.jpg\">" % (i, i)
+        n['Add Reverse'] = "y" if i % 2 else ""
+        col.addNote(n)
+        col.models.setCurrent(cloze)
+        n = col.newNote()
+        n['Text'] = "{{c1::capital}} of {{c2::France::country}} is %d" % i
+        col.addNote(n)
+    col.save()
+    return col
+
+def run(col, total):
+    rows = list(col._qaData())
+    t = time.time()
+    done = 0
+    while done < total:
+        for row in rows[:total - done]:
+            col._renderQA(row)
+        done += min(len(rows), total - done)
+    return time.time() - t
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    tmp = tempfile.mkdtemp()
+    try:
+        col = buildCol(os.path.join(tmp, "bench.anki2"))
+        rows = list(col._qaData())
+        compiledOut = [col._renderQA(r) for r in rows]
+        new = run(col, total)
+        render, clozeFormat = anki.template.render, anki.collection.clozeFormat
+        anki.template.render = legacyRender
+        anki.collection.clozeFormat = clozeFormat.__wrapped__
+        try:
+            assert [col._renderQA(r) for r in rows] == compiledOut
+            old = run(col, total)
+        finally:
+            anki.template.render = render
+            anki.collection.clozeFormat = clozeFormat
+        print("%d cards: parsed each time %.2fs, compiled %.2fs (%.1fx)" % (
+            total, old, new, old / new))
+        col.close()
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""Time resetting the scheduler after answering a card, in a collection
+with many decks: with the queries counting the new and review cards of
+each deck used before the counts were cached, when the cached counts are
+built from scratch at each reset, and when they are kept up to date by
+triggers.
+
+Usage: PYTHONPATH=. tools/bench/reset.py [cards] [decks]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from anki import Collection
+from anki.consts import QUEUE_NEW_CRAM, QUEUE_REV
+from anki.utils import ids2str
+
+def buildCol(path, n, decks):
+    col = Collection(path)
+    col.changeSchedulerVer(2)
+    dids = [col.decks.id("top::deck %d" % i) for i in range(decks)]
+    conf = col.decks.confForDid(dids[0])
+    conf['new']['perDay'] = conf['rev']['perDay'] = n
+    col.decks.save(conf)
+    r = random.Random(0)
+    model = col.models.current()
+    for i in range(n):
+        model['did'] = r.choice(dids)
+        note = col.newNote()
+        note['Front'] = "question %d" % i
+        col.addNote(note)
+    # half the cards are due for review
+    col.db.execute("""
+update cards set type = 2, queue = 2, ivl = 1, factor = 2500,
+due = ? - abs(random() % 10) where id % 2 = 0""", col.sched.today)
+    col.decks.select(col.decks.id("top"))
+    col.save()
+    return col
+
+def previousCounts(sched):
+    """Make sched count the new and review cards with the queries it used
+    before the counts were cached in sched_counts."""
+    def resetNewCount():
+        cntFn = lambda did, lim: sched.col.db.scalar(("""
+select count() from (select 1 from cards where
+did = ? and queue = %d limit ?)"""%QUEUE_NEW_CRAM), did, lim)
+        sched.newCount = sched._walkingCount(sched._deckNewLimitSingle, cntFn)
+    def resetRevCount():
+        lim = sched._currentRevLimit()
+        sched.revCount = sched.col.db.scalar("""
+select count() from (select id from cards where
+did in %s and queue = %d and due <= ? limit %d)""" % (
+            ids2str(sched.col.decks.active()), QUEUE_REV, lim), sched.today)
+    sched._resetNewCount = resetNewCount
+    sched._resetRevCount = resetRevCount
+
+def resetTime(col, reps, mode):
+    """The mean time taken by reset() after answering a card.
+
+    mode -- "previous", "from scratch" or "triggers", as described
+    above."""
+    if mode == "previous":
+        previousCounts(col.sched)
+    col.reset()
+    total = 0
+    for i in range(reps):
+        col.sched.answerCard(col.sched.getCard(), 3)
+        if mode == "from scratch":
+            col.sched._dropCounts()
+        t = time.time()
+        col.reset()
+        total += time.time() - t
+    col.rollback()
+    # back to the scheduler's own methods
+    for name in ("_resetNewCount", "_resetRevCount"):
+        col.sched.__dict__.pop(name, None)
+    return total / reps
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    decks = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    tmp = tempfile.mkdtemp()
+    try:
+        col = buildCol(os.path.join(tmp, "reset.anki2"), n, decks)
+        for mode in ("previous", "from scratch", "triggers"):
+            print("%-12s %8.3fms" % (mode, resetTime(col, 50, mode) * 1000))
+        col.close()
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""Time what the reviewer waits for between answering a card and
+showing the next question: answering, then getting the next card and
+rendering its question. This is measured with a single card loaded at
+a time, then with the cards prefetched and the upcoming ones rendered
+while the answer is shown, then with the answers also written in
+batches, as the reviewer does.
+
+Usage: PYTHONPATH=. tools/bench/review.py [cards]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from anki import Collection
+
+def buildCol(path, n):
+    col = Collection(path)
+    col.changeSchedulerVer(2)
+    conf = col.decks.confForDid(1)
+    conf['new']['perDay'] = n
+    col.decks.save(conf)
+    for i in range(n):
+        note = col.newNote()
+        note['Front'] = "question %d {{c1::not a cloze}}" % i
+        note['Back'] = "answer %d <b>bold</b> [sound:s%d.mp3]" % (i, i)
+        col.addNote(note)
+    col.save()
+    return col
+
+def reviewTime(col, n, prefetch, defer):
+    """The mean time taken to answer a card, and to get and render the next
+    question."""
+    col.sched.prefetchLimit = 10 if prefetch else 0
+    col.db.deferLimit = 100 if defer else 0
+    col.reset()
+    answering = showing = 0
+    card = col.sched.getCard()
+    card.q()
+    for i in range(n - 1):
+        card.a()
+        if prefetch:
+            # done by the reviewer while the answer is shown
+            for c in col.sched.upcomingCards():
+                c.q()
+                c.a()
+        t = time.time()
+        col.sched.answerCard(card, 4)
+        t2 = time.time()
+        card = col.sched.getCard()
+        card.q()
+        answering += t2 - t
+        showing += time.time() - t2
+    col.rollback()
+    return answering / (n - 1), showing / (n - 1)
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    tmp = tempfile.mkdtemp()
+    try:
+        col = buildCol(os.path.join(tmp, "review.anki2"), n)
+        print("%-12s %10s %10s" % ("", "answer", "next card"))
+        for name, prefetch, defer in (("one by one", False, False),
+                                      ("prefetch", True, False),
+                                      ("batch writes", True, True)):
+            answering, showing = reviewTime(col, n, prefetch, defer)
+            print("%-12s %8.3fms %8.3fms" % (
+                name, answering * 1000, showing * 1000))
+        col.close()
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""Time the statistics of a collection with a large revlog, for each
+period, when the graphs read every review, when they read the
+aggregates of RevlogStats, and when the sections are also computed by
+a ParallelReport. The first report with the aggregates also computes
+them.
+
+Usage: PYTHONPATH=. tools/bench/stats.py [reviews]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from anki import Collection
+from anki.stats import ParallelReport
+
+def buildCol(path, reviews):
+    col = Collection(path)
+    col.changeSchedulerVer(2)
+    cids = []
+    for i in range(1000):
+        note = col.newNote()
+        note['Front'] = "question %d" % i
+        col.addNote(note)
+        cids.append(note.cards()[0].id)
+    r = random.Random(0)
+    # five years of reviews, done in two sessions of an hour a day
+    days = 5*365
+    sessions = [(col.sched.dayCutoff - (day+1)*86400 + hour*3600) * 1000
+                for day in range(days) for hour in r.sample(range(24), 2)]
+    col.db.executemany(
+        "insert or ignore into revlog values (?,?,0,?,?,?,2500,?,?)",
+        ((r.choice(sessions) + r.randrange(3600000), r.choice(cids),
+          r.randrange(1, 5), r.randrange(1, 100), r.randrange(-60, 100),
+          r.randrange(60000), r.randrange(4)) for i in range(reviews)))
+    col.save()
+    return col
+
+def reportTime(col, type, useRevlogStats):
+    stats = col.stats()
+    stats.useRevlogStats = useRevlogStats
+    t = time.time()
+    stats.report(type)
+    return time.time() - t
+
+def parallelTime(col, type):
+    report = ParallelReport(col.stats(), type)
+    t = time.time()
+    report.start()
+    report.html()
+    return time.time() - t
+
+def main():
+    reviews = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    tmp = tempfile.mkdtemp()
+    try:
+        col = buildCol(os.path.join(tmp, "stats.anki2"), reviews)
+        print("%-12s %10s %10s %10s" % ("", "revlog", "aggregates",
+                                        "parallel"))
+        t = time.time()
+        col.revlogStats.check(col.sched.dayCutoff)
+        print("%-12s %10s %9.3fs" % ("computing", "", time.time() - t))
+        for type, name in enumerate(("month", "year", "deck life")):
+            print("%-12s %9.3fs %9.3fs %9.3fs" % (
+                name, reportTime(col, type, False),
+                reportTime(col, type, True), parallelTime(col, type)))
+        col.close()
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main()
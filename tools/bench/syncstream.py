@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""Measure the peak memory of a full sync, against a local stand-in for
+the sync server, for collections of growing size.
+
+The stand-in stores the uploaded collection, and sends it back on
+download. The peak is the one of the memory allocated by Python while
+uploading, and then downloading, the collection; it should not depend
+on the collection's size.
+
+Usage: PYTHONPATH=. tools/bench/syncstream.py [megabytes ...]
+"""
+
+import gzip
+import http.server
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import tracemalloc
+
+from anki import Collection
+from anki.sync import FullSyncer, HTTP_BUF_SIZE
+
+class StandIn(http.server.BaseHTTPRequestHandler):
+    "Accept uploads, and answer downloads with the last upload."
+
+    store = None
+
+    def do_POST(self):
+        # the multipart body is only kept for uploads
+        left = int(self.headers['Content-Length'])
+        body = tempfile.TemporaryFile()
+        while left:
+            data = self.rfile.read(min(left, HTTP_BUF_SIZE))
+            left -= len(data)
+            body.write(data)
+        if self.path.endswith("/upload"):
+            # skip the post vars and the data header, up to the payload,
+            # and the final boundary
+            body.seek(0)
+            head = body.read(HTTP_BUF_SIZE)
+            start = head.index(b"\r\n\r\n", head.index(b'name="data"')) + 4
+            left = body.seek(0, 2) - start - len(
+                b"\r\n--Anki-sync-boundary--\r\n")
+            body.seek(start)
+            payload = tempfile.TemporaryFile()
+            while left:
+                data = body.read(min(left, HTTP_BUF_SIZE))
+                left -= len(data)
+                payload.write(data)
+            payload.seek(0)
+            with gzip.GzipFile(fileobj=payload) as src, \
+                 open(self.store, "wb") as dst:
+                shutil.copyfileobj(src, dst, HTTP_BUF_SIZE)
+            payload.close()
+            reply = b"OK"
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(reply)))
+            self.end_headers()
+            self.wfile.write(reply)
+        else:
+            self.send_response(200)
+            self.send_header("Content-Length", str(os.path.getsize(self.store)))
+            self.end_headers()
+            with open(self.store, "rb") as f:
+                shutil.copyfileobj(f, self.wfile, HTTP_BUF_SIZE)
+        body.close()
+
+    def log_message(self, *args):
+        pass
+
+def buildCol(path, megabytes):
+    col = Collection(path)
+    # random content, so that compression doesn't shrink it
+    for i in range(megabytes * 16):
+        n = col.newNote()
+        n['Front'] = "%d" % i
+        n['Back'] = os.urandom(32*1024).hex()
+        col.addNote(n)
+    col.close()
+    return Collection(path)
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [10, 40]
+    tmp = tempfile.mkdtemp()
+    StandIn.store = os.path.join(tmp, "server.anki2")
+    server = http.server.HTTPServer(("127.0.0.1", 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:%d/sync/" % server.server_address[1]
+    FullSyncer.syncURL = lambda self: url
+    try:
+        for megabytes in sizes:
+            path = os.path.join(tmp, "bench%d.anki2" % megabytes)
+            col = buildCol(path, megabytes)
+            size = os.path.getsize(path)
+            tracemalloc.start()
+            assert FullSyncer(col, "hkey", None, None).upload()
+            col = Collection(path)
+            FullSyncer(col, "hkey", None, None).download()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            col = Collection(path)
+            assert col.noteCount() == megabytes * 16
+            col.close()
+            print("collection %5.1fMB: peak %5.1fMB" % (
+                size / 1024**2, peak / 1024**2))
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main()
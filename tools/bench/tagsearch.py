@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""Time tag searches on a collection with many tagged notes, done with
+the index of the notes' tags and with the LIKE on notes.tags it
+replaces, as well as listing the tags in use.
+
+Usage: PYTHONPATH=. tools/bench/tagsearch.py [notes]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from anki import Collection
+from anki.utils import guid64, intTime
+
+searches = ("tag:topic17", "tag:topic17::sub3", "tag:topic17::*",
+            "tag:*::sub3", "tag:rare")
+
+def populate(col, n):
+    "Add n notes, with a few hierarchical tags each, in sql."
+    mid = col.models.current()['id']
+    now = intTime()
+    rand = random.Random(0)
+    def rows():
+        for i in range(n):
+            tags = set("topic%d::sub%d" % (rand.randrange(200),
+                                           rand.randrange(10))
+                       for j in range(3))
+            tags.add("topic%d" % rand.randrange(200))
+            if i % 10000 == 0:
+                tags.add("rare")
+            yield (i + 1, guid64(), mid, now, -1,
+                   " %s " % " ".join(sorted(tags)), "front %d\x1fback" % i,
+                   "front %d" % i, 0, 0, "")
+    col.db.executemany(
+        "insert into notes values (?,?,?,?,?,?,?,?,?,?,?)", rows())
+    col.save()
+
+def likeSearch(col, search):
+    "The notes matching search with the former LIKE on notes.tags."
+    val = search[4:].replace("*", "%")
+    if not val.startswith("%"):
+        val = "% " + val
+    if not val.endswith("%"):
+        val += " %"
+    return col.db.list(
+        "select id from notes where tags like ? escape '\\'", val)
+
+def indexSearch(col, search):
+    "The notes matching search with the index, as done by the Finder."
+    args = []
+    return col.db.list(
+        col.noteTags.query(search[4:].replace("*", "%"), args), *args)
+
+def timed(fn, *args):
+    t = time.time()
+    res = fn(*args)
+    return time.time() - t, res
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    tmp = tempfile.mkdtemp()
+    try:
+        col = Collection(os.path.join(tmp, "collection.anki2"))
+        populate(col, n)
+        t, _ = timed(col.tags.registerNotes)
+        print("indexing %d notes and registering their tags: %.2fs" % (
+            n, t))
+        print("%-22s %8s %10s %10s" % ("search", "notes", "like", "index"))
+        for search in searches:
+            tlike, like = timed(likeSearch, col, search)
+            tidx, idx = timed(indexSearch, col, search)
+            assert sorted(like) == sorted(set(idx))
+            print("%-22s %8d %9.3fs %9.3fs" % (search, len(like), tlike, tidx))
+        t, _ = timed(col.tags.registerNotes)
+        print("registerNotes once indexed: %.3fs" % t)
+        col.close()
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main()